@@ -32,39 +32,66 @@ class Builder(object):
         self._current_dir = os.path.join(build_dir, "current")
         self._app_tarball = os.path.join(build_dir, "application.tar")
         self._svc_tarball = os.path.join(build_dir, "service.tar")
+        # Files deleted since the previous build (when only the changes are
+        # uploaded on top of it):
+        self._deleted_files = os.path.join(build_dir, "deleted.json")
+
+    def _delete_files(self):
+        with open(self._deleted_files, "r") as fp:
+            deleted = json.load(fp)
+        logging.debug("Deleting {0} files removed since the previous build".format(
+            len(deleted)
+        ))
+        for path in deleted:
+            try:
+                os.unlink(os.path.join(self._code_dir, path))
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+        os.unlink(self._deleted_files)
 
     def _unpack_sources(self):
-        logging.debug("Extracting application.tar and service.tar")
+        # Sandbox streams the code and the service files directly in place,
+        # but they can also come as application.tar and service.tar:
         with ignore_eexist():
             os.mkdir(self._code_dir)
-        untar_app = subprocess.Popen([
-            "tar", "--recursive-unlink",
-            "-xf", self._app_tarball,
-            "-C", self._code_dir,
-        ])
-        untar_svc = subprocess.Popen([
-            "tar",
-            "-xf", self._svc_tarball,
-            "-C", self._build_dir
-        ])
-        untar_svc = untar_svc.wait()
-        untar_app = untar_app.wait()
-        if untar_svc != 0:
-            logging.error(
-                "Couldn't extract the environment and the supervisor "
-                "configuration (tar returned {0})".format(untar_svc)
-            )
-        else:
-            os.unlink(self._svc_tarball)
-        if untar_app != 0:
-            logging.error(
-                "Couldn't extract the application code "
-                "(tar returned {0})".format(untar_app)
-            )
-        else:
-            os.unlink(self._app_tarball)
+        untar_app = untar_svc = None
+        if os.path.exists(self._app_tarball):
+            logging.debug("Extracting application.tar")
+            untar_app = subprocess.Popen([
+                "tar", "--recursive-unlink",
+                "-xf", self._app_tarball,
+                "-C", self._code_dir,
+            ])
+        if os.path.exists(self._svc_tarball):
+            logging.debug("Extracting service.tar")
+            untar_svc = subprocess.Popen([
+                "tar",
+                "-xf", self._svc_tarball,
+                "-C", self._build_dir
+            ])
+        if untar_svc is not None:
+            untar_svc = untar_svc.wait()
+            if untar_svc != 0:
+                logging.error(
+                    "Couldn't extract the environment and the supervisor "
+                    "configuration (tar returned {0})".format(untar_svc)
+                )
+            else:
+                os.unlink(self._svc_tarball)
+        if untar_app is not None:
+            untar_app = untar_app.wait()
+            if untar_app != 0:
+                logging.error(
+                    "Couldn't extract the application code "
+                    "(tar returned {0})".format(untar_app)
+                )
+            else:
+                os.unlink(self._app_tarball)
         if untar_app or untar_svc:
             return False
+        if os.path.exists(self._deleted_files):
+            self._delete_files()
 
         logging.debug("Setting up SSH keys")
         ssh_dir = os.path.join(self._build_dir, ".ssh")
@@ -88,11 +115,15 @@ class Builder(object):
 
         return True
 
-    def build(self):
+    def build(self, dependencies_only=False):
         """Unpack the sources and start the build.
 
         The build is started using the right service class from
         :mod:`builder.services <udotcloud.builder.services>`.
+
+        :param dependencies_only: only install the dependencies of the service
+                                  (see :meth:`ServiceBase.install_dependencies
+                                  <udotcloud.builder.services.ServiceBase.install_dependencies>`).
         """
 
         if not self._unpack_sources():
@@ -100,6 +131,13 @@ class Builder(object):
         service_builder = get_service(
             self._build_dir, self._current_dir, self._svc_definition
         )
+        if dependencies_only:
+            returncode = service_builder.install_dependencies()
+            if returncode == 0:
+                log_success("Dependencies installed for service {0}".format(
+                    self._svc_definition['name']
+                ))
+            return returncode
         returncode = service_builder.build()
         if returncode == 0:
             log_success("{0} build done for service {1}".format(
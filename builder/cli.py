@@ -22,6 +22,9 @@ environment—).
 This binary is called internally by udotcloud.sandbox and shouldn't be called
 manually."""
     )
+    parser.add_argument("--dependencies", action="store_true",
+        help="Only install the dependencies of the service"
+    )
     parser.add_argument("sources", default=".",
         help="Path to the sources directory"
     )
@@ -32,7 +35,7 @@ manually."""
 
     try:
         builder = Builder(args.sources)
-        sys.exit(builder.build())
+        sys.exit(builder.build(dependencies_only=args.dependencies))
     except Exception:
         logging.exception("Sorry, the following bug happened:")
     sys.exit(1)
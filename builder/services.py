@@ -10,6 +10,8 @@ from a service type.
 """
 
 import copy
+import hashlib
+import json
 import logging
 import os
 import shutil
@@ -20,6 +22,10 @@ from ..utils import ignore_eexist, strsignal
 
 class ServiceBase(object):
 
+    #: True if the dependencies of this type of service can be installed
+    #: alone, before the code (see :meth:`install_dependencies`).
+    CACHEABLE_DEPENDENCIES = False
+
     SUPERVISOR_PROCESS_TPL = """[program:{name}]
 command=/bin/sh -lc "exec {command}"
 directory={exec_dir}
@@ -47,6 +53,7 @@ stderr_logfile={supervisor_dir}/{name}_error.log
         self._templates = TemplatesRepository()
 
     def _configure(self): pass
+    def _install_dependencies(self): pass
     def _install_requirements(self): pass
 
     def _run_hook(self, hook_script):
@@ -118,19 +125,10 @@ stderr_logfile={supervisor_dir}/{name}_error.log
                     exec_dir=self._svc_dir, supervisor_dir=self._supervisor_dir
                 ))
 
-    def build(self):
-        logging.debug("Building service {0} ({1}) inside Docker".format(
-            self._name, self._type
-        ))
+    def _run_steps(self, steps):
         try:
-            self._symlink_current()
-            self._hook_prebuild()
-            self._generate_supervisor_configuration()
-            self._generate_processes()
-            self._configure_sshd()
-            self._configure()
-            self._install_requirements()
-            self._hook_postbuild()
+            for step in steps:
+                step()
         except subprocess.CalledProcessError as ex:
             cmd = " ".join(ex.cmd) if isinstance(ex.cmd, list) else ex.cmd
             msg = "Can't build service {0} ({1}): the command " \
@@ -147,8 +145,40 @@ stderr_logfile={supervisor_dir}/{name}_error.log
             return ex.returncode
         return 0
 
+    def build(self):
+        logging.debug("Building service {0} ({1}) inside Docker".format(
+            self._name, self._type
+        ))
+        return self._run_steps([
+            self._symlink_current,
+            self._hook_prebuild,
+            self._generate_supervisor_configuration,
+            self._generate_processes,
+            self._configure_sshd,
+            self._configure,
+            self._install_requirements,
+            self._hook_postbuild
+        ])
+
+    def install_dependencies(self):
+        """Only install the dependencies of the service.
+
+        This is done, with nothing but the files listing the dependencies,
+        to commit them in an image that later builds can re-use; :meth:`build`
+        then skips them if they haven't changed.
+        """
+
+        logging.debug("Installing the dependencies of service {0} ({1})".format(
+            self._name, self._type
+        ))
+        return self._run_steps([
+            self._symlink_current, self._install_dependencies
+        ])
+
 class PythonWorker(ServiceBase):
 
+    CACHEABLE_DEPENDENCIES = True
+
     def __init__(self, *args, **kwargs):
         ServiceBase.__init__(self, *args, **kwargs)
         self._virtualenv_dir = os.path.join(self._build_dir, "env")
@@ -156,22 +186,58 @@ class PythonWorker(ServiceBase):
         self._pip_cache = os.path.join(self._build_dir, ".pip-cache")
         self._requirements = os.path.join(self._svc_dir, "requirements.txt")
         self._svc_setup_py = os.path.join(self._svc_dir, "setup.py")
+        # Digest of what was used to install the virtualenv:
+        self._dependencies_stamp = os.path.join(
+            self._virtualenv_dir, ".dependencies-digest"
+        )
 
-    def _configure(self):
-        python_version = self._config.get("python_version", "v2.6")[1:]
+    @property
+    def _python_version(self):
+        return self._config.get("python_version", "v2.6")[1:]
+
+    def _dependencies_digest(self):
+        requirements = None
+        if os.path.exists(self._requirements):
+            with open(self._requirements, "r") as fp:
+                requirements = fp.read()
+        return hashlib.sha1(json.dumps([
+            self._type, self._python_version, requirements,
+            self._extra_requirements, getattr(self, "UWSGI_VERSION", None)
+        ])).hexdigest()
+
+    def _install_dependencies(self):
+        digest = self._dependencies_digest()
+        try:
+            with open(self._dependencies_stamp, "r") as fp:
+                if fp.read() == digest:
+                    logging.info(
+                        "The dependencies of {0} ({1}) are already "
+                        "installed".format(self._name, self._type)
+                    )
+                    return
+        except IOError:
+            pass
+        # Start from a new virtualenv, like if nothing was installed:
+        shutil.rmtree(self._virtualenv_dir, ignore_errors=True)
         logging.info("Configuring {0} ({1}) for Python {2}:".format(
-            self._name, self._type, python_version
+            self._name, self._type, self._python_version
         ))
-        python_version = "python" + python_version
         subprocess.check_call([
-            "virtualenv", "-p", python_version, self._virtualenv_dir
+            "virtualenv", "-p", "python" + self._python_version,
+            self._virtualenv_dir
         ])
+        self._install_packages()
+        with open(self._dependencies_stamp, "w") as fp:
+            fp.write(digest)
+
+    def _configure(self):
+        self._install_dependencies()
         with open(self._profile, 'a') as profile:
             profile.write("\n. {0}\n".format(
                 os.path.join(self._virtualenv_dir, "bin/activate")
             ))
 
-    def _install_requirements(self):
+    def _install_packages(self):
         if os.path.exists(self._requirements):
             logging.info("Installating requirements from requirements.txt:")
             subprocess.check_call([
@@ -189,6 +255,8 @@ class PythonWorker(ServiceBase):
                 "--download-cache={0}".format(self._pip_cache),
                 " ".join(self._extra_requirements)
             ])
+
+    def _install_requirements(self):
         if os.path.exists(self._svc_setup_py):
             subprocess.check_call(
                 [self._pip, "install", ".", "-U"],
@@ -228,10 +296,13 @@ class Python(PythonWorker):
         with open(self._supervisor_include, "a") as fp:
             fp.write(uwsgi_inc)
             fp.write(nginx_inc)
+
+    def _install_packages(self):
         logging.debug("Installing uWSGI {0}".format(self.UWSGI_VERSION))
         subprocess.check_call([
             self._pip, "install", "uWSGI {0}".format(self.UWSGI_VERSION)
         ])
+        PythonWorker._install_packages(self)
 
 class Custom(ServiceBase):
 
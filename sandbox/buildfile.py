@@ -171,6 +171,25 @@ _schema = _require(
                 'prebuild': _optional(str),
                 'postbuild': _optional(str),
                 'ruby_version': _optional(str),
+                # Deadlines, in seconds, of each step of the build:
+                'timeouts': _optional(dict, {
+                    'systempackages': _optional(int),
+                    'upload': _optional(int),
+                    'bootstrap': _optional(int),
+                    'build': _optional(int),
+                }),
+                # Resources of the build container, see containers.Limits:
+                'limits': _optional(dict, {
+                    'cpu_shares': _optional(int),
+                    'cpuset': _optional(str, checks=[
+                        ('cpuset (e.g: "0-3" or "0,2")',
+                            lambda c: re.match(r'^\d+(-\d+)?(,\d+(-\d+)?)*$', c)),
+                    ]),
+                    'memory': _optional(str, checks=[
+                        ('memory size (e.g: "512M" or "2G")',
+                            lambda m: re.match(r'^\d+(\.\d+)?[bkmgtBKMGT]?$', m)),
+                    ]),
+                }),
             },
             checks=[
                 ('service name (must be <= 16 characters)', lambda n: len(n) <= 16),
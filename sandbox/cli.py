@@ -3,14 +3,20 @@
 import argparse
 import colorama
 import errno
+import json
 import logging
+import os
 import re
 import string
 import sys
 
-from .containers import ImageRevSpec, Image
-from .exceptions import UnkownImageError
-from .sources import Application
+from .containers import ImageRevSpec, Image, Limits, configure_scheduler
+from .containers import configure_warm_pool, drain_warm_pool, use_backend
+from .containers import configure_image_catalog, docker_metrics, scheduler_stats
+from .exceptions import UnkownImageError, DockerNotFoundError
+from .sources import Application, build_applications
+from .tarfile import CODECS
+from ..utils import human_to_bytes
 from ..utils.debug import configure_logging, log_success
 
 def parse_environment_variables(env_list):
@@ -30,7 +36,30 @@ def parse_environment_variables(env_list):
         env_dict[key] = value
     return env_dict
 
-def cmd_build(args, application):
+def load_application(path, env):
+    logging.debug("Loading {0}".format(path))
+    try:
+        application = Application(path, env)
+    except IOError as ex:
+        if ex.errno == errno.ENOENT:
+            logging.error("Couldn't find a dotcloud.yml in {0}".format(path))
+        else:
+            logging.error("Couldn't load {0}: {1}".format(path, ex.strerror))
+        sys.exit(1)
+    logging.debug("Application's buildfile: {0}".format(application))
+    logging.debug("Application's environment: {0}".format(
+        application.environment
+    ))
+    logging.info("{0} successfully loaded with {1} service(s): {2}".format(
+        application.name,
+        len(application.services),
+        ", ".join([
+            "{0} ({1})".format(s.name, s.type) for s in application.services
+        ])
+    ))
+    return application
+
+def parse_build_options(args):
     try:
         base_image = Image(ImageRevSpec.parse(args.image)) if args.image else None
     except ValueError as ex:
@@ -43,27 +72,95 @@ def cmd_build(args, application):
         )
         sys.exit(1)
 
+    try:
+        memory = human_to_bytes(args.memory) if args.memory else None
+    except ValueError:
+        logging.error("Can't parse the memory limit: {0}".format(args.memory))
+        sys.exit(1)
+    limits = Limits(args.cpu_shares, args.cpuset, memory)
+
+    configure_scheduler(args.jobs)
+    configure_warm_pool(args.warm_pool)
+
     logging.debug("Starting build with base image: {0}".format(
         base_image.revspec if base_image else "default"
     ))
-    result_images = application.build(base_image)
-    if result_images:
-        log_success("{0} successfully built:\n    - {1}".format(
-            application.name,
-            "\n    - ".join([
-                "{0}: {1}".format(service, image)
-                for service, image in result_images.iteritems()
-            ])
-        ))
+    return base_image, dict(
+        squash=args.squash, limits=limits, refresh_cache=args.refresh_cache,
+        incremental=not args.full, compression=args.compress,
+        workers=args.workers, fail_fast=args.fail_fast
+    )
+
+def read_application_list(path):
+    """Return the application directories listed in a file, one per line
+    (blank lines and lines starting with # are skipped), relative paths are
+    relative to the directory of the file.
+    """
+
+    try:
+        with open(path, "r") as fp:
+            lines = [line.strip() for line in fp]
+    except IOError as ex:
+        logging.error("Couldn't read {0}: {1}".format(path, ex.strerror))
+        sys.exit(1)
+    return [
+        os.path.join(os.path.dirname(path), line) for line in lines
+        if line and not line.startswith("#")
+    ]
+
+def cmd_build(args, applications):
+    base_image, options = parse_build_options(args)
+    if len(applications) > 1:
+        # The build of each service looks for images that don't exist yet
+        # (e.g: the result of a build with the same inputs), don't list all
+        # the images again for each of them:
+        configure_image_catalog(reload_interval=30)
+    try:
+        results = build_applications(applications, base_image, **options)
+    except ValueError as ex:
+        logging.error(str(ex))
+        sys.exit(1)
+    finally:
+        drain_warm_pool()
+    for application, result_images in results.iteritems():
+        if result_images:
+            log_success("{0} successfully built:\n    - {1}".format(
+                application.name,
+                "\n    - ".join([
+                    "{0}: {1}".format(service, image)
+                    for service, image in result_images.iteritems()
+                ])
+            ))
+        elif result_images is not None:
+            logging.warning("No buildable service found in {0}".format(
+                application.name
+            ))
+    if all(r is not None for r in results.itervalues()) and \
+        any(results.itervalues()):
         sys.exit(0)
-    elif result_images is not None:
-        logging.warning("No buildable service found in {0}".format(
-            application.name
-        ))
 
 def cmd_run(args, application):
     sys.exit(0 if application.run() else 1)
 
+def cmd_watch(args, application):
+    base_image, options = parse_build_options(args)
+    try:
+        ret = application.watch(base_image, args.debounce, **options)
+    finally:
+        drain_warm_pool()
+    sys.exit(0 if ret else 1)
+
+def dump_metrics(path):
+    metrics = docker_metrics()
+    metrics["scheduler"] = scheduler_stats()
+    try:
+        with open(path, "w") as fp:
+            json.dump(metrics, fp, indent=4, sort_keys=True)
+    except IOError as ex:
+        logging.error("Couldn't write the metrics to {0}: {1}".format(
+            path, ex.strerror
+        ))
+
 def main():
     colorama.init()
 
@@ -80,19 +177,99 @@ generated in the environment).
         choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
         help="Log level to use on stderr"
     )
+    parser.add_argument("--docker", dest="docker_backend", default="auto",
+        choices=["auto", "api", "cli"],
+        help="Talk to Docker through its remote API or through the docker "
+            "command (auto uses the API when its unix socket is accessible)"
+    )
+    parser.add_argument("--metrics", metavar="FILE",
+        help="Write the metrics of the Docker operations (durations, errors, "
+            "bytes transferred…) to this file, in JSON"
+    )
 
     subparsers = parser.add_subparsers(dest="cmd")
 
-    parser_build = subparsers.add_parser("build",
-        help="build Docker images from the given dotCloud application (directory)"
-    )
-    parser_build.add_argument("-e", "--env", action="append",
+    # Shared by the build and watch commands:
+    build_options = argparse.ArgumentParser(add_help=False)
+    build_options.add_argument("-e", "--env", action="append",
         help="Define an environment variable (in the form KEY=VALUE) during the build"
     )
-    parser_build.add_argument("-i", "--image",
+    build_options.add_argument("-i", "--image",
         help="Specify which Docker image to use as a starting point to build services"
     )
+    build_options.add_argument("-j", "--jobs", type=int,
+        help="How many heavy Docker operations (run, commit…) of each type "
+            "can run at the same time (defaults to the number of CPUs)"
+    )
+    build_options.add_argument("--fail-fast", action="store_true",
+        default=None,
+        help="Stop the build of all the services as soon as one fails (the "
+            "default when the CI environment variable is set to true)"
+    )
+    build_options.add_argument("--no-fail-fast", action="store_false",
+        dest="fail_fast",
+        help="Keep building the other services when one fails"
+    )
+    build_options.add_argument("--workers", type=int,
+        help="How many build stages (of all the services) can run at the same "
+            "time (by default, twice the number of CPUs)"
+    )
+    build_options.add_argument("--warm-pool", type=int, default=0,
+        metavar="SIZE",
+        help="Start the build containers in advance, and keep SIZE idle "
+            "containers per base image ready for the next builds"
+    )
+    build_options.add_argument("--compress", default="auto",
+        choices=["auto", "none"] + sorted(CODECS),
+        help="Compress the code on its way to the containers (by default, "
+            "depending on its size)"
+    )
+    build_options.add_argument("--full", action="store_true",
+        help="Upload all the code instead of the changes since the last build"
+    )
+    build_options.add_argument("--refresh-cache", action="store_true",
+        help="Rebuild the cached layers (e.g: the system packages) instead of "
+            "re-using the ones from the previous builds"
+    )
+    build_options.add_argument("--squash", action="store_true",
+        help="Flatten the layers added on top of the base image into a single "
+            "layer in the resulting images (slower, but they start faster)"
+    )
+    build_options.add_argument("--cpu-shares", type=int,
+        help="CPU shares (relative weight) of each build container "
+            "(defaults to 1024, i.e: the CPUs are shared equally)"
+    )
+    build_options.add_argument("--cpuset",
+        help="CPUs the build containers can use (e.g: 0-3 or 0,2, defaults "
+            "to all the CPUs but the first one on hosts with 4 CPUs or more)"
+    )
+    build_options.add_argument("--memory",
+        help="Memory limit of each build container (e.g: 512M or 2G, defaults "
+            "to an equal share of 3/4 of the host memory between the services)"
+    )
+
+    parser_build = subparsers.add_parser("build", parents=[build_options],
+        help="build Docker images from the given dotCloud applications (directories)"
+    )
+    parser_build.add_argument("--from-file", metavar="FILE",
+        help="Also build the applications listed in this file (one directory "
+            "per line, relative to the file)"
+    )
     parser_build.add_argument("application",
+        help="Path to your application source directory (where your "
+            "dotcloud.yml is), several applications are built at once",
+        nargs="*"
+    )
+
+    parser_watch = subparsers.add_parser("watch", parents=[build_options],
+        help="build and run the given dotCloud application, then rebuild and "
+            "restart the services as their code changes (EXPERIMENTAL)"
+    )
+    parser_watch.add_argument("--debounce", type=float, default=0.5,
+        metavar="SECONDS",
+        help="Wait until nothing changed for that long before rebuilding"
+    )
+    parser_watch.add_argument("application",
         help="Path to your application source directory (where your dotcloud.yml is)",
         default=".", nargs="?"
     )
@@ -109,41 +286,36 @@ generated in the environment).
     args = parser.parse_args()
     configure_logging("==>", args.log_lvl)
 
+    try:
+        use_backend(args.docker_backend)
+    except DockerNotFoundError as ex:
+        logging.error(str(ex))
+        sys.exit(1)
+
     if getattr(args, "env", None):
         env = parse_environment_variables(args.env)
     else:
         env = {}
 
     try:
-        logging.debug("Loading {0}".format(args.application))
-        try:
-            application = Application(args.application, env)
-        except IOError as ex:
-            if ex.errno == errno.ENOENT:
-                logging.error("Couldn't find a dotcloud.yml in {0}".format(
-                    args.application
-                ))
-            else:
-                logging.error("Couldn't load {0}: {1}".format(
-                    args.application, ex.strerror
-                ))
-            sys.exit(1)
-        logging.debug("Application's buildfile: {0}".format(application))
-        logging.debug("Application's environment: {0}".format(
-            application.environment
-        ))
-        logging.info("{0} successfully loaded with {1} service(s): {2}".format(
-            application.name,
-            len(application.services),
-            ", ".join([
-                "{0} ({1})".format(s.name, s.type) for s in application.services
-            ])
-        ))
-
         if args.cmd == "build":
-            cmd_build(args, application)
-        elif args.cmd == "run":
-            cmd_run(args, application)
+            paths = list(args.application)
+            if args.from_file:
+                paths.extend(read_application_list(args.from_file))
+            applications = [load_application(p, env) for p in paths or ["."]]
+        else:
+            application = load_application(args.application, env)
+
+        try:
+            if args.cmd == "build":
+                cmd_build(args, applications)
+            elif args.cmd == "run":
+                cmd_run(args, application)
+            elif args.cmd == "watch":
+                cmd_watch(args, application)
+        finally:
+            if args.metrics:
+                dump_metrics(args.metrics)
     except Exception:
         logging.exception("Sorry, the following bug happened:")
     sys.exit(1)
@@ -6,25 +6,43 @@ sandbox.containers
 
 This module implements a Python binding for Docker.
 
-Docker functionnalities are exposed through three different classes:
+Docker functionnalities are exposed through the following classes:
 
 - :class:`ImageRevSpec`: used to instantiate images;
 - :class:`Image`: used to instantiate containers;
-- :class:`Container`: used to run and commit new images.
+- :class:`Container`: used to run and commit new images;
+- :class:`BuildSession`: used to run several commands in the same container
+  and commit new images when needed.
+- :class:`Limits`: used to cap the CPU and memory of containers.
+
+Docker is either reached through its remote API (on the unix socket of the
+daemon) or through the docker command, see :func:`use_backend`. Either way,
+the number of Docker operations running at the same time is capped, see
+:func:`configure_scheduler`. Build sessions can also use containers started in
+advance, see :func:`configure_warm_pool`.
 """
 
+import bisect
 import collections
 import contextlib
 import copy
 import gevent
 import gevent.event
+import gevent.local
 import gevent.subprocess
+import heapq
 import itertools
 import json
 import logging
+import multiprocessing
+import os
 import re
+import tempfile
+import time
 
-from .exceptions import UnkownImageError, DockerCommandError, DockerNotFoundError
+from . import dockerapi, squash
+from .exceptions import UnkownImageError, ContainerTimeoutError
+from .exceptions import DockerCommandError, DockerNotFoundError
 from ..utils import bytes_to_human
 
 class _CatchDockerError(object):
@@ -37,7 +55,1619 @@ class _CatchDockerError(object):
             raise DockerCommandError(exc_value.output)
         return False
 
-class Container(object):
+class _EventsWatcher(object):
+    """Follow the events of the Docker daemon to know when containers exit.
+
+    A single subscription to the events is shared by all the containers,
+    instead of one ``docker wait`` (or one wait request) per container.
+
+    When the stream of events breaks (e.g: the daemon restarted), it's
+    followed again from the time of the last event, waiting longer and
+    longer between each attempt. The containers waited for only get an
+    error after several attempts in a row failed.
+
+    :param subscribe: callable that takes a timestamp and returns an iterable
+                      over the (status, container id, timestamp or None) of
+                      the events since then.
+    """
+
+    #: How many exits to remember for the containers nobody waits for yet
+    #: (containers can exit before :meth:`exited` is called).
+    RECENT_EXITS_SIZE = 1024
+
+    #: How many times in a row following the events can fail before the
+    #: containers waited for get the error.
+    MAX_FAILURES = 5
+
+    #: How long to wait, in seconds, before following the events again (it
+    #: doubles after each failure, up to MAX_RETRY_DELAY).
+    RETRY_DELAY = 0.5
+    MAX_RETRY_DELAY = 30
+
+    def __init__(self, subscribe):
+        self._subscribe = subscribe
+        # Subscribe from there, the containers started before the subscription
+        # is made won't be missed:
+        self._since = int(time.time()) - 1
+        # short container id → AsyncResult:
+        self._exits = {}
+        self._recent_exits = collections.OrderedDict()
+        self._events = None
+        self._greenlet = None
+
+    @staticmethod
+    def _short_id(container_id):
+        return container_id[:12]
+
+    def _died(self, container_id):
+        short_id = self._short_id(container_id)
+        exited = self._exits.pop(short_id, None)
+        if exited is not None:
+            exited.set()
+            return
+        self._recent_exits[short_id] = True
+        if len(self._recent_exits) > self.RECENT_EXITS_SIZE:
+            self._recent_exits.popitem(last=False)
+
+    def _watch(self):
+        failures = 0
+        while True:
+            try:
+                self._events = self._subscribe(self._since)
+                for status, container_id, timestamp in self._events:
+                    failures = 0
+                    # Follow the events from there if the stream breaks (the
+                    # time of the daemon when it's known, it can be remote):
+                    self._since = int(timestamp or time.time()) - 1
+                    if status == "die":
+                        self._died(container_id)
+                raise DockerCommandError("The stream of Docker events closed")
+            except Exception as ex:
+                failures += 1
+                logging.debug(
+                    "Couldn't follow the events from Docker ({0} times in a "
+                    "row): {1}".format(failures, ex)
+                )
+                if failures >= self.MAX_FAILURES:
+                    exits, self._exits = self._exits, {}
+                    for exited in exits.itervalues():
+                        exited.set_exception(ex)
+            gevent.sleep(min(
+                self.RETRY_DELAY * 2 ** (failures - 1), self.MAX_RETRY_DELAY
+            ))
+
+    def exited(self, container_id):
+        """Return a :class:`gevent.event.AsyncResult` set once the given
+        container has exited.
+        """
+
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._watch)
+        short_id = self._short_id(container_id)
+        if short_id in self._recent_exits:
+            exited = gevent.event.AsyncResult()
+            exited.set()
+            return exited
+        return self._exits.setdefault(short_id, gevent.event.AsyncResult())
+
+    def wait(self, container_id):
+        """Wait for a container to exit and return its exit code."""
+
+        self.exited(container_id).get()
+        return inspect_many([container_id])[0]['State']['ExitCode']
+
+    def close(self):
+        """Stop following the events."""
+
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+        if hasattr(self._events, "close"):
+            self._events.close()
+        self._events = None
+
+def _write_output(sink, data):
+    """Write data to a callable, a file descriptor or a file object."""
+
+    if callable(sink):
+        sink(data)
+    elif isinstance(sink, int):
+        os.write(sink, data)
+    else:
+        sink.write(data)
+        sink.flush()
+
+class _ContainerProcess(object):
+    """Mimic the parts of :class:`subprocess.Popen` used on the objects
+    yielded by :meth:`Container.run` and :meth:`Container.run_stream_logs`,
+    for a container waited for with the :class:`_EventsWatcher`.
+
+    :param wait: callable that waits for the container and returns its exit
+                 code.
+    :param attached: process attached to the output of the container (e.g:
+                     docker attach) if any, its stdout is exposed.
+    """
+
+    def __init__(self, wait, attached=None, pumps=[]):
+        self._wait = wait
+        self._attached = attached
+        self._pumps = pumps
+        self.stdin = self.stderr = None
+        self.stdout = attached.stdout if attached and not pumps else None
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            self.returncode = self._wait()
+            if self._attached:
+                self._attached.wait()
+            gevent.joinall(self._pumps)
+        return self.returncode
+
+    def communicate(self):
+        output = self.stdout.read() if self.stdout else None
+        self.wait()
+        return output, None
+
+class _CLIBackend(object):
+    """Drive Docker by forking the docker command for each operation."""
+
+    name = "cli"
+
+    # The format of docker events before Docker 1.10:
+    _EVENT_RE = re.compile(
+        r"(?P<id>[0-9a-f]{12,64}): \(from .*\) (?P<status>\w+)\s*$"
+    )
+    # And since then (when --format isn't supported, before 1.13):
+    _CONTAINER_EVENT_RE = re.compile(
+        r"^\S+ container (?P<status>\w+) (?P<id>[0-9a-f]{12,64})\b"
+    )
+
+    def __init__(self):
+        self.events = _EventsWatcher(self.subscribe)
+        # Cleared if docker events doesn't support --format:
+        self._json_events = True
+
+    @staticmethod
+    def _generate_option_list(option, args):
+        """_generate_option_list("-p", [1, 2…]) → ["-p", 1, "-p", 2…]"""
+        return list(
+            itertools.chain.from_iterable(itertools.product([option], args))
+        )
+
+    @classmethod
+    def _generate_env_option_list(cls, env):
+        return cls._generate_option_list(
+            "-e", ["{0}={1}".format(k, v) for k, v in env.iteritems()]
+        )
+
+    @staticmethod
+    def _generate_limits_option_list(limits):
+        options = []
+        if limits is None:
+            return options
+        if limits.cpu_shares is not None:
+            options += ["-c", str(limits.cpu_shares)]
+        if limits.cpuset is not None:
+            options += ["--cpuset={0}".format(limits.cpuset)]
+        if limits.memory is not None:
+            options += ["-m", str(limits.memory)]
+        return options
+
+    @staticmethod
+    def _pump(fp, sink):
+        def pump():
+            # See the comment on readline in run, lines are split every 8KiB
+            # so a process that never outputs a newline can't fill our memory:
+            for line in iter(lambda: fp.readline(8192), ""):
+                _write_output(sink, line)
+        return gevent.spawn(pump)
+
+    @classmethod
+    def _stream_output(cls, container_id, output, errors=None):
+        # docker logs outputs the stderr of the container on its own stderr
+        # unless the container has a tty:
+        logs = gevent.subprocess.Popen(
+            ["docker", "logs", "-f", container_id],
+            stdout=Container.PIPE,
+            stderr=Container.PIPE if errors else Container.STDOUT
+        )
+        pumps = [cls._pump(logs.stdout, output)]
+        if errors:
+            pumps.append(cls._pump(logs.stderr, errors))
+        def pump():
+            try:
+                gevent.joinall(pumps, raise_error=True)
+                logs.wait()
+            finally:
+                gevent.killall(pumps)
+        return gevent.spawn(pump)
+
+    def run(self, revision, cmd, as_user=None, env={}, stdin=None, output=None,
+            errors=None, limits=None):
+        as_user = ["-u", str(as_user)] if as_user else []
+        env = self._generate_env_option_list(env)
+        limits = self._generate_limits_option_list(limits)
+        # stdout and stderr can only be told apart without a tty:
+        tty = ["-t"] if errors is None else []
+        # If stdin is None, start the container in detached mode, this will
+        # print the id on stdout, then we simply wait for the container to
+        # stop. If stdin is not None, start the container in attached mode
+        # without stdout and stderr. This will print the container id on
+        # stdout so we can read it.
+        if stdin is None:
+            with _CatchDockerError():
+                container_id = gevent.subprocess.check_output(
+                    ["docker", "run", "-d"] + tty + as_user
+                    + env + limits + [revision] + cmd
+                ).strip()
+            docker = _ContainerProcess(
+                lambda: self.events.wait(container_id)
+            )
+        else:
+            docker = gevent.subprocess.Popen(
+                ["docker", "run", "-i", "-a", "stdin"]
+                + as_user + env + limits + [revision] + cmd,
+                stdin=stdin, stdout=Container.PIPE
+            )
+            # readline instead of read is important here, the object behind
+            # docker.stdout is actually a socket._fileobject (yes, the real
+            # socket module from Python) and its read method returns when
+            # its buffer (8192 bytes by default on Python 2.7) is full or
+            # when EOF is reached, not when the underlying read system call
+            # returns.
+            container_id = docker.stdout.readline().strip()
+        # docker logs -f outputs everything since the start of the container,
+        # so we can't miss anything even if the container already started:
+        return container_id, docker, self._stream_output(
+            container_id, output, errors
+        )
+
+    def run_detached(self, revision, cmd, as_user=None, env={}, ports=[],
+            limits=None):
+        as_user = ["-u", str(as_user)] if as_user else []
+        ports = self._generate_option_list("-p", [str(p) for p in ports])
+        env = self._generate_env_option_list(env)
+        limits = self._generate_limits_option_list(limits)
+        with _CatchDockerError():
+            return gevent.subprocess.check_output(
+                ["docker", "run", "-d"] + as_user + env + limits
+                + ports + [revision] + cmd
+            ).strip()
+
+    def attach(self, container_id, output=None, errors=None):
+        # Callables can't be given to Popen, pump the output to them:
+        pumps = []
+        stdout, stderr = output, Container.STDOUT
+        if callable(output):
+            stdout = Container.PIPE
+        if errors is not None:
+            stderr = Container.PIPE if callable(errors) else errors
+        attached = gevent.subprocess.Popen(
+            ["docker", "attach", container_id], stdout=stdout, stderr=stderr
+        )
+        if callable(output):
+            pumps.append(self._pump(attached.stdout, output))
+        if callable(errors):
+            pumps.append(self._pump(attached.stderr, errors))
+        return _ContainerProcess(
+            lambda: self.events.wait(container_id), attached, pumps
+        )
+
+    @classmethod
+    def _parse_event(cls, line):
+        """Return the (status, container id, timestamp or None) of an event
+        written by docker events, or None.
+        """
+
+        if line.startswith("{"):
+            try:
+                event = json.loads(line)
+            except ValueError:
+                return None
+            if event.get("Type", "container") != "container":
+                return None
+            status = event.get("status", event.get("Action"))
+            container_id = event.get("id", event.get("Actor", {}).get("ID"))
+            if not status or not container_id:
+                return None
+            return status, container_id, event.get("time")
+        match = cls._EVENT_RE.search(line) or \
+            cls._CONTAINER_EVENT_RE.search(line)
+        if match:
+            return match.group("status"), match.group("id"), None
+        return None
+
+    def subscribe(self, since):
+        cmd = ["docker", "events", "--since", str(since)]
+        json_events = self._json_events
+        if json_events:
+            cmd.extend(["--format", "{{json .}}"])
+        events = gevent.subprocess.Popen(
+            cmd, stdout=Container.PIPE, stderr=Container.PIPE
+        )
+        try:
+            # See the comment on readline in run:
+            for line in iter(events.stdout.readline, ""):
+                event = self._parse_event(line.strip())
+                if event:
+                    yield event
+                else:
+                    logging.debug("Unknown Docker event: {0}".format(line))
+            if events.wait() != 0:
+                error = events.stderr.read().strip()
+                if json_events and "format" in error:
+                    logging.debug(
+                        "docker events doesn't support --format, following "
+                        "them in plain text"
+                    )
+                    self._json_events = False
+                raise DockerCommandError(error)
+        finally:
+            if events.poll() is None:
+                events.kill()
+            events.wait()
+
+    def execute(self, container_id, cmd, as_user=None, stdin=None, output=None):
+        as_user = ["-u", str(as_user)] if as_user else []
+        interactive = ["-i"] if stdin is not None else []
+        docker = gevent.subprocess.Popen(
+            ["docker", "exec"] + interactive + as_user + [container_id] + cmd,
+            stdin=stdin, stdout=Container.PIPE, stderr=Container.STDOUT
+        )
+        def pump():
+            # See the comment on readline in run:
+            for line in iter(docker.stdout.readline, ""):
+                output(line)
+        return docker, gevent.spawn(pump)
+
+    def kill(self, container_id):
+        with open("/dev/null", "w") as ignore, _CatchDockerError():
+            gevent.subprocess.check_call(
+                ["docker", "kill", container_id],
+                stdout=ignore, stderr=Container.STDOUT
+            )
+
+    def inspect(self, container_id):
+        with _CatchDockerError():
+            infos = json.loads(gevent.subprocess.check_output([
+                "docker", "inspect", container_id
+            ]).strip())
+        # In docker 0.4.1 docker inspect will return a list:
+        if isinstance(infos, list):
+            return infos[0]
+        return infos
+
+    def inspect_many(self, container_ids):
+        with _CatchDockerError():
+            infos = json.loads(gevent.subprocess.check_output(
+                ["docker", "inspect"] + container_ids
+            ).strip())
+        return infos if isinstance(infos, list) else [infos]
+
+    def commit(self, container_id, fqrn=None, tag=None, message=None):
+        commit = ["docker", "commit"]
+        if message:
+            commit.extend(["-m", message])
+        commit.append(container_id)
+        if fqrn:
+            commit.append(fqrn)
+        if tag:
+            commit.append(tag)
+        with _CatchDockerError():
+            return gevent.subprocess.check_output(
+                commit, stderr=Container.STDOUT
+            ).strip()
+
+    def remove_container(self, container_id):
+        with _CatchDockerError():
+            gevent.subprocess.check_call(["docker", "rm", container_id])
+
+    def stop(self, container_id, wait=10):
+        with open("/dev/null", "w") as ignore, _CatchDockerError():
+            gevent.subprocess.check_call(
+                ["docker", "stop", "-t", str(wait), container_id],
+                stdout=ignore, stderr=Container.STDOUT
+            )
+
+    def images(self):
+        with _CatchDockerError():
+            images = gevent.subprocess.check_output(
+                ["docker", "images"], stderr=gevent.subprocess.STDOUT
+            ).splitlines()[1:]
+        revspecs = []
+        for line in images:
+            try:
+                revspecs.append(ImageRevSpec.parse_from_docker(line))
+            except ValueError as ex:
+                logging.warning(str(ex))
+        return revspecs
+
+    def inspect_image(self, revision):
+        return self.inspect(revision)
+
+    def save(self, revision, dest):
+        with _CatchDockerError():
+            gevent.subprocess.check_call(
+                ["docker", "save", revision], stdout=dest
+            )
+
+    def load(self, source):
+        with _CatchDockerError():
+            gevent.subprocess.check_call(["docker", "load"], stdin=source)
+
+    def remove_image(self, revision):
+        with _CatchDockerError():
+            gevent.subprocess.check_call(["docker", "rmi", revision])
+
+    def tag(self, revision, fqrn, tag):
+        with _CatchDockerError():
+            gevent.subprocess.check_call(["docker", "tag", revision, fqrn, tag])
+
+class _APIProcess(object):
+    """Mimic the parts of :class:`subprocess.Popen` used on the objects
+    yielded by :meth:`Container.run` and :meth:`Container.run_stream_logs`
+    when Docker is reached through its remote API.
+    """
+
+    class _Stdin(object):
+        def __init__(self, stream):
+            self._stream = stream
+
+        def write(self, data):
+            self._stream.write(data)
+
+        def close(self):
+            self._stream.close_stdin()
+
+    class _Stdout(object):
+        # Like AttachedStream.read, but without stderr:
+        def __init__(self, stream, errors):
+            self._stream = stream
+            self._errors = errors
+
+        def read(self):
+            output = []
+            for stream_type, data in self._stream.frames():
+                if stream_type == dockerapi.STDERR:
+                    _write_output(self._errors, data)
+                else:
+                    output.append(data)
+            return "".join(output)
+
+    def __init__(self, stream, wait, stdin=False, output=None, errors=None):
+        self._stream = stream
+        self._wait = wait
+        self.pump = None
+        self.stdin = self._Stdin(stream) if stdin else None
+        self.stdout = self.stderr = None
+        self.returncode = None
+        if output is Container.PIPE:
+            self.stdout = stream if errors is None else self._Stdout(
+                stream, errors
+            )
+        else:
+            self.pump = gevent.spawn(self._copy_output, output, errors)
+
+    def _copy_output(self, output, errors):
+        if output is None:
+            output = 1 # like Popen, inherit our stdout
+        # Each frame is written as soon as it's received, so only one frame at
+        # a time is kept in memory:
+        for stream_type, data in self._stream.frames():
+            if stream_type == dockerapi.STDERR and errors is not None:
+                _write_output(errors, data)
+            else:
+                _write_output(output, data)
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            self.returncode = self._wait()
+            if self.pump:
+                self.pump.join()
+            self._stream.close()
+        return self.returncode
+
+    def communicate(self):
+        output = self.stdout.read() if self.stdout else None
+        self.wait()
+        return output, None
+
+class _APIBackend(object):
+    """Drive Docker through its remote API, see :mod:`.dockerapi`."""
+
+    name = "api"
+
+    def __init__(self, socket_path):
+        self._client = dockerapi.Client(dockerapi.ConnectionPool(socket_path))
+        # Ids of the containers started without a tty, their logs are
+        # multiplexed:
+        self._multiplexed = set()
+        self.events = _EventsWatcher(self.subscribe)
+
+    @staticmethod
+    def _short_id(image_id):
+        """Truncate an image id like the docker command does."""
+
+        return image_id.split(":")[-1][:12]
+
+    @staticmethod
+    def _split_repo_tag(repo_tag):
+        tag_separator = repo_tag.rfind(":")
+        # a ":" before the last "/" is the port of a registry:
+        if tag_separator <= repo_tag.rfind("/"):
+            return repo_tag, None
+        return repo_tag[:tag_separator], repo_tag[tag_separator + 1:]
+
+    def _create(self, revision, cmd, as_user=None, env={}, ports=[],
+            tty=False, stdin=False, limits=None):
+        config = {
+            "Image": revision,
+            "Cmd": cmd,
+            "Env": ["{0}={1}".format(k, v) for k, v in env.iteritems()],
+            "Tty": tty,
+            "AttachStdin": stdin,
+            "OpenStdin": stdin,
+            "StdinOnce": stdin
+        }
+        if as_user:
+            config["User"] = str(as_user)
+        if ports:
+            ports = ["{0}/tcp".format(port) for port in ports]
+            config["ExposedPorts"] = {port: {} for port in ports}
+            config["HostConfig"] = {
+                "PortBindings": {port: [{"HostPort": ""}] for port in ports}
+            }
+        if limits is not None:
+            # Set in the config for Docker < 1.18 and in HostConfig after:
+            for key, host_key, value in [
+                ("CpuShares", "CpuShares", limits.cpu_shares),
+                ("Cpuset", "CpusetCpus", limits.cpuset),
+                ("Memory", "Memory", limits.memory)
+            ]:
+                if value is not None:
+                    config[key] = value
+                    config.setdefault("HostConfig", {})[host_key] = value
+        container_id = self._client.create_container(config)['Id']
+        if not tty:
+            self._multiplexed.add(container_id)
+        return container_id
+
+    def _start(self, container_id, stream=None):
+        try:
+            self._client.start(container_id)
+        except:
+            if stream:
+                stream.close()
+            self.remove_container(container_id)
+            raise
+
+    def run(self, revision, cmd, as_user=None, env={}, stdin=None, output=None,
+            errors=None, limits=None):
+        # stdout and stderr can only be told apart without a tty:
+        container_id = self._create(
+            revision, cmd, as_user, env, tty=stdin is None and errors is None,
+            stdin=stdin is not None, limits=limits
+        )
+        # Attach before the start, otherwise we could miss some output:
+        stream = self._client.attach(
+            container_id, stdin=stdin is not None,
+            multiplexed=container_id in self._multiplexed
+        )
+        self._start(container_id, stream)
+        process = _APIProcess(
+            stream, lambda: self.events.wait(container_id),
+            stdin=stdin is not None, output=output, errors=errors
+        )
+        return container_id, process, process.pump
+
+    def run_detached(self, revision, cmd, as_user=None, env={}, ports=[],
+            limits=None):
+        container_id = self._create(
+            revision, cmd, as_user, env, ports, limits=limits
+        )
+        self._start(container_id)
+        return container_id
+
+    def attach(self, container_id, output=None, errors=None):
+        # Unlike docker attach we can get the output since the container
+        # started with logs=True:
+        stream = self._client.attach(
+            container_id, logs=True,
+            multiplexed=container_id in self._multiplexed
+        )
+        return _APIProcess(
+            stream, lambda: self.events.wait(container_id),
+            output=output, errors=errors
+        )
+
+    def execute(self, container_id, cmd, as_user=None, stdin=None, output=None):
+        config = {
+            "Cmd": cmd,
+            "AttachStdin": stdin is not None,
+            "AttachStdout": True,
+            "AttachStderr": True,
+            "Tty": False
+        }
+        if as_user:
+            config["User"] = str(as_user)
+        exec_id = self._client.exec_create(container_id, config)
+        stream = self._client.exec_start(exec_id)
+        def wait():
+            # The output stream can be closed a bit before the command is
+            # marked as stopped:
+            infos = self._client.exec_inspect(exec_id)
+            while infos['Running']:
+                gevent.sleep(0.05)
+                infos = self._client.exec_inspect(exec_id)
+            return infos['ExitCode']
+        process = _APIProcess(
+            stream, wait, stdin=stdin is not None, output=output
+        )
+        return process, process.pump
+
+    def subscribe(self, since):
+        stream = self._client.events(since)
+        try:
+            for event in stream:
+                status = event.get('status', event.get('Action'))
+                if status and "id" in event:
+                    yield status, event['id'], event.get('time')
+        finally:
+            stream.close()
+
+    def kill(self, container_id):
+        self._client.kill(container_id)
+
+    def inspect(self, container_id):
+        return self._client.inspect_container(container_id)
+
+    def inspect_many(self, container_ids):
+        # The API can't inspect several containers at once, but the requests
+        # can be made in parallel over the connection pool:
+        greenlets = [
+            gevent.spawn(self._client.inspect_container, container_id)
+            for container_id in container_ids
+        ]
+        gevent.joinall(greenlets, raise_error=True)
+        return [greenlet.value for greenlet in greenlets]
+
+    def commit(self, container_id, fqrn=None, tag=None, message=None):
+        return self._short_id(
+            self._client.commit(container_id, fqrn, tag, message)
+        )
+
+    def remove_container(self, container_id):
+        self._client.remove_container(container_id)
+        self._multiplexed.discard(container_id)
+
+    def stop(self, container_id, wait=10):
+        self._client.stop(container_id, wait)
+
+    def images(self):
+        revspecs = []
+        for image in self._client.images():
+            revision = self._short_id(image['Id'])
+            if "Repository" in image: # API < 1.7, one entry per tag
+                repo_tags = ["{0}:{1}".format(image['Repository'], image['Tag'])]
+            else:
+                repo_tags = image.get('RepoTags') or []
+            repo_tags = [rt for rt in repo_tags if rt != "<none>:<none>"]
+            if not repo_tags:
+                revspecs.append(ImageRevSpec(None, None, revision, None))
+            for repo_tag in repo_tags:
+                repo, tag = self._split_repo_tag(repo_tag)
+                username, repository = ImageRevSpec._parse_user_and_repo(repo)
+                revspecs.append(ImageRevSpec(username, repository, revision, tag))
+        return revspecs
+
+    def inspect_image(self, revision):
+        return self._client.inspect_image(revision)
+
+    def save(self, revision, dest):
+        self._client.save_image(revision, dest)
+
+    def load(self, source):
+        self._client.load_image(source)
+
+    def remove_image(self, revision):
+        self._client.remove_image(revision)
+
+    def tag(self, revision, fqrn, tag):
+        self._client.tag(revision, fqrn, tag)
+
+class _OutputTail(object):
+    """Keep the last *size* bytes written to it."""
+
+    def __init__(self, size):
+        self._size = size
+        self._chunks = collections.deque()
+        self._length = 0
+        #: How many bytes have been written in total.
+        self.total = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._length += len(data)
+        self.total += len(data)
+        while self._length - len(self._chunks[0]) >= self._size:
+            self._length -= len(self._chunks.popleft())
+
+    def getvalue(self):
+        return "".join(self._chunks)[-self._size:]
+
+class LineBuffer(object):
+    """Callable that splits the output of a container in lines.
+
+    This can be used as the output argument of :meth:`Container.run`.
+
+    :param callback: called with each line (without the line terminator).
+    :param max_length: lines longer than that are split, so a process that
+                       never outputs a newline can't make the buffer grow
+                       without bounds.
+    """
+
+    def __init__(self, callback, max_length=4096):
+        self._callback = callback
+        self._max_length = max_length
+        self._buf = ""
+
+    def __call__(self, data):
+        lines = (self._buf + data).split("\n")
+        self._buf = lines.pop()
+        for line in lines:
+            self._callback(line.rstrip("\r"))
+        while len(self._buf) >= self._max_length:
+            self._callback(self._buf[:self._max_length])
+            self._buf = self._buf[self._max_length:]
+
+    def flush(self):
+        """Call the callback with what's left in the buffer, if anything."""
+
+        if self._buf:
+            self._callback(self._buf.rstrip("\r"))
+            self._buf = ""
+
+class _Scheduler(object):
+    """Limit how many Docker operations run at the same time.
+
+    Each operation (the name of a backend method, e.g: "commit") is capped
+    separately, and the total number of operations in flight is capped too.
+    When a slot frees up, it is handed to the waiting operation with the
+    highest priority (the lowest number), then to the oldest one.
+
+    :param jobs: how many heavy operations (see :attr:`HEAVY_OPERATIONS`) of
+                 each type can run at the same time, the other operations are
+                 allowed four times that. Defaults to the number of CPUs.
+    :param limits: dictionnary to override the cap of specific operations.
+    """
+
+    #: Operations that make the daemon work hard (copy or write filesystems).
+    HEAVY_OPERATIONS = frozenset([
+        "run", "run_detached", "execute", "commit", "save", "load",
+        "remove_image"
+    ])
+
+    #: Operations that free resources go first, then the cheap ones.
+    PRIORITIES = {
+        "stop": 0, "kill": 0, "remove_container": 0,
+        "inspect": 1, "inspect_many": 1, "inspect_image": 1, "images": 1,
+        "tag": 1
+    }
+    DEFAULT_PRIORITY = 2
+
+    def __init__(self, jobs=None, limits=None):
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._running = collections.defaultdict(int)
+        self._total_running = 0
+        self._stats = collections.defaultdict(
+            lambda: {"calls": 0, "queued": 0, "wait": 0., "max_wait": 0.}
+        )
+        self.configure(jobs, limits)
+
+    def configure(self, jobs=None, limits=None):
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self._limits = dict(limits or {})
+        self._total_limit = 4 * self.jobs
+        self._dispatch()
+
+    def limit(self, operation):
+        if operation in self._limits:
+            return self._limits[operation]
+        if operation in self.HEAVY_OPERATIONS:
+            return self.jobs
+        return 4 * self.jobs
+
+    def _can_run(self, operation):
+        return self._total_running < self._total_limit and \
+            self._running[operation] < self.limit(operation)
+
+    def _start(self, operation):
+        self._running[operation] += 1
+        self._total_running += 1
+
+    def _dispatch(self):
+        # Wake up, in order, every waiting operation that fits in the limits:
+        waiting = []
+        while self._waiters:
+            waiter = heapq.heappop(self._waiters)
+            priority, sequence, operation, ready = waiter
+            if self._can_run(operation):
+                self._start(operation)
+                ready.set()
+            else:
+                waiting.append(waiter)
+        for waiter in waiting:
+            heapq.heappush(self._waiters, waiter)
+
+    @contextlib.contextmanager
+    def slot(self, operation, priority=None):
+        """Context manager that waits for a slot to run the given operation."""
+
+        if priority is None:
+            priority = self.PRIORITIES.get(operation, self.DEFAULT_PRIORITY)
+        stats = self._stats[operation]
+        stats["calls"] += 1
+        if not self._waiters and self._can_run(operation):
+            self._start(operation)
+        else:
+            ready = gevent.event.Event()
+            waiter = (priority, next(self._sequence), operation, ready)
+            heapq.heappush(self._waiters, waiter)
+            # The operations already waiting might be capped for other
+            # reasons than this one:
+            self._dispatch()
+            if not ready.is_set():
+                queued_at = time.time()
+                try:
+                    ready.wait()
+                except:
+                    if ready.is_set():
+                        self._release(operation)
+                    else:
+                        self._waiters.remove(waiter)
+                        heapq.heapify(self._waiters)
+                    raise
+                wait = time.time() - queued_at
+                stats["queued"] += 1
+                stats["wait"] += wait
+                stats["max_wait"] = max(stats["max_wait"], wait)
+        try:
+            yield
+        finally:
+            self._release(operation)
+
+    def _release(self, operation):
+        self._running[operation] -= 1
+        self._total_running -= 1
+        self._dispatch()
+
+    def stats(self):
+        """Return, for each operation, how many times it was called, how many
+        times it had to wait for a slot and how long it waited (total and
+        max, in seconds).
+        """
+
+        return {op: dict(stats) for op, stats in self._stats.iteritems()}
+
+_scheduler = _Scheduler()
+
+class _OperationMetrics(object):
+    """Duration histogram, outcome and bytes transferred of one operation."""
+
+    #: Upper bounds, in seconds, of the buckets of the duration histogram.
+    BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, float("inf"))
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.duration = 0.
+        self.max_duration = 0.
+        self.bytes = 0
+        self.histogram = [0] * len(self.BUCKETS)
+        #: exit status → count, for the commands executed in containers.
+        self.exit_statuses = collections.defaultdict(int)
+
+    def record(self, duration, error=False):
+        self.calls += 1
+        self.errors += 1 if error else 0
+        self.duration += duration
+        self.max_duration = max(self.max_duration, duration)
+        self.histogram[bisect.bisect_left(self.BUCKETS, duration)] += 1
+
+    def add_bytes(self, count):
+        self.bytes += count
+
+    def add_exit_status(self, exit_status):
+        self.exit_statuses[exit_status] += 1
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.errors += other.errors
+        self.duration += other.duration
+        self.max_duration = max(self.max_duration, other.max_duration)
+        self.bytes += other.bytes
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+        for exit_status, count in other.exit_statuses.iteritems():
+            self.exit_statuses[exit_status] += count
+
+    def percentile(self, percent):
+        """Upper bound of the bucket the given percentile falls in."""
+
+        rank = self.calls * percent / 100.
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.histogram):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return 0.
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "duration": self.duration,
+            "max_duration": self.max_duration,
+            "bytes": self.bytes,
+            # JSON has no infinity, the last bucket is everything above:
+            "histogram": [
+                {"le": "+Inf" if bound == float("inf") else bound, "count": n}
+                for bound, n in zip(self.BUCKETS, self.histogram)
+            ],
+            "exit_statuses": {
+                str(k): v for k, v in self.exit_statuses.iteritems()
+            }
+        }
+
+class _Metrics(object):
+    """Record the metrics of each Docker operation, per service.
+
+    The service is set with the :meth:`scope` context manager in the greenlet
+    doing the calls, the calls made outside of any scope (e.g: the batched
+    inspections) are accounted to no service.
+
+    Besides the Docker operations (the methods of the backends), the time
+    spent running commands inside the containers is recorded as the
+    ``command`` operation.
+    """
+
+    def __init__(self):
+        self._local = gevent.local.local()
+        self.reset()
+
+    def reset(self):
+        # (scope, operation) → _OperationMetrics:
+        self._operations = {}
+
+    @contextlib.contextmanager
+    def scope(self, name):
+        previous = getattr(self._local, "scope", None)
+        self._local.scope = name
+        try:
+            yield
+        finally:
+            self._local.scope = previous
+
+    def operation(self, name):
+        """Return the :class:`_OperationMetrics` of the given operation in the
+        current scope.
+        """
+
+        key = (getattr(self._local, "scope", None), name)
+        metrics = self._operations.get(key)
+        if metrics is None:
+            metrics = self._operations[key] = _OperationMetrics()
+        return metrics
+
+    def operations(self):
+        """Return the metrics of each operation, all scopes merged."""
+
+        merged = collections.defaultdict(_OperationMetrics)
+        for (scope, name), metrics in self._operations.iteritems():
+            merged[name].merge(metrics)
+        return dict(merged)
+
+    def scopes(self):
+        """Return {scope: {operation: metrics}}."""
+
+        scopes = collections.defaultdict(dict)
+        for (scope, name), metrics in self._operations.iteritems():
+            scopes[scope][name] = metrics
+        return dict(scopes)
+
+_metrics = _Metrics()
+
+class _CountingWriter(object):
+    """Wrap a file-like object to count the bytes written to it.
+
+    .. note:: On purpose, there is no fileno method: whoever writes to it
+              (e.g: :class:`~udotcloud.sandbox.tarfile.Tarball`) has to go
+              through write, or the bytes wouldn't be counted.
+    """
+
+    def __init__(self, fp, metrics):
+        self._fp = fp
+        self._metrics = metrics
+
+    def write(self, data):
+        self._fp.write(data)
+        self._metrics.add_bytes(len(data))
+
+    def flush(self):
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+class _ScheduledBackend(object):
+    """Make every call to a backend go through the scheduler, and record how
+    long each call takes and if it fails.
+    """
+
+    def __init__(self, backend, scheduler, metrics):
+        self._backend = backend
+        self._scheduler = scheduler
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._backend, name)
+        if not callable(attr):
+            return attr
+        def scheduled(*args, **kwargs):
+            metrics = self._metrics.operation(name)
+            with self._scheduler.slot(name):
+                started_at = time.time()
+                try:
+                    result = attr(*args, **kwargs)
+                except:
+                    metrics.record(time.time() - started_at, error=True)
+                    raise
+                metrics.record(time.time() - started_at)
+                return result
+        scheduled.__name__ = name
+        return scheduled
+
+def configure_scheduler(jobs=None, limits=None):
+    """Set how many Docker operations can run at the same time.
+
+    :param jobs: cap for each type of heavy operation (run, commit…), cheap
+                 operations (inspect…) are allowed four times that. Defaults
+                 to the number of CPUs.
+    :param limits: dictionnary to set the cap of specific operations, with the
+                   operation names as keys (e.g: {"commit": 2}).
+    """
+
+    _scheduler.configure(jobs, limits)
+    logging.debug("Running up to {0} heavy Docker operations at once".format(
+        _scheduler.jobs
+    ))
+
+def metrics_scope(name):
+    """Context manager that accounts the Docker operations made in the block
+    (by the current greenlet) to name (e.g: the name of a service) in
+    :func:`docker_metrics`.
+    """
+
+    return _metrics.scope(name)
+
+def docker_metrics():
+    """Return the metrics of the Docker operations made so far.
+
+    :return: a dictionnary that can be serialized to JSON, with:
+
+             - "operations": the metrics of each operation (the names of the
+               methods of the backends, and "command" for the commands run in
+               the containers);
+             - "scopes": the same, for each scope (see :func:`metrics_scope`),
+               the operations made outside of any scope are under "".
+
+             The metrics of an operation are: the number of calls ("calls"),
+             of errors ("errors"), their total and maximum duration in seconds
+             ("duration", "max_duration"), the bytes transferred ("bytes"),
+             the duration histogram ("histogram", a list of buckets with their
+             upper bound "le" and their "count") and the exit statuses
+             ("exit_statuses", with the count of each status).
+    """
+
+    return {
+        "operations": {
+            name: metrics.as_dict()
+            for name, metrics in _metrics.operations().iteritems()
+        },
+        "scopes": {
+            scope or "": {
+                name: metrics.as_dict() for name, metrics in operations.iteritems()
+            }
+            for scope, operations in _metrics.scopes().iteritems()
+        }
+    }
+
+def format_docker_metrics():
+    """Return a human readable summary of :func:`docker_metrics`, as a list
+    of lines.
+    """
+
+    def describe(name, metrics):
+        p95 = metrics.percentile(95)
+        if p95 == float("inf"):
+            p95 = "> {0}s".format(metrics.BUCKETS[-2])
+        else:
+            p95 = "<= {0}s".format(p95)
+        return "{0}: {1} calls, {2} errors, {3:.2f}s total, {4:.2f}s mean, " \
+            "p95 {5}, {6:.2f}s max, {7} transferred".format(
+                name, metrics.calls, metrics.errors, metrics.duration,
+                metrics.duration / metrics.calls if metrics.calls else 0.,
+                p95, metrics.max_duration, bytes_to_human(metrics.bytes)
+            )
+
+    lines = [
+        describe(name, metrics)
+        for name, metrics in sorted(_metrics.operations().iteritems())
+    ]
+    for scope, operations in sorted(_metrics.scopes().iteritems()):
+        if scope is None:
+            continue
+        lines.append("{0}: {1}".format(scope, ", ".join(
+            "{0} {1:.2f}s".format(name, metrics.duration)
+            for name, metrics in sorted(operations.iteritems())
+        )))
+    return lines
+
+def scheduler_stats():
+    """Return the queue-wait metrics of the Docker operations.
+
+    :return: a dictionnary with the operation names as keys, and dictionnaries
+             as values with: how many times the operation was called
+             ("calls"), how many times it had to wait for a slot ("queued")
+             and how long it waited in seconds ("wait" in total and
+             "max_wait").
+    """
+
+    return _scheduler.stats()
+
+class _InspectBatcher(object):
+    """Coalesce the inspections of containers requested by concurrent
+    greenlets.
+
+    The containers to inspect are collected during :attr:`WINDOW` seconds
+    after the first request, then they are all inspected at once.
+
+    :param inspect_many: callable that takes a list of container ids and
+                         returns the list of their informations.
+    :param inspect: callable used to inspect the containers one by one when
+                    the batch fails (to know which one failed).
+    """
+
+    #: How long to wait for more requests before inspecting, in seconds.
+    WINDOW = 0.01
+
+    def __init__(self, inspect_many, inspect):
+        self._inspect_many = inspect_many
+        self._inspect = inspect
+        # container id → AsyncResult:
+        self._pending = collections.OrderedDict()
+        self._flush_greenlet = None
+
+    def inspect(self, container_id):
+        """Return a :class:`gevent.event.AsyncResult` set with the
+        informations of the container.
+        """
+
+        result = self._pending.get(container_id)
+        if result is None:
+            result = self._pending[container_id] = gevent.event.AsyncResult()
+            if self._flush_greenlet is None:
+                self._flush_greenlet = gevent.spawn_later(
+                    self.WINDOW, self._flush
+                )
+        return result
+
+    def _flush(self):
+        pending, self._pending = self._pending, collections.OrderedDict()
+        self._flush_greenlet = None
+        container_ids = pending.keys()
+        logging.debug("Inspecting {0} containers at once".format(
+            len(container_ids)
+        ))
+        try:
+            infos = self._inspect_many(container_ids)
+        except Exception as ex:
+            if len(container_ids) == 1:
+                pending[container_ids[0]].set_exception(ex)
+                return
+            for container_id, result in pending.iteritems():
+                gevent.spawn(self._inspect, container_id).link(result)
+            return
+        for result, container_infos in zip(pending.itervalues(), infos):
+            result.set(container_infos)
+
+_inspect_batcher = _InspectBatcher(
+    lambda container_ids: _docker().inspect_many(container_ids),
+    lambda container_id: _docker().inspect(container_id)
+)
+
+def inspect_many(container_ids):
+    """Inspect several containers.
+
+    The requests made at the same time by different greenlets are batched
+    together and resolved with a single docker inspect.
+
+    :return: the list of the informations returned by Docker for each
+             container, in the same order as container_ids.
+    :raises: :class:`~udotcloud.sandbox.exceptions.DockerCommandError` if one
+             of the containers couldn't be inspected.
+    """
+
+    results = [
+        _inspect_batcher.inspect(container_id) for container_id in container_ids
+    ]
+    return [result.get() for result in results]
+
+_backend = None
+
+def _docker_socket_path():
+    docker_host = os.environ.get("DOCKER_HOST", "")
+    if docker_host.startswith("unix://"):
+        return docker_host[len("unix://"):]
+    if docker_host:
+        return None # remote daemon, only the docker command knows about it
+    return dockerapi.DEFAULT_SOCKET
+
+def use_backend(name="auto"):
+    """Select how Docker is reached.
+
+    :param name: "api" to use the remote API on the unix socket of the Docker
+                 daemon, "cli" to fork the docker command for each operation
+                 or "auto" to use the API when its socket is accessible and
+                 fallback on the docker command otherwise.
+    """
+
+    global _backend
+
+    if _backend is not None:
+        _backend.events.close()
+    socket_path = _docker_socket_path()
+    if name == "auto":
+        usable = socket_path and os.access(socket_path, os.R_OK | os.W_OK)
+        name = "api" if usable else "cli"
+    if name == "api":
+        if not socket_path:
+            raise DockerNotFoundError(
+                "Docker's remote API is only supported on a unix socket"
+            )
+        _backend = _ScheduledBackend(
+            _APIBackend(socket_path), _scheduler, _metrics
+        )
+    elif name == "cli":
+        _backend = _ScheduledBackend(_CLIBackend(), _scheduler, _metrics)
+    else:
+        raise ValueError("Unknown Docker backend {0}".format(name))
+    _image_catalog.invalidate()
+    logging.debug("Using Docker through its {0}".format(
+        "remote API on {0}".format(socket_path) if name == "api" else "command"
+    ))
+
+def _docker():
+    if _backend is None:
+        use_backend()
+    return _backend
+
+def _commit(container_id, image, commit_as=None, message=None):
+    """Commit a new image from a container.
+
+    :param image: the :class:`Image` the container was started from.
+    :param commit_as: the :class:`ImageRevSpec` to commit the image as,
+                      otherwise the revspec of image is re-used.
+    :param message: the commit message (see :attr:`Image.comment`).
+    :return: the new :class:`Image`.
+    """
+
+    username = repository = tag = fqrn = commit_tag = None
+    if commit_as:
+        username = commit_as.username
+        repository = commit_as.repository
+        tag = commit_tag = commit_as.tag
+        fqrn = commit_as.fqrn
+    elif image.fqrn:
+        username = image.username
+        repository = image.repository
+        tag = image.tag
+        fqrn = image.fqrn
+        if repository and tag == "latest":
+            commit_tag = "latest"
+    revision = _docker().commit(container_id, fqrn, commit_tag, message)
+    if repository is None:
+        _image_catalog.add(ImageRevSpec(None, None, revision, None))
+    elif commit_tag:
+        _image_catalog.add(
+            ImageRevSpec(username, repository, revision, commit_tag)
+        )
+    return Image(ImageRevSpec(username, repository, revision, tag))
+
+def _terminate(container_id, wait=10):
+    """Stop a container, then kill it if it's still running."""
+
+    docker = _docker()
+    try:
+        docker.stop(container_id, wait)
+        if not inspect_many([container_id])[0]['State']['Running']:
+            return
+    except DockerCommandError as ex:
+        logging.debug("Couldn't stop container {0}: {1}".format(
+            container_id, ex
+        ))
+    try:
+        docker.kill(container_id)
+    except DockerCommandError: # it stopped in the meantime
+        pass
+
+def _destroy(container_id):
+    """Kill a container and remove it."""
+
+    logging.debug("Destroying container {0}".format(container_id))
+    docker = _docker()
+    try:
+        docker.kill(container_id)
+    except DockerCommandError: # the container is already stopped
+        pass
+    docker.remove_container(container_id)
+    logging.debug("Container {0} destroyed".format(container_id))
+
+@contextlib.contextmanager
+def _deadline(seconds, cmd, expired):
+    """Raise :class:`~udotcloud.sandbox.exceptions.ContainerTimeoutError` if
+    the block doesn't finish in time, expired is called before that.
+    """
+
+    if seconds is None:
+        yield
+        return
+    timeout = gevent.Timeout(seconds)
+    timeout.start()
+    try:
+        yield
+    except gevent.Timeout as ex:
+        if ex is not timeout:
+            raise
+        logging.debug("{0} didn't finish in {1}s".format(cmd, seconds))
+        expired()
+        raise ContainerTimeoutError(
+            "{0} didn't finish in {1} seconds".format(cmd, seconds)
+        )
+    finally:
+        timeout.cancel()
+
+_Limits = collections.namedtuple("_Limits", ["cpu_shares", "cpuset", "memory"])
+
+class Limits(_Limits):
+    """Resources a container can use (None means no limit).
+
+    :param cpu_shares: relative weight of the container when the CPUs are
+                       contended (1024 is the weight of a container without
+                       limits).
+    :param cpuset: the CPUs the container can run on (e.g: "0-3" or "0,2").
+    :param memory: the memory limit of the container, in bytes.
+    """
+
+    #: Don't go below this when the memory of the host is split between the
+    #: containers, most builds wouldn't even complete with less.
+    MIN_MEMORY = 512 * 1024 * 1024
+
+    #: Share of the host memory given to the containers, the rest is left to
+    #: the host and to Docker (this is what keeps the host out of swap).
+    HOST_MEMORY_RATIO = 0.75
+
+    #: From this many CPUs, the first one is left to the host (the Docker
+    #: daemon, the compression of the code…) when the containers run on it.
+    MIN_CPUS_TO_RESERVE = 4
+
+    def __new__(cls, cpu_shares=None, cpuset=None, memory=None):
+        return super(Limits, cls).__new__(cls, cpu_shares, cpuset, memory)
+
+    @staticmethod
+    def _host_memory():
+        try:
+            return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        except (ValueError, OSError):
+            return None
+
+    @staticmethod
+    def _host_cpus():
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return None
+
+    @classmethod
+    def host_defaults(cls, containers):
+        """Return the limits to use when that many containers run at once.
+
+        Each container gets an equal part of the memory of the host, and
+        they all run on the CPUs of the host but the first one when it has
+        at least :attr:`MIN_CPUS_TO_RESERVE` of them (the containers already
+        get the same CPU shares by default, so none of them can starve the
+        others).
+
+        .. note:: the host is the machine running this code, which may not be
+                  the one running Docker (e.g: with a remote ``DOCKER_HOST``):
+                  the CPUs are then left alone.
+        """
+
+        memory = cls._host_memory()
+        if memory is not None:
+            memory = max(
+                cls.MIN_MEMORY,
+                int(memory * cls.HOST_MEMORY_RATIO) // max(containers, 1)
+            )
+        cpuset = None
+        cpus = cls._host_cpus()
+        if cpus is not None and cpus >= cls.MIN_CPUS_TO_RESERVE \
+                and _docker_socket_path() is not None:
+            cpuset = "1-{0}".format(cpus - 1)
+        return cls(cpuset=cpuset, memory=memory)
+
+    def merge(self, other):
+        """Return new limits where the values set in other (i.e: not None)
+        replace the ones of these limits.
+        """
+
+        return self._replace(**{
+            k: v for k, v in other._asdict().iteritems() if v is not None
+        })
+
+class _WarmPool(object):
+    """Keep idle containers started in advance for the build sessions.
+
+    The containers are started from the base images with
+    :attr:`BuildSession.KEEPALIVE_CMD`, so a session can pick one up instead
+    of waiting for Docker to create and start its container. When a
+    container is taken, another one is started in the background.
+
+    There is one set of containers per image revision and :class:`Limits`,
+    since they can't be changed once the container is created.
+
+    :param start: callable that takes an image revision and limits, starts a
+                  container and returns its id.
+    :param destroy: callable that takes a container id and destroys it.
+    :param size: how many idle containers to keep for each image revision
+                 and limits (0 disables the pool).
+    """
+
+    def __init__(self, start, destroy, size=0):
+        self._start = start
+        self._destroy = destroy
+        self.size = size
+        # (revision, limits) → deque of container ids:
+        self._idle = collections.defaultdict(collections.deque)
+        # (revision, limits) → how many containers are being started:
+        self._pending = collections.defaultdict(int)
+        self._greenlets = set()
+
+    def _start_one(self, key):
+        revision, limits = key
+        try:
+            container_id = self._start(revision, limits)
+        except Exception as ex:
+            logging.debug("Couldn't start a container from {0} for the warm "
+                "pool: {1}".format(revision, ex))
+            return
+        finally:
+            self._pending[key] -= 1
+        if self.size:
+            self._idle[key].append(container_id)
+        else: # the pool was drained in the meantime
+            self._destroy(container_id)
+
+    def fill(self, revision, limits=None, count=None):
+        """Start containers in the background until there are count (by
+        default the size of the pool) idle containers for this revision and
+        limits.
+        """
+
+        if not self.size:
+            return
+        key = (revision, limits)
+        count = self.size if count is None else count
+        missing = count - len(self._idle[key]) - self._pending[key]
+        for i in xrange(missing):
+            self._pending[key] += 1
+            greenlet = gevent.spawn(self._start_one, key)
+            self._greenlets.add(greenlet)
+            greenlet.link(self._greenlets.discard)
+
+    def acquire(self, revision, limits=None):
+        """Take an idle container out of the pool.
+
+        :return: the container id, or None when no container is ready (the
+                 caller has to start its own container).
+        """
+
+        if not self.size:
+            return None
+        key = (revision, limits)
+        idle = self._idle[key]
+        container_id = idle.popleft() if idle else None
+        self.fill(revision, limits)
+        return container_id
+
+    def drain(self):
+        """Destroy all the idle containers and disable the pool."""
+
+        self.size = 0
+        gevent.joinall(list(self._greenlets))
+        for key, idle in self._idle.items():
+            while idle:
+                container_id = idle.popleft()
+                try:
+                    self._destroy(container_id)
+                except DockerCommandError as ex:
+                    logging.debug("Couldn't destroy idle container {0}: "
+                        "{1}".format(container_id, ex))
+        self._idle.clear()
+
+_warm_pool = _WarmPool(
+    lambda revision, limits: _docker().run_detached(
+        revision, BuildSession.KEEPALIVE_CMD, limits=limits
+    ),
+    _destroy
+)
+
+def configure_image_catalog(reload_interval=0):
+    """Set how often the list of images can be reloaded from Docker.
+
+    The list of images is kept in memory and reloaded when an image can't be
+    found in it. That happens a lot when many applications are built at once
+    (e.g: to check whether the result of a build is already there), set
+    reload_interval to reload it at most once every that many seconds.
+    """
+
+    _image_catalog.reload_interval = reload_interval or 0
+    logging.debug("Reloading the list of images at most every {0}s".format(
+        _image_catalog.reload_interval
+    ))
+
+def configure_warm_pool(size=0):
+    """Set how many idle containers to keep started in advance for each base
+    image (and :class:`Limits`) of the build sessions.
+
+    Each :class:`BuildSession` takes one of these containers when it can, and
+    a new one is started in the background. Call :func:`drain_warm_pool`
+    to destroy them once you are done.
+
+    :param size: how many idle containers to keep (0 disables the pool).
+    """
+
+    _warm_pool.size = size or 0
+    logging.debug("Keeping {0} idle containers per base image".format(
+        _warm_pool.size
+    ))
+
+def drain_warm_pool():
+    """Destroy the idle containers of the warm pool and disable it."""
+
+    _warm_pool.drain()
+
+class _SystemPackagesMixin(object):
+
+    def install_system_packages(self, packages, output=None, timeout=None):
+        # Exit with the status of apt-get install, so the caller knows if the
+        # packages are there:
+        cmd = "DEBIAN_FRONTEND=noninteractive; " \
+            "apt-get update; apt-get -y install {0}; status=$?; " \
+            "apt-get clean; rm -rf /var/lib/apt/lists/*; exit $status".format(
+                " ".join(packages)
+            )
+        with self.run(["/bin/sh", "-c", cmd], output=output, timeout=timeout):
+            pass
+
+class Container(_SystemPackagesMixin):
     """Containers are transitions between two images.
     
     :param revpsec: the :class:`ImageRevSpec` of the image to use.
@@ -53,62 +1683,57 @@ class Container(object):
     PIPE = gevent.subprocess.PIPE
     STDOUT = gevent.subprocess.STDOUT
 
+    #: Only keep the end of the output of :meth:`run` in :attr:`logs`.
+    LOGS_TAIL_SIZE = 64 * 1024
+
+    #: When a deadline expires, how long the command has to exit after
+    #: SIGTERM before it is killed.
+    STOP_GRACE_PERIOD = 10
+
     def __init__(self, image, commit_as=None):
         #: The image that will be used to start the container.
         self.image = image
         #: The revspec of the image commited when run finishes.
         self.result = None
-        #: The logs from the container when run finishes.
+        #: The end (see :attr:`LOGS_TAIL_SIZE`) of the logs from the container
+        #: when run finishes.
         self.logs = None
         self.commit_as = commit_as
         self._id = None
         #: The return code of the process that was executed in the container.
         self.exit_status = None
 
-    @staticmethod
-    def _generate_option_list(option, args):
-        """_generate_option_list("-p", [1, 2…]) → ["-p", 1, "-p", 2…]"""
-        return list(
-            itertools.chain.from_iterable(itertools.product([option], args))
-        )
-
-    @classmethod
-    def _generate_env_option_list(cls, env):
-        return cls._generate_option_list(
-            "-e", ["{0}={1}".format(k, v) for k, v in env.iteritems()]
-        )
-
     def _get_container_infos(self, async=False):
         def _inspect_container():
             logging.debug("Inspecting container {0}".format(self._id))
-            with _CatchDockerError():
-                infos = json.loads(gevent.subprocess.check_output([
-                    "docker", "inspect", self._id
-                ]).strip())
-                # In docker 0.4.1 docker inspect will return a list:
-                if isinstance(infos, list):
-                    return infos[0]
-                return infos
+            return inspect_many([self._id])[0]
         if async:
             async_result = gevent.event.AsyncResult()
             gevent.spawn(_inspect_container).link(async_result)
             return async_result
         return _inspect_container()
 
-    def install_system_packages(self, packages):
-        cmd = "DEBIAN_FRONTEND=noninteractive; " \
-            "apt-get update; apt-get -y install {0}; " \
-            "apt-get clean; rm -rf /var/lib/apt/lists/*".format(
-                " ".join(packages)
-            )
-        with self.run(["/bin/sh", "-c", cmd]):
-            pass
+    @staticmethod
+    def _get_port_mapping(container_infos):
+        network_settings = container_infos['NetworkSettings']
+        # Docker < 0.6.5 (and only TCP was supported):
+        if network_settings.get('PortMapping') is not None:
+            return {
+                int(k): int(v)
+                for k, v in network_settings['PortMapping'].iteritems()
+            }
+        ports = {}
+        for port, bindings in (network_settings.get('Ports') or {}).iteritems():
+            if bindings:
+                ports[int(port.split("/")[0])] = int(bindings[0]['HostPort'])
+        return ports
 
     # XXX: Maybe this should be named to something else to better reflect the
     # fact that it's really an authoring tool, and reduce the confusion with
     # run_stream_logs.
     @contextlib.contextmanager
-    def run(self, cmd, as_user=None, env={}, stdin=None, stdout=None, stderr=None):
+    def run(self, cmd, as_user=None, env={}, stdin=None, stdout=None,
+            stderr=None, output=None, timeout=None, limits=None):
         """Run the specified command in a new container.
 
         This is a context manager that returns a :class:`subprocess.Popen`
@@ -119,138 +1744,122 @@ class Container(object):
 
         :param cmd: the program to run as a list of arguments.
         :param as_user: run the command under this username or uid.
-        :param stdout, stderr: as in :class:`subprocess.Popen` except that you
-                               should use Container.PIPE and Container.STDOUT
-                               instead of subprocess.PIPE and subprocess.STDOUT.
+        :param stdout, stderr: callables called with what the command writes
+                               on stdout and stderr respectively, chunk by
+                               chunk, while it runs. When any of them is set
+                               the command doesn't get a tty, this is what
+                               allows Docker to tell both streams apart.
         :param stdin: either None (close stdin) or Container.PIPE.
+        :param output: callable called with the output of the command (stdout
+                       and stderr mixed), chunk by chunk, while it runs (see
+                       :class:`LineBuffer`).
+        :param timeout: if the command (and the block of the context manager)
+                        doesn't finish in this many seconds, it is stopped
+                        (then killed after :attr:`STOP_GRACE_PERIOD` seconds)
+                        and the container is destroyed.
+        :param limits: the :class:`Limits` of the container (by default it
+                       can use all the resources of the host).
         :return: Nothing (this is a context manager) but sets :attr:`result`
                  with the class:`ImageRevSpec` of the resulting image.
+        :raises: :class:`~udotcloud.sandbox.exceptions.ContainerTimeoutError`
+                 when the deadline expires.
 
-        .. warning::
+        .. note::
 
-           stdout and stderr currently don't work due to limitations on Docker:
-           you can't get the id of container, in a race-condition free way,
-           with stdout and stderr enabled on docker run. A workaround would be
-           to start a shell in detached mode and then execute the command from
-           docker attach, but docker attach doesn't exit correctly when the
-           process exits (it hangs on stdin until you try to write something
-           which trigger an EBADF in docker).
+           The output is never accumulated in memory: it is given to the
+           callables as it is received (only the end of it is kept in
+           :attr:`logs`).
         """
 
         logging.debug("Starting {0} in a {1} container as user {2}".format(
             cmd, self.image, as_user or "root"
         ))
 
-        as_user = ["-u", as_user] if as_user else []
-        env = self._generate_env_option_list(env)
-
+        logs = _OutputTail(self.LOGS_TAIL_SIZE)
+        def sink(stream):
+            def on_output(data):
+                logs.write(data)
+                if output:
+                    output(data)
+                if stream:
+                    stream(data)
+            return on_output
+
+        separate = stdout is not None or stderr is not None
+        docker = _docker()
+        output_pump = None
+        transfer = _metrics.operation("run")
+        command = _metrics.operation("command")
         try:
-            # If stdin is None, start the container in detached mode, this will
-            # print the id on stdout, then we simply wait for the container to
-            # stop. If stdin is not None, start the container in attached mode
-            # without stdout and stderr. This will print the container id on
-            # stdout so we can read it.
-            if stdin is None:
-                with _CatchDockerError():
-                    self._id = gevent.subprocess.check_output(
-                        ["docker", "run", "-t", "-d"] + as_user
-                        + env + [self.image.revision] + cmd
-                    ).strip()
-                # docker wait prints the number of second we waited, ignore it:
-                with open("/dev/null", "w") as ignore:
-                    docker = gevent.subprocess.Popen(
-                        ["docker", "wait", self._id], stdout=ignore
-                    )
-            else:
-                docker = gevent.subprocess.Popen(
-                    ["docker", "run", "-i", "-a", "stdin"]
-                    + as_user + env + [self.image.revision] + cmd,
-                    stdin=stdin, stdout=self.PIPE
-                )
-                # readline instead of read is important here, the object behind
-                # docker.stdout is actually a socket._fileobject (yes, the real
-                # socket module from Python) and its read method returns when
-                # its buffer (8192 bytes by default on Python 2.7) is full or
-                # when EOF is reached, not when the underlying read system call
-                # returns.
-                self._id = docker.stdout.readline().strip()
+            self._id, process, output_pump = docker.run(
+                self.image.revision, cmd, as_user, env, stdin, sink(stdout),
+                sink(stderr) if separate else None, limits
+            )
+            started_at = time.time()
             logging.debug("Started container {0} from {1}".format(
                 self._id, self.image
             ))
+            if stdin is not None:
+                process.stdin = _CountingWriter(process.stdin, transfer)
 
-            yield docker
+            with _deadline(timeout, cmd, self._expired):
+                try:
+                    yield process
 
-            # Wait for the process to terminate (if the calling code didn't
-            # already do it):
-            logging.debug("Waiting for container {0} to terminate".format(
-                self._id
-            ))
-            docker.wait()
+                    # Wait for the process to terminate (if the calling code
+                    # didn't already do it):
+                    logging.debug(
+                        "Waiting for container {0} to terminate".format(self._id)
+                    )
+                    process.wait()
+                    output_pump.join()
+                except BaseException:
+                    command.record(time.time() - started_at, error=True)
+                    raise
+            command.record(time.time() - started_at)
+            transfer.add_bytes(logs.total)
             logging.debug("Container {0} stopped".format(self._id))
 
-            # Since we can't get stdout/stderr in realtime for now (see the
-            # docstring), let's get the logs instead.
-            logs = gevent.subprocess.Popen(
-                ["docker", "logs", self._id],
-                stdout=self.PIPE,
-                stderr=self.STDOUT
-            )
-            logs = gevent.spawn(logs.communicate)
-
             container_infos = self._get_container_infos(async=True)
 
-            # Commit a new image from the container
-            username = repository = tag = None
-            commit = ["docker", "commit", self._id]
-            if self.commit_as:
-                username = self.commit_as.username
-                repository = self.commit_as.repository
-                tag = self.commit_as.tag
-                if self.commit_as.fqrn:
-                    commit.append(self.commit_as.fqrn)
-                if tag:
-                    commit.append(tag)
-            elif self.image.fqrn:
-                username = self.image.username
-                repository = self.image.repository
-                tag = self.image.tag
-                commit.append(self.image.fqrn)
-                if repository and tag == "latest":
-                    commit.append("latest")
-            with _CatchDockerError():
-                revision = gevent.subprocess.check_output(
-                    commit, stderr=self.STDOUT
-                ).strip()
-            self.result = Image(ImageRevSpec(username, repository, revision, tag))
+            self.result = _commit(self._id, self.image, self.commit_as)
             logging.debug("Container {0} started from {1} commited as image {2}".format(
                 self._id, self.image, self.result
             ))
 
-            logging.debug("Fetching logs from container {0}".format(self._id))
-            logs.join()
-            with _CatchDockerError():
-                # if we raise here, self.logs will stay at None which is wanted
-                self.logs = logs.get()[0]
-            logging.debug("{0} of logs fetched from container {1}".format(
-                bytes_to_human(len(self.logs)), self._id
+            self.logs = logs.getvalue()
+            logging.debug("{0} of logs streamed from container {1}".format(
+                bytes_to_human(logs.total), self._id
             ))
 
             container_infos = container_infos.get()
             self.exit_status = container_infos['State']['ExitCode']
+            command.add_exit_status(self.exit_status)
             logging.debug("Container {0} returned {1}".format(
                 self._id, self.exit_status
             ))
+        except BaseException:
+            # Interrupted (e.g: the build has been cancelled), make sure the
+            # container isn't running anymore so it can be destroyed:
+            if self._id:
+                try:
+                    docker.kill(self._id)
+                except DockerCommandError: # it already stopped
+                    pass
+            raise
         finally:
+            if output_pump:
+                output_pump.kill()
             if self._id:
                 # Destroy the container
                 logging.debug("Destroying container {0}".format(self._id))
-                with _CatchDockerError():
-                    gevent.subprocess.check_call(["docker", "rm", self._id])
+                docker.remove_container(self._id)
                 logging.debug("Container {0} destroyed".format(self._id))
                 self._id = None
 
     @contextlib.contextmanager
-    def run_stream_logs(self, cmd, as_user=None, ports=[], env={}, output=None):
+    def run_stream_logs(self, cmd, as_user=None, ports=[], env={}, output=None,
+            errors=None):
         """Run the specified command and wait for it, logs are streamed.
 
         This is a context manager that yields a :class:`subprocess.Popen`
@@ -260,59 +1869,57 @@ class Container(object):
         ports you defined as keys and the ports they got mapped to, on the host
         public address, as values.
 
-        .. note:: stdout and stderr will be mixed in the logs output, this is
-                  currently a limitation of Docker.
-
         :param cmd: the program to run as a list of arguments.
         :param as_user: run the command under this username or uid.
         :param ports: list of ports in the container to expose on the host.
         :param env: define additional environment variables.
-        :param output: stream the logs to this file object or fd (by default
-                       they are streamed to stdout), it can also be
-                       Container.PIPE.
+        :param output: stream the logs to this file object, fd or callable
+                       (by default they are streamed to stdout), it can also
+                       be Container.PIPE.
+        :param errors: if set, stream what the command writes on stderr to
+                       this file object, fd or callable instead of mixing it
+                       with the rest of the output.
 
         .. warning:: due to limitations in Docker (see :meth:`run`), the
-                     first lines of output might be lost.
+                     first lines of output might be lost when Docker is used
+                     through the docker command.
         """
 
         logging.debug("Starting {0} in a {1} container as user {2}".format(
             cmd, self.image, as_user or "root"
         ))
 
-        as_user = ["-u", as_user] if as_user else []
-        ports = self._generate_option_list("-p", [str(p) for p in ports])
-        env = self._generate_env_option_list(env)
+        docker = _docker()
+        command = _metrics.operation("command")
         try:
-            with _CatchDockerError():
-                self._id = gevent.subprocess.check_output(
-                    ["docker", "run", "-d"] + as_user + env
-                    + ports + [self.image.revision] + cmd
-                ).strip()
-                docker = gevent.subprocess.Popen(
-                    ["docker", "attach", self._id],
-                    stdout=output, stderr=self.STDOUT
-                )
-                container_infos = self._get_container_infos()
-                port_mapping = container_infos['NetworkSettings']['PortMapping']
-                docker.ports = {
-                    int(k): int(v) for k, v in port_mapping.iteritems()
-                }
+            self._id = docker.run_detached(
+                self.image.revision, cmd, as_user, env, ports
+            )
+            started_at = time.time()
+            process = docker.attach(self._id, output, errors)
+            container_infos = self._get_container_infos()
+            process.ports = self._get_port_mapping(container_infos)
 
-            yield docker
+            yield process
 
             logging.debug("Waiting for container {0} to terminate".format(
                 self._id
             ))
-            docker.wait()
+            process.wait()
+            command.record(time.time() - started_at)
             logging.debug("Container {0} stopped".format(self._id))
             container_infos = self._get_container_infos()
             self.exit_status = container_infos['State']['ExitCode']
+            command.add_exit_status(self.exit_status)
             logging.debug("Container {0} returned {1}".format(
                 self._id, self.exit_status
             ))
         finally:
             self._id = None
 
+    def _expired(self):
+        _terminate(self._id, self.STOP_GRACE_PERIOD)
+
     def stop(self, wait=10):
         """If the container is running, interrupt it.
 
@@ -321,14 +1928,167 @@ class Container(object):
         """
 
         if self._id:
-            with open("/dev/null", "w") as ignore, _CatchDockerError():
-                # NOTE: not a big deal if we try to stop a container that's
-                # already stopped or doesn't exist anymore, moreover don't set
-                # self._id to None after that, run or run_stream_logs need it.
-                gevent.subprocess.check_call(
-                    ["docker", "stop", "-t", str(wait), self._id],
-                    stdout=ignore, stderr=self.STDOUT
-                )
+            # NOTE: not a big deal if we try to stop a container that's
+            # already stopped or doesn't exist anymore, moreover don't set
+            # self._id to None after that, run or run_stream_logs need it.
+            _docker().stop(self._id, wait)
+
+
+class BuildSession(_SystemPackagesMixin):
+    """A container kept alive to run several commands in a row.
+
+    Unlike :class:`Container`, which commits a new image after each command,
+    nothing is committed until you call :meth:`commit`. This avoids the
+    creation, commit and destruction of a container for each step of a build.
+
+    A build session is a context manager, the container is started when the
+    block is entered and destroyed when it exits::
+
+        with image.session() as session:
+            with session.run(["apt-get", "update"]):
+                pass
+            result = session.commit(ImageRevSpec.parse("foo/bar:baz"))
+
+    :param image: the :class:`Image` to start the container from.
+    :param limits: the :class:`Limits` of the container, they apply to all
+                   the commands executed in the session.
+
+    .. note:: commands are executed with ``docker exec``, this requires Docker
+              ≥ 1.3.
+    """
+
+    PIPE = Container.PIPE
+    STDOUT = Container.STDOUT
+
+    # Something that waits forever without using any resource:
+    KEEPALIVE_CMD = ["/bin/sh", "-c", "while true; do sleep 3600; done"]
+
+    def __init__(self, image, limits=None):
+        #: The image the container was started from.
+        self.image = image
+        #: The :class:`Limits` of the container.
+        self.limits = limits
+        #: The end of the logs of the last command (see
+        #: :attr:`Container.LOGS_TAIL_SIZE`).
+        self.logs = None
+        #: The return code of the last command executed.
+        self.exit_status = None
+        self._id = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        return False
+
+    def start(self):
+        self._id = _warm_pool.acquire(self.image.revision, self.limits)
+        if self._id is not None:
+            logging.debug("Build session took container {0} from {1} in the "
+                "warm pool".format(self._id, self.image))
+            return
+        self._id = _docker().run_detached(
+            self.image.revision, self.KEEPALIVE_CMD, limits=self.limits
+        )
+        logging.debug("Build session started in container {0} from {1}".format(
+            self._id, self.image
+        ))
+
+    @contextlib.contextmanager
+    def run(self, cmd, as_user=None, env={}, stdin=None, output=None,
+            timeout=None):
+        """Execute a command in the container of this session.
+
+        This is a context manager which works like :meth:`Container.run`,
+        except that no image is commited when the block exits.
+
+        :param output: callable called with the output of the command (stdout
+                       and stderr mixed) as it runs.
+        :param timeout: if the command doesn't finish in this many seconds the
+                        whole session is stopped (then killed) and
+                        :class:`~udotcloud.sandbox.exceptions.ContainerTimeoutError`
+                        is raised, the session can't be used after that.
+        """
+
+        logging.debug("Executing {0} in container {1} as user {2}".format(
+            cmd, self._id, as_user or "root"
+        ))
+
+        if env:
+            cmd = ["env"] + [
+                "{0}={1}".format(k, v) for k, v in env.iteritems()
+            ] + cmd
+        logs = _OutputTail(Container.LOGS_TAIL_SIZE)
+        def on_output(data):
+            logs.write(data)
+            if output:
+                output(data)
+
+        self.logs = self.exit_status = None
+        transfer = _metrics.operation("execute")
+        command = _metrics.operation("command")
+        process, output_pump = _docker().execute(
+            self._id, cmd, as_user, stdin, on_output
+        )
+        started_at = time.time()
+        if stdin is not None:
+            process.stdin = _CountingWriter(process.stdin, transfer)
+        try:
+            with _deadline(timeout, cmd, self._expired):
+                try:
+                    yield process
+
+                    self.exit_status = process.wait()
+                    output_pump.join()
+                except BaseException:
+                    command.record(time.time() - started_at, error=True)
+                    raise
+            command.record(time.time() - started_at)
+            command.add_exit_status(self.exit_status)
+            transfer.add_bytes(logs.total)
+            self.logs = logs.getvalue()
+            logging.debug("{0} returned {1} in container {2}".format(
+                cmd, self.exit_status, self._id
+            ))
+        finally:
+            output_pump.kill()
+
+    def commit(self, commit_as=None, message=None):
+        """Commit the current state of the container as a new image.
+
+        :param commit_as: the :class:`ImageRevSpec` to use for the image (by
+                          default the revspec of the session's image is
+                          re-used).
+        :param message: the commit message, stored with the image (see
+                        :attr:`Image.comment`).
+        :return: the new :class:`Image`.
+        """
+
+        result = _commit(self._id, self.image, commit_as, message)
+        logging.debug("Container {0} started from {1} commited as image {2}".format(
+            self._id, self.image, result
+        ))
+        return result
+
+    def _expired(self):
+        _terminate(self._id, Container.STOP_GRACE_PERIOD)
+
+    def stop(self, wait=10):
+        """Interrupt the commands running in the session (see
+        :meth:`Container.stop`).
+        """
+
+        if self._id:
+            _docker().stop(self._id, wait)
+
+    def close(self):
+        """Destroy the container of this session."""
+
+        if self._id:
+            _destroy(self._id)
+            self._id = None
 
 
 _ImageRevSpec = collections.namedtuple(
@@ -490,6 +2250,163 @@ class ImageRevSpec(_ImageRevSpec):
             "Invalid image: {0} (can't find the revision)".format(revspec)
         )
 
+class _ImageCatalog(object):
+    """Process-wide index of the images known by Docker.
+
+    The list of images is loaded on the first lookup, then kept up to date by
+    the operations made through this module (commit, tag and destroy) and
+    reloaded only when a lookup misses (the image might have been pulled or
+    built from somewhere else).
+
+    :param load: callable that returns the list of :class:`ImageRevSpec` known
+                 by Docker, most recent first.
+    :param reload_interval: a miss doesn't reload the catalog if it was loaded
+                            less than that many seconds ago (the images
+                            created by this process are always found).
+    """
+
+    def __init__(self, load=lambda: _docker().images(), reload_interval=0.):
+        self._load = load
+        self._loading = None
+        self.reload_interval = reload_interval
+        self._loaded_at = 0.
+        self.invalidate()
+
+    @staticmethod
+    def _short_id(revision):
+        return revision[:12]
+
+    def invalidate(self):
+        """Forget everything, the next lookup will reload the catalog."""
+
+        self._loaded = False
+        # short id → revspecs for this image, most recent first:
+        self._by_revision = {}
+        # sorted list of short ids, to resolve prefixes:
+        self._short_ids = []
+        # (username, repository, tag) → revspec:
+        self._by_name = {}
+
+    def _index(self, revspec, prepend=False):
+        short_id = self._short_id(revspec.revision)
+        revspecs = self._by_revision.get(short_id)
+        if revspecs is None:
+            revspecs = self._by_revision[short_id] = []
+            bisect.insort(self._short_ids, short_id)
+        # NOTE: ImageRevSpec.__eq__ ignores the tag when both sides have a
+        # revision, compare the tuples instead:
+        if tuple(revspec) in [tuple(r) for r in revspecs]:
+            return
+        if revspec.repository:
+            # A repository:tag only points to one image, take it back from the
+            # image it was pointing to before:
+            name = (revspec.username, revspec.repository, revspec.tag)
+            previous = self._by_name.get(name)
+            if previous is not None:
+                self._unindex(previous)
+            self._by_name[name] = revspec
+            # This image is not anonymous anymore:
+            revspecs[:] = [r for r in revspecs if r.repository]
+        if prepend:
+            revspecs.insert(0, revspec)
+        else:
+            revspecs.append(revspec)
+
+    def _unindex(self, revspec):
+        revspecs = self._by_revision[self._short_id(revspec.revision)]
+        revspecs[:] = [r for r in revspecs if tuple(r) != tuple(revspec)]
+        self._by_name.pop((revspec.username, revspec.repository, revspec.tag), None)
+        # Like Docker, keep the image around as an anonymous image:
+        if not revspecs:
+            revspecs.append(ImageRevSpec(None, None, revspec.revision, None))
+
+    def _reload(self):
+        # Several greenlets can miss at the same time, only load once:
+        if self._loading is not None:
+            return self._loading.get()
+        self._loading = gevent.event.AsyncResult()
+        try:
+            logging.debug("Loading the list of images from Docker")
+            revspecs = self._load()
+            self.invalidate()
+            for revspec in revspecs:
+                self._index(revspec)
+            self._loaded = True
+            self._loaded_at = time.time()
+            logging.debug("{0} images loaded from Docker".format(
+                len(self._by_revision)
+            ))
+            self._loading.set()
+        except Exception as ex:
+            self._loading.set_exception(ex)
+            raise
+        finally:
+            self._loading = None
+
+    def _find(self, revspec):
+        if revspec.revision:
+            for short_id in self.resolve_prefix(revspec.revision[:12]):
+                for candidate in self._by_revision[short_id]:
+                    if candidate.username == revspec.username and \
+                        candidate.repository == revspec.repository:
+                            return candidate
+            return None
+        return self._by_name.get(
+            (revspec.username, revspec.repository, revspec.tag)
+        )
+
+    def resolve_prefix(self, prefix):
+        """Return the short ids starting with the given prefix."""
+
+        start = bisect.bisect_left(self._short_ids, prefix)
+        short_ids = []
+        for short_id in itertools.islice(self._short_ids, start, None):
+            if not short_id.startswith(prefix):
+                break
+            short_ids.append(short_id)
+        return short_ids
+
+    def lookup(self, revspec):
+        """Find an image in Docker.
+
+        :return: the :class:`ImageRevSpec` from Docker (which has the
+                 revision) matching the given revspec, or None.
+        """
+
+        if not self._loaded:
+            self._reload()
+            return self._find(revspec)
+        docker_revspec = self._find(revspec)
+        if docker_revspec is None and \
+            time.time() - self._loaded_at >= self.reload_interval:
+            logging.debug("{0} not in the images catalog, reloading".format(
+                revspec
+            ))
+            self._reload()
+            docker_revspec = self._find(revspec)
+        return docker_revspec
+
+    def add(self, revspec):
+        """Record a new image (or a new tag) created by this process."""
+
+        if self._loaded:
+            self._index(revspec, prepend=True)
+
+    def remove(self, revision):
+        """Forget the image with the given revision."""
+
+        if self._loaded:
+            short_id = self._short_id(revision)
+            for revspec in self._by_revision.pop(short_id, []):
+                self._by_name.pop(
+                    (revspec.username, revspec.repository, revspec.tag), None
+                )
+            index = bisect.bisect_left(self._short_ids, short_id)
+            if index < len(self._short_ids) and self._short_ids[index] == short_id:
+                del self._short_ids[index]
+
+_image_catalog = _ImageCatalog()
+
 class Image(object):
     """Represent an image in Docker. Can be used to start a :class:`Container`.
 
@@ -526,27 +2443,15 @@ class Image(object):
 
     def __init__(self, revspec):
         logging.debug("Looking for {0} in docker images".format(revspec))
-        with _CatchDockerError():
-            images = gevent.subprocess.check_output(
-                ["docker", "images"], stderr=gevent.subprocess.STDOUT
-            ).splitlines()[1:]
-        docker_revspecs = []
-        for line in images:
-            try:
-                docker_revspecs.append(ImageRevSpec.parse_from_docker(line))
-            except ValueError as ex:
-                logging.warning(str(ex))
         # check that the image exists in Docker, and if so save it (it will
         # have the revision, which might not be the case of the revspec
         # received in argument).
-        for docker_revspec in docker_revspecs:
-            if revspec == docker_revspec:
-                self.revspec = docker_revspec
-                return
-        raise UnkownImageError(
-            "The image {0} doesn't exist "
-            "(maybe you need to pull it in Docker?)".format(revspec)
-        )
+        self.revspec = _image_catalog.lookup(revspec)
+        if self.revspec is None:
+            raise UnkownImageError(
+                "The image {0} doesn't exist "
+                "(maybe you need to pull it in Docker?)".format(revspec)
+            )
 
     def __str__(self):
         return self.revspec.__str__()
@@ -579,6 +2484,28 @@ class Image(object):
     def instantiate(self, *args, **kwargs):
         return Container(self, *args, **kwargs)
 
+    @_check_exists
+    def session(self, limits=None):
+        """Return a :class:`BuildSession` started from this image.
+
+        :param limits: the :class:`Limits` of the session's container.
+        """
+
+        return BuildSession(self, limits)
+
+    @_check_exists
+    def warm(self, limits=None, count=None):
+        """Start idle containers from this image in the background, for the
+        build sessions to come (see :func:`configure_warm_pool`, this does
+        nothing when the warm pool is disabled).
+
+        :param limits: the :class:`Limits` of the sessions.
+        :param count: how many sessions are coming (by default the size of
+                      the pool).
+        """
+
+        _warm_pool.fill(self.revision, limits, count)
+
     @_check_exists
     def destroy(self):
         """Remove the image from Docker.
@@ -593,12 +2520,87 @@ class Image(object):
         """
 
         logging.debug("Destroying image {0} from Docker".format(self.revspec))
-        with _CatchDockerError():
-            gevent.subprocess.check_call([
-                "docker", "rmi", self.revspec.revision
-            ])
+        _docker().remove_image(self.revspec.revision)
+        _image_catalog.remove(self.revspec.revision)
         self.revspec = None
 
+    @property
+    @_check_exists
+    def comment(self):
+        """The commit message of this image, or None."""
+
+        infos = _docker().inspect_image(self.revspec.revision)
+        return infos.get('Comment', infos.get('comment')) or None
+
+    @_check_exists
+    def layers(self):
+        """Return the layers of this image, top-most first.
+
+        :return: a list of (full layer id, size in bytes) tuples.
+        """
+
+        layers = []
+        layer_id = self.revspec.revision
+        docker = _docker()
+        while layer_id:
+            infos = docker.inspect_image(layer_id)
+            layers.append((
+                infos.get('Id', infos.get('id')),
+                infos.get('Size', infos.get('size', 0))
+            ))
+            layer_id = infos.get('Parent', infos.get('parent'))
+        return layers
+
+    @_check_exists
+    def squash(self, base):
+        """Flatten all the layers above *base* into a single layer.
+
+        The new image gets the same repository and tag as this one, and this
+        image is then removed from Docker (this object is invalidated, like
+        with :meth:`destroy`).
+
+        :param base: the :class:`Image` this image has been built from, its
+                     layers are kept as is.
+        :return: the new :class:`Image` (or this image if there was nothing to
+                 squash).
+        :raises: ValueError if this image isn't based on *base*.
+        """
+
+        layers = [layer_id for layer_id, size in self.layers()]
+        base_index = next((
+            i for i, layer_id in enumerate(layers)
+            if layer_id.startswith(base.revision)
+        ), None)
+        if base_index is None:
+            raise ValueError("{0} is not based on {1}".format(self, base))
+        if base_index <= 1:
+            logging.debug("Nothing to squash in {0}".format(self))
+            return self
+
+        logging.debug("Squashing {0} layers of {1} on top of {2}".format(
+            base_index, self, base
+        ))
+        docker = _docker()
+        with tempfile.TemporaryFile() as saved, \
+            tempfile.TemporaryFile() as loadable:
+            docker.save(self.revspec.revision, saved)
+            _metrics.operation("save").add_bytes(saved.tell())
+            saved.seek(0)
+            new_id = squash.squash_saved_image(
+                saved, loadable, layers[0], layers[base_index],
+                self.revspec.fqrn, self.revspec.tag
+            )
+            loadable.flush()
+            _metrics.operation("load").add_bytes(loadable.tell())
+            loadable.seek(0)
+            docker.load(loadable)
+        new_image = copy.copy(self)
+        new_image.revspec = self.revspec._replace(revision=new_id[:12])
+        _image_catalog.add(new_image.revspec)
+        # The tag has been moved to the new image, the old one is anonymous:
+        self.destroy()
+        return new_image
+
     @_check_exists
     def add_tag(self, tag):
         """Add a new tag to this image.
@@ -607,13 +2609,11 @@ class Image(object):
         """
 
         logging.debug("Tagging {0} as {1}".format(self.revspec, tag))
-        with _CatchDockerError():
-            gevent.subprocess.check_call([
-                "docker", "tag", self.revspec.revision, self.revspec.fqrn, tag
-            ])
+        _docker().tag(self.revspec.revision, self.revspec.fqrn, tag)
         # We can't re-instantiate an Image object, because it might resolve to
         # the wrong revspec when it parses the output of docker images (and
         # it's slower anyway):
         new_image = copy.copy(self)
         new_image.revspec = ImageRevSpec(*(self.revspec[:-1] + (tag,)))
+        _image_catalog.add(new_image.revspec)
         return new_image
@@ -0,0 +1,532 @@
+# -*- coding: utf-8 -*-
+
+"""
+sandbox.dockerapi
+~~~~~~~~~~~~~~~~~
+
+This module implements a minimal client for the Docker Remote API, spoken over
+the unix socket of the Docker daemon.
+
+Connections are kept alive and shared between greenlets with a
+:class:`ConnectionPool`, this way :mod:`~udotcloud.sandbox.containers` doesn't
+have to fork a docker process for each command.
+"""
+
+import contextlib
+import errno
+import gevent.queue
+import gevent.socket
+import httplib
+import json
+import logging
+import os
+import socket
+import struct
+import urllib
+
+from .exceptions import DockerCommandError, DockerNotFoundError
+
+DEFAULT_SOCKET = "/var/run/docker.sock"
+
+#: Stream types found in the headers of a multiplexed attach stream:
+STDIN, STDOUT, STDERR = range(3)
+
+def demultiplex(data):
+    """Iterate over a multiplexed stream, already read, as (stream type, data)
+    tuples.
+    """
+
+    offset = 0
+    while offset + 8 <= len(data):
+        stream_type, size = struct.unpack_from(">BxxxL", data, offset)
+        offset += 8
+        yield stream_type, data[offset:offset + size]
+        offset += size
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """An :class:`httplib.HTTPConnection` over a (gevent) unix socket."""
+
+    def __init__(self, path, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        httplib.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        sock = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            sock.settimeout(self.timeout)
+        try:
+            sock.connect(self._path)
+        except socket.error as ex:
+            sock.close()
+            if ex.errno in (errno.ENOENT, errno.ECONNREFUSED):
+                raise DockerNotFoundError(
+                    "Can't connect to Docker on {0}: {1}".format(
+                        self._path, ex.strerror
+                    )
+                )
+            raise
+        self.sock = sock
+
+class ConnectionPool(object):
+    """Keep-alive connections to the Docker daemon, shared between greenlets.
+
+    :param path: path to the unix socket of the Docker daemon.
+    :param size: maximum number of connections opened at the same time.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, size=8):
+        self.path = path
+        self.size = size
+        # Each item is a connection slot: None means that the connection has
+        # not been opened yet. Greenlets block on get() when every slot is in
+        # use.
+        self._slots = gevent.queue.LifoQueue()
+        for i in xrange(size):
+            self._slots.put(None)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Context manager that borrows a connection from the pool.
+
+        The connection is put back in the pool if the block exits normally,
+        otherwise it is closed (its state is unknown).
+        """
+
+        conn = self._slots.get()
+        if conn is None:
+            logging.debug("Opening a new connection to {0}".format(self.path))
+            conn = UnixHTTPConnection(self.path)
+        try:
+            yield conn
+        except:
+            conn.close()
+            self._slots.put(None)
+            raise
+        self._slots.put(conn)
+
+    def close(self):
+        """Close all the idle connections."""
+
+        for i in xrange(self.size):
+            conn = self._slots.get()
+            if conn is not None:
+                conn.close()
+        for i in xrange(self.size):
+            self._slots.put(None)
+
+class _RawStream(object):
+    """Read from a connection taken over from httplib.
+
+    :param sock: the socket to the Docker daemon.
+    :param buf: data already received after the headers of the response.
+    """
+
+    def __init__(self, sock, buf):
+        self._sock = sock
+        self._buf = buf
+
+    def _recv(self, bufsize):
+        if self._buf:
+            data, self._buf = self._buf[:bufsize], self._buf[bufsize:]
+            return data
+        return self._sock.recv(bufsize)
+
+    def _recv_exactly(self, size):
+        buf = []
+        while size:
+            data = self._recv(size)
+            if not data:
+                return None
+            buf.append(data)
+            size -= len(data)
+        return "".join(buf)
+
+    def _readline(self):
+        while "\r\n" not in self._buf:
+            data = self._sock.recv(4096)
+            if not data:
+                return None
+            self._buf += data
+        line, self._buf = self._buf.split("\r\n", 1)
+        return line
+
+    def close(self):
+        self._sock.close()
+
+class AttachedStream(_RawStream):
+    """A stream hijacked from the Docker daemon by an attach request.
+
+    :param sock: the socket to the Docker daemon.
+    :param buf: data already received after the headers of the response.
+    :param multiplexed: True if the container has no tty, in this case stdout
+                        and stderr are multiplexed on the stream.
+    """
+
+    def __init__(self, sock, buf, multiplexed):
+        _RawStream.__init__(self, sock, buf)
+        self.multiplexed = multiplexed
+
+    def write(self, data):
+        self._sock.sendall(data)
+
+    def close_stdin(self):
+        """Send EOF on the stdin of the container."""
+
+        try:
+            self._sock.shutdown(socket.SHUT_WR)
+        except socket.error as ex:
+            if ex.errno != errno.ENOTCONN:
+                raise
+
+    def frames(self, bufsize=8192):
+        """Iterate over the stream as (stream type, data) tuples.
+
+        If the stream isn't multiplexed everything is reported on STDOUT.
+        """
+
+        if not self.multiplexed:
+            data = self._recv(bufsize)
+            while data:
+                yield STDOUT, data
+                data = self._recv(bufsize)
+            return
+
+        header = self._recv_exactly(8)
+        while header:
+            stream_type, size = struct.unpack(">BxxxL", header)
+            data = self._recv_exactly(size)
+            if data is None:
+                return
+            yield stream_type, data
+            header = self._recv_exactly(8)
+
+    def read(self):
+        """Read the stream until EOF, stdout and stderr are merged."""
+
+        return "".join(data for stream_type, data in self.frames())
+
+class EventStream(_RawStream):
+    """The stream of events of the Docker daemon.
+
+    Iterate over it to get each event as a dictionnary, the iteration only
+    stops when the stream is closed.
+
+    :param chunked: True if the response uses the chunked transfer encoding.
+    """
+
+    def __init__(self, sock, buf, chunked):
+        _RawStream.__init__(self, sock, buf)
+        self._chunked = chunked
+
+    def _chunks(self):
+        if not self._chunked:
+            data = self._recv(8192)
+            while data:
+                yield data
+                data = self._recv(8192)
+            return
+
+        size = self._readline()
+        while size:
+            size = int(size.split(";")[0], 16)
+            if size == 0:
+                return
+            data = self._recv_exactly(size + 2) # + CRLF
+            if data is None:
+                return
+            yield data[:-2]
+            size = self._readline()
+
+    def __iter__(self):
+        decoder = json.JSONDecoder()
+        buf = ""
+        for data in self._chunks():
+            buf += data
+            while True:
+                buf = buf.lstrip()
+                try:
+                    event, end = decoder.raw_decode(buf)
+                except ValueError: # incomplete (or empty)
+                    break
+                buf = buf[end:]
+                yield event
+
+class Client(object):
+    """Client for the Docker Remote API.
+
+    :param pool: the :class:`ConnectionPool` to use.
+    """
+
+    #: The requests that can be made twice with the same result.
+    IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "PUT", "DELETE"])
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    @staticmethod
+    def _url(path, params=None):
+        if params:
+            params = {k: v for k, v in params.iteritems() if v is not None}
+            path = "{0}?{1}".format(path, urllib.urlencode(params))
+        return path
+
+    @staticmethod
+    def _request_body(body):
+        if body is None:
+            return None, {}
+        if hasattr(body, "read"): # a tarball
+            return body, {
+                "Content-Type": "application/x-tar",
+                "Content-Length": str(os.fstat(body.fileno()).st_size)
+            }
+        return json.dumps(body), {"Content-Type": "application/json"}
+
+    @classmethod
+    def _can_retry(cls, method, body, sent, error):
+        """Return True if a request that failed with error on a connection
+        kept alive can be made again.
+
+        :param sent: True if the request was completely sent.
+        """
+
+        if hasattr(body, "read") and not hasattr(body, "seek"):
+            return False # can't send it again
+        if not sent:
+            return True
+        # Nothing was received, the connection was closed before the
+        # daemon read the request:
+        if isinstance(error, httplib.BadStatusLine):
+            return True
+        return method in cls.IDEMPOTENT_METHODS
+
+    def _request(self, method, path, params=None, body=None, dest=None):
+        """Make a request and return the body of the response.
+
+        :param body: an object to send as JSON or a file to upload.
+        :param dest: if set, write the body of the response to this file
+                     instead of returning it.
+        """
+
+        url = self._url(path, params)
+        body, headers = self._request_body(body)
+        with self._pool.connection() as conn:
+            reused = conn.sock is not None
+            sent = False
+            try:
+                conn.request(method, url, body, headers)
+                sent = True
+                response = conn.getresponse()
+            except (httplib.BadStatusLine, socket.error) as ex:
+                # The daemon may have closed the connection while it was idle
+                # in the pool, open a new one and retry if the daemon can't
+                # have processed the request (or if it doesn't matter):
+                if not reused or not self._can_retry(method, body, sent, ex):
+                    raise
+                logging.debug("Retrying {0} {1} on a new connection: {2}".format(
+                    method, url, ex
+                ))
+                conn.close()
+                if hasattr(body, "seek"):
+                    body.seek(0)
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+            # Always consume the body so the connection can be re-used:
+            if dest is not None and response.status < 400:
+                data = response.read(65536)
+                while data:
+                    dest.write(data)
+                    data = response.read(65536)
+            else:
+                data = response.read()
+        # 304 is returned when you stop an already stopped container:
+        if response.status >= 400:
+            raise DockerCommandError("{0} {1} returned {2}: {3}".format(
+                method, url, response.status, data.strip()
+            ))
+        return data
+
+    def _request_json(self, method, path, params=None, body=None):
+        data = self._request(method, path, params, body)
+        return json.loads(data) if data else None
+
+    def version(self):
+        return self._request_json("GET", "/version")
+
+    def images(self):
+        return self._request_json("GET", "/images/json")
+
+    def create_container(self, config):
+        return self._request_json("POST", "/containers/create", body=config)
+
+    def start(self, container_id):
+        self._request("POST", "/containers/{0}/start".format(container_id))
+
+    def wait(self, container_id):
+        """Wait for the container to stop and return its exit code."""
+
+        return self._request_json(
+            "POST", "/containers/{0}/wait".format(container_id)
+        )['StatusCode']
+
+    def inspect_container(self, container_id):
+        return self._request_json(
+            "GET", "/containers/{0}/json".format(container_id)
+        )
+
+    def logs(self, container_id):
+        return self._request(
+            "GET", "/containers/{0}/logs".format(container_id),
+            params={"stdout": 1, "stderr": 1}
+        )
+
+    def commit(self, container_id, repository=None, tag=None, comment=None):
+        return self._request_json("POST", "/commit", params={
+            "container": container_id, "repo": repository, "tag": tag,
+            "comment": comment
+        })['Id']
+
+    def stop(self, container_id, timeout=10):
+        self._request(
+            "POST", "/containers/{0}/stop".format(container_id),
+            params={"t": timeout}
+        )
+
+    def kill(self, container_id):
+        self._request("POST", "/containers/{0}/kill".format(container_id))
+
+    def remove_container(self, container_id):
+        self._request("DELETE", "/containers/{0}".format(container_id))
+
+    def inspect_image(self, image):
+        return self._request_json("GET", "/images/{0}/json".format(image))
+
+    def save_image(self, image, dest):
+        """Write the tarball of an image (and its parents) to dest."""
+
+        self._request("GET", "/images/{0}/get".format(image), dest=dest)
+
+    def load_image(self, source):
+        """Load the images from a tarball made by :meth:`save_image`."""
+
+        self._request("POST", "/images/load", body=source)
+
+    def remove_image(self, image):
+        self._request("DELETE", "/images/{0}".format(image))
+
+    def tag(self, image, repository, tag):
+        self._request("POST", "/images/{0}/tag".format(image), params={
+            "repo": repository, "tag": tag, "force": 1
+        })
+
+    def _raw_request(self, method, path, params=None, body=None, headers={}):
+        """Make a request on a new connection, not taken from the pool, and
+        read the headers of the response.
+
+        This is used for the requests which can't go through httplib: the
+        ones after which the daemon takes the connection over, and the ones
+        streaming a response that never ends.
+
+        :return: a tuple (socket, response headers as a dictionnary with
+                 lower-case keys, data already received after the headers).
+        """
+
+        url = self._url(path, params)
+        body, body_headers = self._request_body(body)
+        headers = dict(headers, **body_headers)
+        body = body or ""
+        conn = UnixHTTPConnection(self._pool.path)
+        conn.connect()
+        sock, conn.sock = conn.sock, None
+        try:
+            sock.sendall(
+                "{0} {1} HTTP/1.1\r\n"
+                "Host: docker\r\n"
+                "{2}"
+                "Content-Length: {3}\r\n\r\n"
+                "{4}".format(method, url, "".join(
+                    "{0}: {1}\r\n".format(k, v) for k, v in headers.iteritems()
+                ), len(body), body)
+            )
+            buf = ""
+            while "\r\n\r\n" not in buf:
+                data = sock.recv(4096)
+                if not data:
+                    raise DockerCommandError(
+                        "{0} {1}: connection closed by Docker".format(method, url)
+                    )
+                buf += data
+            response_headers, buf = buf.split("\r\n\r\n", 1)
+            response_headers = response_headers.split("\r\n")
+            status = int(response_headers[0].split(" ", 2)[1])
+            if status >= 400:
+                raise DockerCommandError("{0} {1} returned {2}: {3}".format(
+                    method, url, status, buf.strip()
+                ))
+            response_headers = dict(
+                (k.strip().lower(), v.strip()) for k, v in (
+                    header.split(":", 1) for header in response_headers[1:]
+                )
+            )
+        except:
+            sock.close()
+            raise
+        return sock, response_headers, buf
+
+    def _hijack(self, path, params=None, body=None, multiplexed=True):
+        """Make a request after which the daemon takes the connection over.
+
+        :return: an :class:`AttachedStream` on a connection that is not taken
+                 from the pool (it is closed with the stream).
+        """
+
+        sock, headers, buf = self._raw_request(
+            "POST", path, params, body,
+            {"Connection": "Upgrade", "Upgrade": "tcp"}
+        )
+        return AttachedStream(sock, buf, multiplexed)
+
+    def events(self, since=None):
+        """Subscribe to the events of the daemon.
+
+        :param since: timestamp, the events since then are sent first.
+        :return: an :class:`EventStream` (closing it unsubscribes).
+        """
+
+        sock, headers, buf = self._raw_request(
+            "GET", "/events", params={"since": since}
+        )
+        return EventStream(
+            sock, buf, headers.get("transfer-encoding") == "chunked"
+        )
+
+    def attach(self, container_id, stdin=False, stdout=True, stderr=True,
+            logs=False, multiplexed=True):
+        """Attach to a container and return an :class:`AttachedStream`."""
+
+        return self._hijack("/containers/{0}/attach".format(container_id), {
+            "stream": 1,
+            "logs": int(logs),
+            "stdin": int(stdin),
+            "stdout": int(stdout),
+            "stderr": int(stderr)
+        }, multiplexed=multiplexed)
+
+    def exec_create(self, container_id, config):
+        return self._request_json(
+            "POST", "/containers/{0}/exec".format(container_id), body=config
+        )['Id']
+
+    def exec_start(self, exec_id, tty=False):
+        """Start a command created with :meth:`exec_create`.
+
+        :return: an :class:`AttachedStream` (see :meth:`attach`).
+        """
+
+        return self._hijack(
+            "/exec/{0}/start".format(exec_id),
+            body={"Detach": False, "Tty": tty},
+            multiplexed=not tty
+        )
+
+    def exec_inspect(self, exec_id):
+        return self._request_json("GET", "/exec/{0}/json".format(exec_id))
@@ -13,6 +13,10 @@ class UnkownImageError(SandboxError):
     """Raised when an Image cannot be found in Docker."""
     pass
 
+class ContainerTimeoutError(SandboxError):
+    """Raised when a command doesn't finish before its deadline."""
+    pass
+
 class DockerError(Exception):
     pass
 
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""
+sandbox.ignore
+~~~~~~~~~~~~~~
+
+Parse .sandboxignore files: the paths of the application that shouldn't be
+uploaded, in the same format as .gitignore.
+"""
+
+import errno
+import os
+import re
+
+class IgnoreRules(object):
+    """The rules of a .sandboxignore file.
+
+    Like in a .gitignore file:
+
+    - blank lines and lines starting with # are skipped;
+    - a pattern without a slash (e.g: ``*.pyc``) matches a file or directory
+      at any depth, a pattern with a slash (e.g: ``/data`` or ``doc/build``)
+      is relative to the root of the application;
+    - a pattern ending with a slash only matches directories;
+    - ``*`` and ``?`` don't match slashes, ``**`` matches any number of
+      directories;
+    - a pattern starting with ``!`` includes again what a previous pattern
+      excluded (but nothing can be included again below an excluded
+      directory: it isn't even walked).
+
+    The last pattern that matches a path decides.
+
+    :param lines: the lines of the file.
+    """
+
+    FILENAME = ".sandboxignore"
+
+    def __init__(self, lines=[]):
+        # list of (compiled pattern, negated, only matches directories):
+        self._rules = []
+        for line in lines:
+            line = line.rstrip("\n").rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negated = line.startswith("!")
+            if negated:
+                line = line[1:]
+            elif line.startswith("\\"):
+                line = line[1:] # \! or \#
+            directory = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            anchored = "/" in line
+            regex = self._translate(line.lstrip("/"))
+            if not anchored:
+                regex = "(?:.*/)?" + regex
+            self._rules.append((re.compile(regex + "$"), negated, directory))
+
+    def __len__(self):
+        return len(self._rules)
+
+    @classmethod
+    def load(cls, root):
+        """Return the rules of the .sandboxignore file in root (no rules if
+        there is no such file).
+        """
+
+        try:
+            with open(os.path.join(root, cls.FILENAME), "r") as fp:
+                return cls(fp.readlines())
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return cls()
+
+    @staticmethod
+    def _translate(pattern):
+        """Translate a glob pattern to a regular expression."""
+
+        i, n = 0, len(pattern)
+        regex = ""
+        while i < n:
+            if pattern.startswith("**/", i):
+                regex += "(?:.*/)?"
+                i += 3
+            elif pattern.startswith("**", i):
+                regex += ".*"
+                i += 2
+            elif pattern[i] == "*":
+                regex += "[^/]*"
+                i += 1
+            elif pattern[i] == "?":
+                regex += "[^/]"
+                i += 1
+            elif pattern[i] == "[" and pattern.find("]", i + 2) != -1:
+                end = pattern.find("]", i + 2)
+                chars = pattern[i + 1:end].replace("\\", "\\\\")
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                regex += "[{0}]".format(chars)
+                i = end + 1
+            else:
+                if pattern[i] == "\\" and i + 1 < n:
+                    i += 1
+                regex += re.escape(pattern[i])
+                i += 1
+        return regex
+
+    def match(self, path, is_dir=False):
+        """Return True if path (relative to the root of the application)
+        should be ignored.
+        """
+
+        ignored = False
+        for regex, negated, directory in self._rules:
+            if directory and not is_dir:
+                continue
+            if ignored == negated and regex.match(path):
+                ignored = not negated
+        return ignored
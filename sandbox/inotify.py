@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+"""
+sandbox.inotify
+~~~~~~~~~~~~~~~
+
+Watch the sources of an application for changes with inotify(7) (Linux only),
+through ctypes.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import gevent
+import gevent.socket
+import logging
+import os
+import struct
+import time
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 02000000
+IN_NONBLOCK = 04000
+
+_EVENT_HEADER = struct.Struct("iIII") # wd, mask, cookie, len
+
+class Inotify(object):
+    """Watch a directory tree (the ignored directories aren't watched).
+
+    :param root: the directory to watch.
+    :param ignore: :class:`~udotcloud.sandbox.ignore.IgnoreRules`.
+    :raise OSError: if inotify isn't available.
+    """
+
+    MASK = (
+        IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+        IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR |
+        IN_DONT_FOLLOW
+    )
+
+    def __init__(self, root, ignore=None):
+        self.root = root
+        self._ignore = ignore
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            self._raise_errno("inotify_init1")
+        # watch descriptor → directory, relative to root ("" for root):
+        self._directories = {}
+        self._add_tree("")
+
+    def _raise_errno(self, function):
+        code = ctypes.get_errno()
+        raise OSError(code, "{0}: {1}".format(function, os.strerror(code)))
+
+    def _ignored(self, path, is_dir):
+        return bool(self._ignore and path and self._ignore.match(path, is_dir))
+
+    def _add_tree(self, reldir):
+        """Watch reldir and the directories under it.
+
+        :return: the paths found under reldir (useful for a new directory).
+        """
+
+        found = []
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.root, reldir)):
+            current = os.path.relpath(dirpath, self.root)
+            current = "" if current == "." else current
+            wd = self._libc.inotify_add_watch(self._fd, dirpath, self.MASK)
+            if wd < 0:
+                if ctypes.get_errno() in (errno.ENOENT, errno.ENOTDIR):
+                    dirnames[:] = [] # removed in the meantime
+                    continue
+                self._raise_errno("inotify_add_watch")
+            self._directories[wd] = current
+            dirnames[:] = [
+                name for name in dirnames
+                if not self._ignored(os.path.join(current, name), True)
+            ]
+            found.extend(os.path.join(current, name) for name in dirnames)
+            found.extend(
+                os.path.join(current, name) for name in filenames
+                if not self._ignored(os.path.join(current, name), False)
+            )
+        return found
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def read(self):
+        """Wait for changes.
+
+        :return: the set of the paths (relative to root) that changed, or that
+                 are under a directory that changed. "" means that anything
+                 could have changed (the kernel dropped events).
+        """
+
+        while True:
+            gevent.socket.wait_read(self._fd)
+            try:
+                data = os.read(self._fd, 64 * 1024)
+                break
+            except OSError as ex:
+                if ex.errno != errno.EAGAIN:
+                    raise
+
+        paths = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("Too many changes at once, rescanning everything")
+                paths.add("")
+                continue
+            directory = self._directories.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._directories[wd]
+                continue
+            path = os.path.join(directory, name) if name else directory
+            is_dir = bool(mask & IN_ISDIR)
+            if self._ignored(path, is_dir):
+                continue
+            if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                paths.update(self._add_tree(path))
+            paths.add(path)
+        return paths
+
+    def changes(self, debounce=0.5):
+        """Generator of the changes: wait until nothing changed for debounce
+        seconds (e.g: while an editor saves a file, or a VCS checks out a
+        branch) before yielding them.
+
+        :return: (set of the paths that changed, time of the first change)
+                 tuples.
+        """
+
+        while True:
+            paths = self.read()
+            first_change_at = time.time()
+            while True:
+                timeout = gevent.Timeout.start_new(debounce)
+                try:
+                    paths.update(self.read())
+                except gevent.Timeout as ex:
+                    if ex is not timeout:
+                        raise
+                    break
+                finally:
+                    timeout.cancel()
+            if paths:
+                yield paths, first_change_at
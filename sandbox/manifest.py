@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""
+sandbox.manifest
+~~~~~~~~~~~~~~~~
+
+List the files of a source tree with their size, modification time and
+digest, to find what changed since the previous build.
+"""
+
+import hashlib
+import json
+import os
+import stat
+
+class Manifest(object):
+    """The files (and symbolic links) of a source tree.
+
+    The digests are computed lazily: :meth:`diff` re-uses the digests of the
+    previous manifest for the files that have the same size and modification
+    time, and only reads the others.
+
+    :param root: the directory the paths are relative to (only needed to
+                 compute the digests).
+    :param entries: dictionnary with the paths in keys and [size, mtime,
+                    digest or None] lists in values.
+    """
+
+    def __init__(self, root=None, entries=None):
+        self.root = root
+        self.entries = entries if entries is not None else {}
+        #: The directories of the tree (only known after :meth:`scan`).
+        self.directories = []
+        #: The ignored paths with their size, or None for the directories
+        #: that weren't measured (only known after :meth:`scan`).
+        self.ignored = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def _du(path):
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in filenames:
+                try:
+                    size += os.lstat(os.path.join(dirpath, name)).st_size
+                except OSError:
+                    pass
+        return size
+
+    @classmethod
+    def scan(cls, root, ignore=None, measure_ignored=False):
+        """Walk root and return its :class:`Manifest` (without the digests).
+
+        :param ignore: :class:`~udotcloud.sandbox.ignore.IgnoreRules`, the
+                       ignored directories aren't walked.
+        :param measure_ignored: if True, walk the ignored directories anyway
+                                to get their size.
+        """
+
+        manifest = cls(root)
+        for dirpath, dirnames, filenames in os.walk(root):
+            reldir = os.path.relpath(dirpath, root)
+            reldir = "" if reldir == "." else reldir + "/"
+            # os.walk lists the symbolic links to directories as directories:
+            for name in filenames + dirnames[:]:
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                is_dir = stat.S_ISDIR(st.st_mode)
+                relpath = reldir + name
+                if ignore and ignore.match(relpath, is_dir):
+                    if is_dir:
+                        dirnames.remove(name)
+                        manifest.ignored[relpath] = (
+                            cls._du(path) if measure_ignored else None
+                        )
+                    else:
+                        manifest.ignored[relpath] = st.st_size
+                elif is_dir:
+                    manifest.directories.append(relpath)
+                elif stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+                    manifest.entries[relpath] = [st.st_size, st.st_mtime, None]
+        return manifest
+
+    def size(self, paths=None):
+        """Return the total size of the given files (by default, of all the
+        files).
+        """
+
+        if paths is None:
+            paths = self.entries
+        return sum(self.entries[path][0] for path in paths if path in self.entries)
+
+    def paths(self):
+        """Return the sorted list of the directories and files to archive."""
+
+        return sorted(self.directories + self.entries.keys())
+
+    def digest(self, path):
+        """Return (and remember) the digest of the given path."""
+
+        entry = self.entries[path]
+        if entry[2] is None:
+            abspath = os.path.join(self.root, path)
+            sha1 = hashlib.sha1()
+            if os.path.islink(abspath):
+                sha1.update("link:" + os.readlink(abspath))
+            else:
+                with open(abspath, "rb") as fp:
+                    for buf in iter(lambda: fp.read(64 * 1024), ""):
+                        sha1.update(buf)
+            entry[2] = sha1.hexdigest()
+        return entry[2]
+
+    def diff(self, previous):
+        """Compare this manifest with the one of the previous build.
+
+        :return: the sorted lists of the paths added or changed since
+                 previous, and of the paths deleted since previous.
+        """
+
+        changed = []
+        for path, entry in self.entries.iteritems():
+            previous_entry = previous.entries.get(path)
+            if previous_entry is None or entry[0] != previous_entry[0]:
+                changed.append(path)
+            elif entry[1] == previous_entry[1] and entry[2] is None:
+                entry[2] = previous_entry[2]
+            elif self.digest(path) != previous_entry[2]:
+                changed.append(path)
+        deleted = [path for path in previous.entries if path not in self.entries]
+        return sorted(changed), sorted(deleted)
+
+    def reuse_digests(self, previous):
+        """Adopt the digests of the previous manifest for the files that have
+        the same size and modification time, so they aren't read again.
+        """
+
+        for path, entry in self.entries.iteritems():
+            previous_entry = previous.entries.get(path)
+            if entry[2] is None and previous_entry is not None \
+                    and previous_entry[:2] == entry[:2]:
+                entry[2] = previous_entry[2]
+
+    def dumps(self, computed_only=False):
+        """Serialize the manifest (with all the digests) to JSON.
+
+        :param computed_only: if True, leave out the files whose digest
+                              wasn't computed yet instead of reading them.
+        """
+
+        if computed_only:
+            return json.dumps({
+                path: entry for path, entry in self.entries.iteritems()
+                if entry[2] is not None
+            })
+        for path in self.entries:
+            self.digest(path)
+        return json.dumps(self.entries)
+
+    @classmethod
+    def loads(cls, data, root=None):
+        return cls(root, json.loads(data))
@@ -8,14 +8,20 @@ This module implements :class:`Application` which is the counterpart of
 :class:`builder.Builder <udotcloud.builder.builder.Builder>`.
 """
 
+import collections
 import contextlib
 import copy
+import errno
+import functools
 import gevent
 import gevent.event
+import gevent.lock
 import gevent.subprocess
+import hashlib
 import itertools
 import json
 import logging
+import multiprocessing
 import os
 import pkg_resources
 import pprint
@@ -23,6 +29,7 @@ import re
 import shutil
 import signal
 import socket
+import sys
 import tempfile
 import termios
 import time
@@ -30,10 +37,279 @@ import yaml
 
 from .. import builder
 from .buildfile import load_build_file
-from .containers import ImageRevSpec, Image
-from .exceptions import UnkownImageError
-from .tarfile import Tarball
-from ..utils import strsignal
+from .containers import ImageRevSpec, Image, LineBuffer, Limits
+from .containers import format_docker_metrics, metrics_scope, scheduler_stats
+from .exceptions import ContainerTimeoutError, UnkownImageError
+from .ignore import IgnoreRules
+from .inotify import Inotify
+from .manifest import Manifest
+from .tarfile import Compressor, Tarball, select_codec
+from ..utils import bytes_to_human, human_to_bytes, strsignal
+
+class _LayerCache(object):
+    """Images built on top of a base image and tagged with the digest of
+    what was used to build them, so the builds with the same inputs can
+    start from them instead of doing the work again.
+
+    The images are in the :attr:`REPOSITORY` repository and tagged with the
+    kind of layer and the digest (e.g: sandbox-cache:systempackages-1a2b…).
+    """
+
+    REPOSITORY = "sandbox-cache"
+
+    def __init__(self):
+        # tag → AsyncResult, for the layers being built right now:
+        self._building = {}
+
+    @staticmethod
+    def digest(*inputs):
+        """Hash the given inputs (anything that can be serialized to JSON)."""
+
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+    def get(self, kind, digest, build, refresh=False):
+        """Return the cached image for this kind of layer and digest, or
+        build it.
+
+        When the same layer is already being built (e.g: by another service
+        with the same system packages), wait for it instead of building it
+        twice.
+
+        :param build: callable that takes the :class:`ImageRevSpec` to commit
+                      the layer as, and returns the new :class:`Image` or None
+                      if the layer couldn't be built.
+        :param refresh: if True, build the layer even if it's already cached.
+        :return: the :class:`Image` or None if the layer couldn't be built.
+        """
+
+        tag = "{0}-{1}".format(kind, digest)
+        if tag in self._building:
+            return self._building[tag].get()
+        # Register the layer before looking it up in the cache (which yields)
+        # so the other builds with the same layer wait for this one:
+        result = self._building[tag] = gevent.event.AsyncResult()
+        revspec = ImageRevSpec.parse("{0}:{1}".format(self.REPOSITORY, tag))
+        try:
+            image = None
+            if not refresh:
+                try:
+                    image = Image(revspec)
+                    logging.debug("Found {0} layer {1} in the cache".format(
+                        kind, image
+                    ))
+                except UnkownImageError:
+                    pass
+            if image is None:
+                image = build(revspec)
+            result.set(image)
+            return image
+        except BaseException as ex:
+            result.set_exception(ex)
+            raise
+        finally:
+            self._building.pop(tag, None)
+
+_layer_cache = _LayerCache()
+
+class _Stage(object):
+    """A step of a build, see :class:`_StageScheduler`."""
+
+    def __init__(self, name, func, inputs, scope, required, on_failure):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.scope = scope
+        self.required = required
+        self.on_failure = on_failure
+        self.output = None
+        #: True if the stage raised an exception, returned None while being
+        #: required, or was skipped because one of its inputs failed.
+        self.failed = False
+        self.skipped = False
+        self.exc_info = None
+        self.waited = 0.
+        self.started_at = self.finished_at = None
+        self.done = gevent.event.Event()
+
+    @property
+    def duration(self):
+        if self.started_at is None or self.finished_at is None:
+            return 0.
+        return self.finished_at - self.started_at
+
+class _StageScheduler(object):
+    """Run the stages of the builds as a graph: each stage starts as soon as
+    the stages it depends on are done, with at most workers stages running at
+    the same time (waiting for the inputs doesn't take a worker).
+
+    A stage is a function called with the outputs of its inputs (the stages
+    it depends on, by name) and returns its own output. A stage fails when it
+    raises an exception, or returns None when it's required (e.g: the system
+    packages couldn't be installed), the stages that depend on it are then
+    skipped.
+
+    :param workers: how many stages can run at the same time, defaults to
+                    twice the number of CPUs (the stages mostly wait on
+                    Docker, whose operations are capped separately).
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or 2 * multiprocessing.cpu_count()
+        self._slots = gevent.lock.Semaphore(self.workers)
+        self._stages = collections.OrderedDict()
+        self._started_at = None
+
+    def __getitem__(self, name):
+        return self._stages[name]
+
+    def __iter__(self):
+        return iter(self._stages.values())
+
+    def add(self, name, func, inputs=[], scope=None, required=False,
+            on_failure=None):
+        """Add a stage.
+
+        :param inputs: the names of the stages whose outputs are given, in
+                       that order, to func.
+        :param scope: account the Docker operations of the stage to this
+                      name (see :func:`~udotcloud.sandbox.containers.metrics_scope`).
+        :param required: if True, returning None fails the stage.
+        :param on_failure: called with the :class:`_Stage` if it fails (but
+                           not if it's skipped or cancelled).
+        """
+
+        for input in inputs:
+            if input not in self._stages:
+                raise ValueError("Stage {0} depends on unknown stage {1}".format(
+                    name, input
+                ))
+        self._stages[name] = _Stage(
+            name, func, list(inputs), scope, required, on_failure
+        )
+
+    def _run_stage(self, stage):
+        inputs = [self._stages[name] for name in stage.inputs]
+        for input in inputs:
+            input.done.wait()
+        try:
+            if any(input.failed for input in inputs):
+                stage.failed = stage.skipped = True
+                return
+            queued_at = time.time()
+            with self._slots:
+                stage.started_at = time.time()
+                stage.waited = stage.started_at - queued_at
+                try:
+                    with metrics_scope(stage.scope):
+                        stage.output = stage.func(*[i.output for i in inputs])
+                except Exception:
+                    stage.exc_info = sys.exc_info()
+                    stage.failed = True
+                except BaseException:
+                    # Cancelled
+                    stage.failed = True
+                    raise
+                finally:
+                    stage.finished_at = time.time()
+            if stage.required and stage.output is None:
+                stage.failed = True
+            if stage.failed:
+                self._stage_failed(stage)
+        finally:
+            stage.done.set()
+
+    def _stage_failed(self, stage):
+        if stage.on_failure:
+            try:
+                stage.on_failure(stage)
+            except Exception:
+                logging.exception("Couldn't report the failure of stage {0}".format(
+                    stage.name
+                ))
+        if self._fail_fast or (
+            stage.exc_info and isinstance(stage.exc_info[1], self._cancel_on)
+        ):
+            self._cancel.set()
+
+    def run(self, cancel_on=(), fail_fast=False):
+        """Run all the stages.
+
+        :param cancel_on: exception classes that, when raised by a stage,
+                          cancel all the other stages.
+        :param fail_fast: if True, cancel all the other stages as soon as one
+                          fails.
+        """
+
+        self._started_at = time.time()
+        self._cancel_on = cancel_on
+        self._fail_fast = fail_fast
+        self._cancel = gevent.event.Event()
+        greenlets = [
+            gevent.spawn(self._run_stage, stage)
+            for stage in self._stages.values()
+        ]
+        watcher = gevent.spawn(self._cancel.wait)
+        remaining = len(greenlets)
+        try:
+            for greenlet in gevent.iwait(greenlets + [watcher]):
+                if greenlet is watcher:
+                    logging.info("Cancelling the build of the other services…")
+                    break
+                remaining -= 1
+                if not remaining:
+                    break
+        finally:
+            # Propagate the cancellation (a deadline or ^C) to the stages
+            # still running, their containers are destroyed on the way out:
+            gevent.killall(greenlets + [watcher])
+            for stage in self._stages.values():
+                if stage.finished_at is None:
+                    stage.failed = stage.skipped = True
+                    stage.done.set()
+
+    def critical_path(self):
+        """Return the chain of stages that determined how long the run took:
+        starting from the last stage to finish, the input that finished last
+        at each step.
+        """
+
+        finished = [s for s in self._stages.values() if s.finished_at]
+        if not finished:
+            return []
+        stage = max(finished, key=lambda s: s.finished_at)
+        path = [stage]
+        while True:
+            inputs = [
+                self._stages[name] for name in stage.inputs
+                if self._stages[name].finished_at
+            ]
+            if not inputs:
+                break
+            stage = max(inputs, key=lambda s: s.finished_at)
+            path.append(stage)
+        return list(reversed(path))
+
+    def log_critical_path(self):
+        path = self.critical_path()
+        if not path:
+            return
+        logging.info("Critical path ({0:.1f}s out of {1:.1f}s): {2}".format(
+            sum(stage.duration + stage.waited for stage in path),
+            path[-1].finished_at - self._started_at,
+            " → ".join(
+                "{0} {1:.1f}s".format(stage.name, stage.duration)
+                for stage in path
+            )
+        ))
+        for stage in self._stages.values():
+            if stage.started_at is not None:
+                logging.debug(
+                    "Stage {0}: started after {1:.2f}s, waited {2:.2f}s for a "
+                    "worker, ran for {3:.2f}s".format(
+                        stage.name, stage.started_at - self._started_at,
+                        stage.waited, stage.duration
+                    )
+                )
 
 class Application(object):
     """Represents a dotCloud application.
@@ -42,6 +318,19 @@ class Application(object):
     :param env: additional environment variables to define for this application.
     """
 
+    #: Where the manifest of the sources is kept between builds, so the files
+    #: that didn't change aren't read again (see :meth:`Service._inputs_digest`).
+    MANIFESTS_DIR = os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "sandbox", "manifests"
+    )
+
+    #: The sdist of Sandbox installed in the build containers to run the
+    #: builder (generated by setup.py).
+    SANDBOX_SDIST = pkg_resources.resource_filename(
+        "udotcloud.sandbox", "../dist/udotcloud.sandbox.tar.gz"
+    )
+
     def __init__(self, root, env):
         self._root = root
         #: Name of the application
@@ -66,6 +355,25 @@ class Application(object):
             for name, definition in self._build_file.iteritems()
         ]
         self._buildable_services = [s for s in self.services if s.buildable]
+        #: The :class:`~udotcloud.sandbox.manifest.Manifest` of the sources,
+        #: set by :meth:`build`.
+        self.manifest = None
+        #: How the code is compressed on its way to the containers: "auto",
+        #: "none", "gzip" or "xz" (see :func:`~udotcloud.sandbox.tarfile.select_codec`).
+        self.compression = "auto"
+        # upstream image revision → AsyncResult, for the images with the code
+        # shared by the services built on the same image:
+        self._code_images = {}
+        # Prefix of the names of the build stages of this application, set
+        # when several applications are built at once (see build_applications):
+        self._stage_prefix = ""
+        # Service → greenlet running it, while run is running:
+        self._runners = {}
+        # The services stopped by restart, that run starts again:
+        self._restarting = set()
+        # True while run is running (restart is only possible then):
+        self._running = False
+        self._stop_ev = gevent.event.Event()
 
     def __str__(self):
         return "{0}: {1}".format(self.name, pprint.pformat(self._build_file))
@@ -84,22 +392,72 @@ class Application(object):
         yield
         termios.tcsetattr(1, termios.TCSAFLUSH, old)
 
-    def _generate_application_tarball(self, app_build_dir):
-        logging.debug("Archiving {0} in {1}".format(self.name, app_build_dir))
-        app_tarball = Tarball.create_from_files(
-            ".",
-            os.path.join(app_build_dir, "application.tar"),
-            self._root
+    def _scan(self):
+        """List the files of the application (the ones excluded by the
+        .sandboxignore file are left out).
+        """
+
+        ignore = IgnoreRules.load(self._root)
+        # Measuring the ignored directories means walking them (e.g: .git or
+        # node_modules), only do it when the sizes are displayed:
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        self.manifest = Manifest.scan(self._root, ignore, measure_ignored=debug)
+        self._load_digests()
+        if not self.manifest.ignored:
+            return self.manifest
+        logging.info("Ignored {0} paths from {1}".format(
+            len(self.manifest.ignored), IgnoreRules.FILENAME
+        ))
+        if not debug:
+            return self.manifest
+        ignored = sorted(
+            self.manifest.ignored.iteritems(), key=lambda i: i[1], reverse=True
         )
-        app_tarball.wait()
+        logging.debug("The ignored paths add up to {0}:".format(
+            bytes_to_human(sum(size for p, size in ignored))
+        ))
+        for path, size in ignored[:10]:
+            logging.debug("    {0:>5} {1}".format(bytes_to_human(size), path))
+        if len(ignored) > 10:
+            logging.debug("    … and {0} more".format(len(ignored) - 10))
+        return self.manifest
+
+    @property
+    def _manifest_cache_path(self):
+        return os.path.join(self.MANIFESTS_DIR, "{0}.json".format(
+            hashlib.sha1(os.path.abspath(self._root)).hexdigest()
+        ))
+
+    def _load_digests(self):
+        """Re-use the digests computed by the previous build for the files
+        that didn't change since then.
+        """
+
+        try:
+            with open(self._manifest_cache_path, "r") as fp:
+                previous = Manifest.loads(fp.read())
+        except (IOError, ValueError):
+            return
+        self.manifest.reuse_digests(previous)
+
+    def _save_digests(self):
+        if self.manifest is None:
+            return
+        path = self._manifest_cache_path
+        try:
+            if not os.path.isdir(self.MANIFESTS_DIR):
+                os.makedirs(self.MANIFESTS_DIR)
+            with open(path + ".tmp", "w") as fp:
+                fp.write(self.manifest.dumps(computed_only=True))
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError) as ex:
+            logging.debug("Couldn't save the manifest of {0}: {1}".format(
+                self.name, ex
+            ))
+
+    def _generate_builder_files(self, app_build_dir):
         sandbox_sdist = os.path.join(app_build_dir, "udotcloud.sandbox.tar.gz")
-        shutil.copy(
-            pkg_resources.resource_filename(
-                "udotcloud.sandbox",
-                "../dist/udotcloud.sandbox.tar.gz"
-            ),
-            sandbox_sdist
-        )
+        shutil.copy(self.SANDBOX_SDIST, sandbox_sdist)
         bootstrap_script = os.path.join(app_build_dir, "bootstrap.sh")
         shutil.copy(
             pkg_resources.resource_filename(
@@ -107,6 +465,9 @@ class Application(object):
             ),
             bootstrap_script
         )
+        with open(sandbox_sdist, "rb") as fp:
+            #: Identify the builder, for the layers it builds.
+            self.builder_digest = hashlib.sha1(fp.read()).hexdigest()
         ssh_keys = os.path.join(app_build_dir, "authorized_keys2")
         with open(ssh_keys, "w") as fp:
             os.fchmod(fp.fileno(), 0600)
@@ -122,49 +483,94 @@ class Application(object):
                 except IOError:
                     pass
 
-        return [app_tarball.dest, sandbox_sdist, bootstrap_script, ssh_keys]
+        return [sandbox_sdist, bootstrap_script, ssh_keys]
 
-    def build(self, base_image=None):
-        """Build the application using Docker.
+    def _code_image(self, upstream, limits, upload):
+        """Return the image with the code uploaded on top of upstream, shared
+        by all the services built on this image during the build.
 
-        :return: a dictionnary with the service names in keys and the resulting
-                 Docker images in values. Returns an empty dictionnary if there
-                 is no buildable service in this application (i.e: only
-                 databases). Returns None if one service couldn't be built.
+        :param upload: callable that uploads the code in the
+                       :class:`~udotcloud.sandbox.containers.BuildSession` it
+                       gets, only called by the first service.
         """
 
-        if not self._buildable_services:
-            return {}
+        if upstream.revision in self._code_images:
+            return self._code_images[upstream.revision].get()
+        result = self._code_images[upstream.revision] = gevent.event.AsyncResult()
+        logging.debug("Uploading the code of {0} on top of {1}".format(
+            self.name, upstream
+        ))
+        try:
+            with upstream.session(limits) as session:
+                upload(session)
+                image = session.commit(ImageRevSpec.parse("{0}:code-{1}".format(
+                    self.name, upstream.revision[:12]
+                )))
+            result.set(image)
+            return image
+        except BaseException as ex:
+            result.set_exception(ex)
+            raise
 
-        if not base_image:
-            # TODO: design something to automatically pick a base image.
-            logging.error(
-                "You need to specify the base image to use via the -i option "
-                "(you can pull and try lopter/sandbox-base)"
+    @staticmethod
+    def _log_scheduler_stats():
+        for operation, stats in sorted(scheduler_stats().iteritems()):
+            logging.debug(
+                "Docker {0}: {1} calls, {2} waited for a slot ({3:.2f}s in "
+                "total, {4:.2f}s max)".format(
+                    operation, stats["calls"], stats["queued"],
+                    stats["wait"], stats["max_wait"]
+                )
             )
-            return
 
-        with self._build_dir() as build_dir, self._reset_terminal():
-            app_files = self._generate_application_tarball(build_dir)
-            logging.debug("Starting parallel build for {0} services".format(
-                len(self._buildable_services)
+    @staticmethod
+    def _log_docker_metrics():
+        lines = format_docker_metrics()
+        if lines:
+            logging.info("Docker operations:\n    {0}".format(
+                "\n    ".join(lines)
             ))
-            greenlets = [
-                gevent.spawn(s.build, build_dir, app_files, base_image)
-                for s in self._buildable_services
-            ]
-            gevent.joinall(greenlets)
-            for service, result in zip(self._buildable_services, greenlets):
-                try:
-                    if not result.get():
-                        return None
-                except Exception:
-                    logging.exception("Couldn't build service {0} ({1})".format(
-                        service.name, service.type
-                    ))
-                    return None
 
-        return {s.name: s.result_image for s in self.services if s.buildable}
+    def build(self, base_image=None, squash=False, limits=None,
+            refresh_cache=False, incremental=True, compression="auto",
+            workers=None, fail_fast=None, services=None):
+        """Build the application using Docker.
+
+        :param squash: if True, flatten the layers added on top of the base
+                       image into a single layer in the resulting images.
+        :param incremental: if True, build each service on top of its
+                            previous build when possible, only uploading the
+                            files that changed since then.
+        :param refresh_cache: if True, rebuild the cached layers (e.g: the
+                              system packages) instead of re-using them.
+        :param compression: how to compress the code uploaded in the
+                            containers: "none", "gzip", "xz" or "auto" to
+                            pick depending on its size.
+        :param workers: how many build stages (installing the system
+                        packages, uploading the code, running the builder…)
+                        can run at the same time, for all the services (see
+                        :class:`_StageScheduler`).
+        :param fail_fast: if True, stop the build of all the services as soon
+                          as one fails (their containers are destroyed). By
+                          default, only when the CI environment variable is
+                          set (e.g: on Travis CI).
+        :param limits: the :class:`~udotcloud.sandbox.containers.Limits` of
+                       the build containers, the values left to None default
+                       to an equal share of the host between the services
+                       (the limits section of each service takes precedence
+                       over both).
+        :param services: the names of the services to build, by default all
+                         the buildable services.
+        :return: a dictionnary with the service names in keys and the resulting
+                 Docker images in values. Returns an empty dictionnary if there
+                 is no buildable service in this application (i.e: only
+                 databases). Returns None if one service couldn't be built.
+        """
+
+        return build_applications(
+            [self], base_image, squash, limits, refresh_cache, incremental,
+            compression, workers, fail_fast, services
+        )[self]
 
     def run(self):
         """Run the application in Docker using the result of the latest build.
@@ -181,9 +587,12 @@ class Application(object):
 
         def signal_handler(signum):
             logging.info("{0} caught, stopping {1} services…".format(
-                strsignal(signum), len(greenlets)
+                strsignal(signum), len(self._runners)
             ))
-            gevent.joinall([gevent.spawn(service.stop) for service in services])
+            self._restarting.clear()
+            gevent.joinall([
+                gevent.spawn(service.stop) for service in self._runners
+            ])
 
         def get_status(service, result):
             try:
@@ -193,10 +602,8 @@ class Application(object):
                 if len(self._buildable_services) > 1:
                     logging.info("Stopping the other services…")
                     gevent.joinall([
-                        gevent.spawn(service.stop) for service in services
+                        gevent.spawn(other.stop) for other in self._runners
                     ])
-            except gevent.Timeout:
-                return None
             except UnkownImageError:
                 logging.error(
                     "Couldn't find the image to run for service {0} ({1}), did "
@@ -208,35 +615,212 @@ class Application(object):
                 ))
             return False
 
-        stop_ev = gevent.event.Event()
-        services = [service for service in self._buildable_services]
-        greenlets = [gevent.spawn(service.run, stop_ev) for service in services]
+        self._stop_ev.clear()
+        self._restarting.clear()
+        self._running = True
+        self._runners = {
+            service: gevent.spawn(service.run, self._stop_ev)
+            for service in self._buildable_services
+        }
         sigterm_handler = gevent.signal(signal.SIGTERM, signal_handler)
         ret = True
         try:
-            while greenlets:
-                remaining_greenlets = []
+            while self._runners:
                 try:
-                    stop_ev.wait()
-                    stop_ev.clear()
-                    for service, result in zip(self._buildable_services, greenlets):
-                        status = get_status(service, result)
-                        if status is None:
-                            remaining_greenlets.append(result)
-                        elif not status:
-                            ret = status
+                    self._stop_ev.wait()
+                    self._stop_ev.clear()
+                    for service, result in self._runners.items():
+                        if not result.ready():
+                            continue
+                        del self._runners[service]
+                        if service in self._restarting:
+                            self._restarting.discard(service)
+                            self._runners[service] = gevent.spawn(
+                                service.run, self._stop_ev
+                            )
+                        elif not get_status(service, result):
+                            ret = False
                 except KeyboardInterrupt:
                     signal_handler(signal.SIGINT)
-                greenlets = remaining_greenlets
         finally:
+            self._running = False
             gevent.signal(signal.SIGTERM, sigterm_handler)
+            self._log_docker_metrics()
         return ret
 
+    def restart(self, services, timeout=60):
+        """Restart services (started by :meth:`run`) on the result of their
+        latest build.
+
+        :param services: list of :class:`Service`.
+        :param timeout: how long to wait, in seconds, for the services to run
+                        again.
+        :return: True if all the services are running again, False if they
+                 aren't or if :meth:`run` returned.
+        """
+
+        if not self._running:
+            logging.error(
+                "Can't restart {0}, the application isn't running".format(
+                    ", ".join(service.name for service in services)
+                )
+            )
+            return False
+        stopping = []
+        for service in services:
+            service._serving.clear()
+            if service in self._runners:
+                self._restarting.add(service)
+                stopping.append(service)
+            else: # It exited in the meantime, run is still waiting on the
+                  # others and will report its result:
+                self._runners[service] = gevent.spawn(service.run, self._stop_ev)
+        gevent.joinall([gevent.spawn(service.stop) for service in stopping])
+        return all(service._serving.wait(timeout) for service in services)
+
+    def _affected_services(self, paths):
+        """Return the buildable services whose build depends on one of the
+        paths (relative to the root of the application, "" means that
+        anything could have changed).
+        """
+
+        if "dotcloud.yml" in paths:
+            logging.warning(
+                "dotcloud.yml changed, restart sandbox to take the new "
+                "definitions of the services into account"
+            )
+        if paths & {"", "dotcloud.yml", IgnoreRules.FILENAME}:
+            return list(self._buildable_services)
+        return [
+            service for service in self._buildable_services
+            if any(
+                (path + "/").startswith(service._approot_prefix)
+                for path in paths
+            )
+        ]
+
+    def _rebuild_on_changes(self, inotify, base_image, debounce, build_options):
+        for paths, first_change_at in inotify.changes(debounce):
+            services = self._affected_services(paths)
+            if not services:
+                logging.debug("No service depends on {0}".format(
+                    ", ".join(sorted(paths))
+                ))
+                continue
+            names = [service.name for service in services]
+            logging.info("{0} changed, rebuilding {1}…".format(
+                ", ".join(sorted(paths)[:3]) + (" …" if len(paths) > 3 else ""),
+                ", ".join(names)
+            ))
+            build_started_at = time.time()
+            try:
+                result_images = self.build(
+                    base_image, services=names, **build_options
+                )
+            except Exception:
+                logging.exception("Couldn't rebuild {0}".format(
+                    ", ".join(names)
+                ))
+                result_images = None
+            if result_images is None:
+                logging.error(
+                    "Keeping the previous build of {0} running until the next "
+                    "changes".format(", ".join(names))
+                )
+                continue
+            restart_started_at = time.time()
+            if not self.restart(services):
+                logging.error("{0} didn't start again after the rebuild".format(
+                    ", ".join(names)
+                ))
+                continue
+            now = time.time()
+            logging.info(
+                "{0} serving the changes {1:.2f}s after they were made "
+                "(build: {2:.2f}s, restart: {3:.2f}s)".format(
+                    ", ".join(names), now - first_change_at,
+                    restart_started_at - build_started_at,
+                    now - restart_started_at
+                )
+            )
+
+    def watch(self, base_image=None, debounce=0.5, **build_options):
+        """Build and run the application, then rebuild and restart the
+        services whose code changed, until they exit.
+
+        Only the services with changes under their approot are rebuilt
+        (incrementally by default) and restarted, the others keep running.
+        If the rebuild fails, the previous build keeps running.
+
+        :param debounce: wait until nothing changed for that many seconds
+                         before rebuilding (e.g: while a VCS checks out a
+                         branch).
+        :param build_options: the other arguments of :meth:`build`.
+        :return: like :meth:`run`, or None if the application couldn't be
+                 built or watched.
+        """
+
+        try:
+            inotify = Inotify(self._root, IgnoreRules.load(self._root))
+        except OSError as ex:
+            logging.error("Can't watch {0} for changes: {1}".format(
+                self._root, ex.strerror
+            ))
+            return None
+        try:
+            if self.build(base_image, **build_options) is None:
+                return None
+            watcher = gevent.spawn(
+                self._rebuild_on_changes,
+                inotify, base_image, debounce, build_options
+            )
+            try:
+                return self.run()
+            finally:
+                watcher.kill()
+        finally:
+            inotify.close()
+
+def _metrics_scope(method):
+    """Account the Docker operations made by this method of
+    :class:`Service` (e.g: while the service is run) to the service.
+    """
+
+    @functools.wraps(method)
+    def wrapped(self, *args, **kwargs):
+        with metrics_scope(self.name):
+            return method(self, *args, **kwargs)
+    return wrapped
+
 class Service(object):
     """Represents a single service within a dotCloud application."""
 
     CUSTOM_PORTS_RANGE_START = 42800
 
+    #: Where the manifest of the code is saved in the result image.
+    MANIFEST_NAME = ".sandbox-manifest.json"
+
+    #: Each incremental build adds a layer on top of the previous one, do a
+    #: full build once there are that many layers above the dependencies.
+    MAX_INCREMENTAL_BUILDS = 8
+
+    #: Commit message of the result images, with the digest of the inputs
+    #: of the build (see :meth:`_inputs_digest`).
+    MEMO_COMMENT = "sandbox inputs {0}"
+
+    #: How many lines of output are displayed when the build fails.
+    OUTPUT_TAIL_LINES = 50
+
+    #: Deadlines, in seconds, of each step of the build (None means no
+    #: deadline), they can be overridden in the timeouts section of each
+    #: service in dotcloud.yml.
+    DEFAULT_TIMEOUTS = {
+        "systempackages": 30 * 60,
+        "upload": 10 * 60,
+        "bootstrap": 10 * 60,
+        "build": 60 * 60
+    }
+
     def __init__(self, application, name, definition):
         self._application = application
         self.name = name
@@ -249,6 +833,19 @@ class Service(object):
         self.environment = copy.copy(self.environment)
         self.environment["DOTCLOUD_SERVICE_NAME"] = self.name
         self.environment["DOTCLOUD_SERVICE_ID"] = 0
+        self.timeouts = dict(
+            self.DEFAULT_TIMEOUTS, **definition.get("timeouts", {})
+        )
+        limits = definition.get("limits", {})
+        cpuset = limits.get("cpuset")
+        memory = limits.get("memory")
+        #: The :class:`~udotcloud.sandbox.containers.Limits` from the limits
+        #: section of the service in dotcloud.yml.
+        self.limits = Limits(
+            cpu_shares=limits.get("cpu_shares"),
+            cpuset=str(cpuset) if cpuset is not None else None,
+            memory=human_to_bytes(str(memory)) if memory is not None else None
+        )
         # Let's keep it as real dict too, so we can easily dump it:
         self._definition = definition
         self._definition['environment'] = self.environment
@@ -259,7 +856,22 @@ class Service(object):
         # "Allocate" the custom ports we are going to bind too inside the
         # container
         self._allocate_custom_ports()
+        # The container of the service started by run:
         self._container = None
+        # The BuildSession of the build step in progress (the service can be
+        # rebuilt while it's running, see Application.watch):
+        self._session = None
+        #: Prefix for the lines of output streamed from the build containers.
+        self.output_prefix = "{0} |".format(self.name)
+        # The last lines of output of the commands run during the build:
+        self._output_tail = collections.deque(maxlen=self.OUTPUT_TAIL_LINES)
+        # Digest of the inputs of the build, see _inputs_digest:
+        self._digest = None
+        # Set by Application.build when other services are built on the same
+        # image, the code is then uploaded once for all of them:
+        self._share_code = False
+        # Set while the service is running (see run):
+        self._serving = gevent.event.Event()
 
     # XXX This is half broken right now, since we will loose the original
     # protocol of the port (tcp or udp), anyway good enough for now (docker
@@ -291,14 +903,87 @@ class Service(object):
             self._application.name, self.name
         ))
 
-    def _build_revspec(self):
-        return ImageRevSpec(None, None, None, None) # keep build rev anonymous
+    @property
+    def _label(self):
+        """Name of the service in the build stages and their output."""
+
+        return self._application._stage_prefix + self.name
+
+    @property
+    def _approot_prefix(self):
+        """Prefix of the paths (relative to the root of the application)
+        under the approot of this service.
+        """
+
+        approot = os.path.normpath(self.approot)
+        return "" if approot == "." else approot + "/"
+
+    def _memo_revspec(self, digest):
+        return ImageRevSpec.parse("{0}-{1}:inputs-{2}".format(
+            self._application.name, self.name, digest
+        ))
+
+    def _inputs_digest(self, base_image, manifest, squash):
+        """Hash everything the result of the build of this service depends
+        on: the base image, the definition of the service, the content of the
+        files under its approot, its environment and the builder.
+
+        Only the files whose size or modification time changed since the
+        previous build are read (see :meth:`Application._load_digests`).
+        """
 
-    def _generate_environment_files(self, svc_build_dir):
+        files = [
+            (path, manifest.digest(path)) for path in sorted(manifest.entries)
+            if path.startswith(self._approot_prefix)
+        ]
+        return _layer_cache.digest(
+            base_image.revision, dict(self._definition, name=self.name),
+            files, self._environment_files(),
+            self._application.builder_digest, squash
+        )
+
+    def _memoized_build(self, digest):
+        """Return the result of a previous build with the same inputs, or
+        None.
+        """
+
+        try:
+            image = Image(self._memo_revspec(digest))
+        except UnkownImageError:
+            return None
+        # (The commit message is lost when the image is squashed)
+        comment = image.comment
+        if comment is not None and comment != self.MEMO_COMMENT.format(digest):
+            logging.debug("{0} wasn't built from {1}".format(image, digest))
+            return None
+        return image
+
+    def _log_output(self, level):
+        def log_line(line):
+            self._output_tail.append((level, line))
+            logging.log(level, "{0} {1}".format(self.output_prefix, line))
+        return LineBuffer(log_line)
+
+    def _log_failure(self, stage):
+        """Show the last lines of output of the service that weren't displayed
+        (e.g: the output of apt-get is logged at the debug level), as soon as
+        one of its stages fails.
+        """
+
+        hidden = [
+            line for level, line in self._output_tail
+            if not logging.getLogger().isEnabledFor(level)
+        ]
+        if not hidden:
+            return
+        logging.error("{0} Stage {1} failed, last lines of output:".format(
+            self.output_prefix, stage.name
+        ))
+        for line in hidden:
+            logging.error("{0} {1}".format(self.output_prefix, line))
+
+    def _environment_files(self):
         # environment.{json,yml} + .dotcloud_profile
-        env_json = os.path.join(svc_build_dir, "environment.json")
-        env_yml = os.path.join(svc_build_dir, "environment.yml")
-        env_profile = os.path.join(svc_build_dir, "dotcloud_profile")
         env = {
             key: value for key, value in itertools.chain(
                 self._application.environment.iteritems(),
@@ -309,122 +994,526 @@ class Service(object):
             "PORT_{0}".format(name.upper()): port
             for name, port in self.ports.iteritems()
         })
-        with open(env_json, 'w') as fp:
-            json.dump(env, fp, indent=4)
-        with open(env_yml, 'w') as fp:
-            yaml.safe_dump(env, fp, indent=4, default_flow_style=False)
-        with open(env_profile, 'w') as fp:
-            fp.writelines([
+        return {
+            "environment.json": json.dumps(env, indent=4),
+            "environment.yml": yaml.safe_dump(
+                env, indent=4, default_flow_style=False
+            ),
+            "dotcloud_profile": "".join([
                 "export {0}={1}\n".format(k, v) for k, v in env.iteritems()
             ])
-        return [env_json, env_yml, env_profile]
-
-    def _dump_service_definition(self, svc_build_dir):
-        definition = os.path.join(svc_build_dir, "definition.json")
-        with open(definition, "w") as fp:
-            json.dump(dict(self._definition, name=self.name), fp, indent=4)
-        return definition
-
-    def _generate_service_tarball(self, app_build_dir, app_files):
-        svc_build_dir = os.path.join(app_build_dir, self.name)
-        os.mkdir(svc_build_dir)
-        svc_tarball_name = "service.tar"
-        app_files_names = [os.path.basename(path) for path in app_files]
-
-        svc_files = self._generate_environment_files(svc_build_dir)
-        svc_files.append(self._dump_service_definition(svc_build_dir))
-        svc_tarball = Tarball.create_from_files(
-            [os.path.basename(path) for path in svc_files],
-            os.path.join(svc_build_dir, svc_tarball_name),
-            svc_build_dir
-        )
-        svc_tarball.wait()
-
-        for name, path in zip(app_files_names, app_files):
-            os.link(path, os.path.join(svc_build_dir, name))
-        app_files_names.append(svc_tarball_name)
-        svc_tarball = Tarball.create_from_files(
-            app_files_names,
-            os.path.join(app_build_dir, "{0}.tar".format(self.name)),
-            svc_build_dir
+        }
+
+    def _service_files(self, deleted=None):
+        """Return the files generated for the service (environment and
+        definition), by name.
+
+        :param deleted: list of the files deleted since the previous build,
+                        if the code is uploaded on top of it.
+        """
+
+        files = self._environment_files()
+        files["definition.json"] = json.dumps(
+            dict(self._definition, name=self.name), indent=4
         )
-        svc_tarball.wait()
-        return svc_tarball
+        if deleted is not None:
+            files["deleted.json"] = json.dumps(deleted)
+        return files
+
+    def _stream_service_tarball(self, dest, app_files, code=None, deleted=None,
+            service_files=True):
+        """Write the code, the builder files and the service files, as a
+        single tar stream, to dest.
+
+        Nothing is written on the disk: the code is archived straight from
+        the sources (in the code directory) and the service files are
+        generated in memory.
+
+        :param code: the paths (relative to the root of the application) to
+                     upload, instead of all the code (except the ignored
+                     files).
+        :param service_files: if False, only stream the code and the builder
+                              files (e.g: to share them between services).
+        """
+
+        root = self._application._root
+        if code is None:
+            code = self._application.manifest.paths()
+        tarball = Tarball.create_from_list(code, dest, root, prefix="code")
+        tarball.wait()
+        if app_files:
+            tarball = Tarball.create_from_files(
+                [os.path.basename(path) for path in app_files],
+                dest, os.path.dirname(app_files[0])
+            )
+            tarball.wait()
+        if service_files:
+            Tarball.write_files(self._service_files(deleted), dest)
+
+    def _unpack_service_tarball(self, svc_tarball, container, codec=None):
+        """Extract a tarball in the build directory of the service.
+
+        :param svc_tarball: callable that writes the tar stream (e.g:
+                            :meth:`_stream_service_tarball`) to the file-like
+                            object it gets.
+        :param codec: compress the tarball on the way with this codec (see
+                      :data:`~udotcloud.sandbox.tarfile.CODECS`).
+        """
 
-    def _unpack_service_tarball(self, svc_tarball_path, container):
         logging.debug("Extracting code in service {0}".format(self.name))
-        with open(svc_tarball_path, "r") as source:
-            tar_extract = ["tar", "-xf", "-", "-C", self._extract_path]
-            with container.run(tar_extract, stdin=container.PIPE) as dest:
-                buf = source.read(8192)
-                while buf:
-                    dest.stdin.write(buf)
-                    buf = source.read(8192)
-                dest.stdin.close()
-
-    def build(self, app_build_dir, app_files, base_image):
-        logging.info("Building service {0}…".format(self.name))
-        # Install system packages
-        logging.debug("Installing system packages {0} for service {1}".format(
-            ", ".join(self.systempackages), self.name
-        ))
-        self._container = base_image.instantiate(
-            commit_as=self._build_revspec()
-        )
-        self._container.install_system_packages(self.systempackages)
-        svc_tarball = self._generate_service_tarball(app_build_dir, app_files)
-        logging.debug("Tarball for service {0} generated at {1}".format(
-            self.name, svc_tarball.dest
+        # The stream can be made of several tarballs:
+        tar_extract = [
+            "tar", "--ignore-zeros", "--recursive-unlink",
+            "-xf", "-", "-C", self._extract_path
+        ]
+        if codec:
+            tar_extract.insert(1, "--use-compress-program={0}".format(codec))
+        started_at = time.time()
+        with container.run(
+            tar_extract, stdin=container.PIPE,
+            timeout=self.timeouts["upload"]
+        ) as dest:
+            stream = Compressor(codec, dest.stdin) if codec else dest.stdin
+            svc_tarball(stream)
+            if codec:
+                stream.close()
+            dest.stdin.close()
+        if codec:
+            duration = max(time.time() - started_at, 0.001)
+            logging.info(
+                "Uploaded {0} in service {1} with {2}: {3:.0%} of the size, "
+                "at {4}/s ({5}/s compressed)".format(
+                    bytes_to_human(stream.bytes_in), self.name, codec,
+                    float(stream.bytes_out) / max(stream.bytes_in, 1),
+                    bytes_to_human(stream.bytes_in / duration),
+                    bytes_to_human(stream.bytes_out / duration)
+                )
+            )
+
+    def _squash_result_image(self, base_image):
+        def describe(layers):
+            return "{0} layers ({1})".format(
+                len(layers), bytes_to_human(sum(size for id, size in layers))
+            )
+
+        layers_before = self.result_image.layers()
+        self.result_image = self.result_image.squash(base_image)
+        logging.info("Squashed service {0}: {1} → {2}".format(
+            self.name, describe(layers_before),
+            describe(self.result_image.layers())
         ))
-        # Upload all the code:
-        self._container = self._container.result.instantiate(
-            commit_as=self._build_revspec()
-        )
-        self._unpack_service_tarball(svc_tarball.dest, self._container)
+
+    def _session_limits(self, limits=None):
+        if limits is not None:
+            return limits.merge(self.limits)
+        return self.limits
+
+    def _system_packages_image(self, base_image, limits, refresh=False):
+        """Return the image with the system packages of this service
+        installed on top of base_image (from the cache when possible), or
+        None if they couldn't be installed.
+        """
+
+        if not self.systempackages:
+            return base_image
+
+        packages = sorted(set(self.systempackages))
+
+        def install(revspec):
+            logging.debug("Installing system packages {0} for service {1}".format(
+                ", ".join(packages), self.name
+            ))
+            with base_image.session(limits) as session:
+                self._session = session
+                try:
+                    output = self._log_output(logging.DEBUG)
+                    session.install_system_packages(
+                        packages, output,
+                        timeout=self.timeouts["systempackages"]
+                    )
+                    output.flush()
+                    if session.exit_status != 0:
+                        logging.error(
+                            "Couldn't install the system packages of service "
+                            "{0}: apt-get returned {1}".format(
+                                self.name, session.exit_status
+                            )
+                        )
+                        return None
+                    return session.commit(revspec)
+                finally:
+                    self._session = None
+
+        digest = _layer_cache.digest(base_image.revision, packages)
+        return _layer_cache.get("systempackages", digest, install, refresh)
+
+    def _install_builder(self, session):
         # Install the builder via the bootstrap script
-        self._container = self._container.result.instantiate(
-            commit_as=self._build_revspec()
-        )
         bootstrap_script = os.path.join(self._extract_path, "bootstrap.sh")
-        with self._container.run([bootstrap_script]):
+        output = self._log_output(logging.DEBUG)
+        with session.run(
+            [bootstrap_script], output=output,
+            timeout=self.timeouts["bootstrap"]
+        ):
             logging.debug("Installing builder in service {0}".format(self.name))
-        logging.debug("Builder bootstrap logs:\n{0}".format(
-            self._container.logs
-        ))
-        if self._container.exit_status != 0:
+        output.flush()
+        if session.exit_status != 0:
             logging.warning(
                 "Couldn't install the builder in service {0} (bootstrap script "
-                "returned {1}".format(self.name, self._container.exit_status)
+                "returned {1}".format(self.name, session.exit_status)
             )
-        # And run it
-        self._container = self._container.result.instantiate(
-            commit_as=self._result_revspec()
-        )
-        # Since we don't actually go through login(1) we need to set HOME
-        # otherwise, .profile won't be executed by login shells:
-        with self._container.run(
-            [builder.BUILDER_INSTALL_PATH, self._extract_path],
-            env={"HOME": "/home/dotcloud"}, as_user="dotcloud"
+
+    def _run_builder(self, session, options=[]):
+        # And run it. Since we don't actually go through login(1) we need to
+        # set HOME otherwise, .profile won't be executed by login shells:
+        output = self._log_output(logging.INFO)
+        with session.run(
+            [builder.BUILDER_INSTALL_PATH] + options + [self._extract_path],
+            env={"HOME": "/home/dotcloud"}, as_user="dotcloud",
+            output=output, timeout=self.timeouts["build"]
         ):
             logging.debug("Running builder in service {0}".format(self.name))
-        logging.info("Build logs for {0}:\n{1}".format(
-            self.name, self._container.logs
-        ))
-        if self._container.exit_status != 0:
+        output.flush()
+        if session.exit_status != 0:
             logging.error(
                 "The build failed on service {0}: the builder returned {1} "
-                "(expected 0)".format(self.name, self._container.exit_status)
+                "(expected 0)".format(self.name, session.exit_status)
             )
             return False
-        self.result_image = self._container.result
-        self.result_image.add_tag("latest")
-        self._container = None
         return True
 
+    # Requirements that refer to other files than requirements.txt (local
+    # packages, other requirements files…), they can't be installed without
+    # the code:
+    _LOCAL_REQUIREMENT_RE = re.compile(
+        r"^\s*(-e|--editable|-r|--requirement|-c|--constraint|\.|/|file:)"
+    )
+
+    def _read_requirements(self):
+        path = os.path.join(
+            self._application._root, self.approot, "requirements.txt"
+        )
+        try:
+            with open(path, "r") as fp:
+                return fp.read()
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return None
+
+    def _dependencies_inputs(self):
+        """Return what the dependencies layer of this service is built from,
+        or None if its dependencies are installed with the code.
+        """
+
+        service_class = builder.services.get_service_class(self.type)
+        if not service_class.CACHEABLE_DEPENDENCIES:
+            return None
+        requirements = self._read_requirements()
+        if requirements is not None and any(
+            self._LOCAL_REQUIREMENT_RE.match(line)
+            for line in requirements.splitlines()
+        ):
+            logging.debug(
+                "The requirements of service {0} refer to local files, they "
+                "will be installed with the code".format(self.name)
+            )
+            return None
+        return (
+            self.type, self.approot, self.config.get("python_version"),
+            requirements, self.requirements
+        )
+
+    def _upstream_digest(self):
+        """Hash what the layers under the code of this service are built from
+        (on a given base image): the services with the same digest are built
+        on the same image.
+        """
+
+        return _layer_cache.digest(
+            sorted(set(self.systempackages)), self._dependencies_inputs()
+        )
+
+    def _dependencies_image(self, app_files, base_image, limits, refresh=False):
+        """Return the image with the dependencies of this service (e.g: the
+        virtualenv of Python services) installed on top of base_image (from
+        the cache when possible), or None if they couldn't be installed.
+
+        The dependencies are installed with nothing but the files listing
+        them, so the image can be re-used until they change.
+        """
+
+        inputs = self._dependencies_inputs()
+        if inputs is None:
+            return base_image
+        requirements = inputs[3]
+
+        def install(revspec):
+            logging.debug("Installing the dependencies of service {0}".format(
+                self.name
+            ))
+            # Only upload the files listing the dependencies:
+            code = [self.approot]
+            if requirements is not None:
+                code.append(os.path.join(self.approot, "requirements.txt"))
+            with base_image.session(limits) as session:
+                self._session = session
+                try:
+                    self._unpack_service_tarball(
+                        lambda dest: self._stream_service_tarball(
+                            dest, app_files, code
+                        ),
+                        session
+                    )
+                    self._install_builder(session)
+                    if not self._run_builder(session, ["--dependencies"]):
+                        return None
+                    return session.commit(revspec)
+                finally:
+                    self._session = None
+
+        digest = _layer_cache.digest(
+            base_image.revision, *inputs + (self._application.builder_digest,)
+        )
+        return _layer_cache.get("dependencies", digest, install, refresh)
+
+    def _previous_build(self, dependencies_image):
+        """Return the image of the previous build if the next one can be done
+        on top of it, otherwise None.
+        """
+
+        try:
+            previous = Image(self._latest_result_revspec)
+        except UnkownImageError:
+            return None
+        layers = [layer_id for layer_id, size in previous.layers()]
+        depth = next((
+            i for i, layer_id in enumerate(layers)
+            if layer_id.startswith(dependencies_image.revision)
+        ), None)
+        if depth is None:
+            logging.debug("{0} isn't based on {1}, full build for service "
+                "{2}".format(previous, dependencies_image, self.name))
+            return None
+        if depth > self.MAX_INCREMENTAL_BUILDS:
+            logging.debug("{0} incremental builds in a row, full build for "
+                "service {1}".format(depth, self.name))
+            return None
+        return previous
+
+    @property
+    def _manifest_path(self):
+        return os.path.join(self._extract_path, self.MANIFEST_NAME)
+
+    def _read_manifest(self, session):
+        chunks = []
+        with session.run(
+            ["cat", self._manifest_path], output=chunks.append,
+            timeout=self.timeouts["upload"]
+        ):
+            pass
+        if session.exit_status != 0:
+            return None
+        return Manifest.loads("".join(chunks), self._application._root)
+
+    def _write_manifest(self, session, manifest):
+        with session.run(
+            ["/bin/sh", "-c", "cat > {0}".format(self._manifest_path)],
+            stdin=session.PIPE, timeout=self.timeouts["upload"]
+        ) as process:
+            process.stdin.write(manifest.dumps())
+            process.stdin.close()
+
+    def _upload_service_files(self, session):
+        # The code is already there, only upload what's specific to the
+        # service:
+        self._unpack_service_tarball(
+            lambda dest: Tarball.write_files(self._service_files(), dest),
+            session
+        )
+
+    def _codec(self, paths=None):
+        """Pick the codec to upload these files (by default, all the code)."""
+
+        return select_codec(
+            self._application.manifest.size(paths),
+            self._application.compression
+        )
+
+    def _upload_code(self, app_files, session, incremental):
+        """Upload the code in the session (only what changed since the build
+        the session was started from, when incremental is True).
+        """
+
+        manifest = self._application.manifest
+        changed = deleted = None
+        previous_manifest = self._read_manifest(session) if incremental else None
+        if previous_manifest is not None:
+            changed, deleted = manifest.diff(previous_manifest)
+            logging.info(
+                "Uploading {0} changed files (out of {1}) and deleting {2} "
+                "files in service {3}".format(
+                    len(changed), len(manifest), len(deleted), self.name
+                )
+            )
+        else:
+            if incremental:
+                # The previous build didn't record its code, start over:
+                with session.run(
+                    ["rm", "-rf", os.path.join(self._extract_path, "code")]
+                ):
+                    pass
+        self._unpack_service_tarball(
+            lambda dest: self._stream_service_tarball(
+                dest, app_files, changed, deleted
+            ),
+            session, self._codec(changed)
+        )
+
+    def _build(self, app_files, start_image, code_image, previous_image,
+            limits):
+        # Everything happens in the same container, and only the result of the
+        # build is commited:
+        with start_image.session(limits) as session:
+            self._session = session
+            try:
+                if code_image is not None:
+                    self._upload_service_files(session)
+                else:
+                    self._upload_code(
+                        app_files, session, previous_image is not None
+                    )
+                self._install_builder(session)
+                if not self._run_builder(session):
+                    return None
+                self._write_manifest(session, self._application.manifest)
+                self.result_image = session.commit(
+                    self._result_revspec(),
+                    self.MEMO_COMMENT.format(self._digest)
+                )
+                return self.result_image
+            finally:
+                self._session = None
+
+    def _add_build_stages(self, scheduler, base_image, squash=False,
+            limits=None, refresh_cache=False, incremental=True):
+        """Add the stages to build this service to scheduler.
+
+        The stages are named after the service (e.g: www:packages, or
+        app/www:packages when several applications are built at once) and
+        depend on the "scan" (the manifest of the application) and
+        "builder-files" stages. The "memo" stage looks for the result of a
+        build with the same inputs: when there is one, it's tagged as the
+        latest build and the stages after the dependencies have nothing to
+        do. The system packages and the dependencies don't wait for it (it
+        needs the whole sources to be scanned and hashed), they are usually
+        cached anyway when the result of the build is.
+        """
+
+        limits = self._session_limits(limits)
+        logging.debug("Limits for service {0}: {1}".format(self.name, limits))
+
+        scan = self._application._stage_prefix + "scan"
+
+        def stage(name):
+            return "{0}:{1}".format(self._label, name)
+
+        def add(name, func, inputs=[], required=False, after_memo=True):
+            def run(memoized, *inputs):
+                # Nothing to do if the result of the build is already there:
+                if memoized is not None:
+                    return memoized
+                return func(*inputs)
+            scheduler.add(
+                stage(name), run if after_memo else func,
+                ([stage("memo")] if after_memo else []) + [
+                    scan if i == "scan" else
+                    i if i == "builder-files" else stage(i)
+                    for i in inputs
+                ],
+                scope=self._label, required=required,
+                on_failure=self._log_failure
+            )
+
+        def memo(manifest, app_files):
+            self._digest = self._inputs_digest(base_image, manifest, squash)
+            if refresh_cache:
+                return None
+            memoized = self._memoized_build(self._digest)
+            if memoized is None:
+                return None
+            logging.info(
+                "Service {0} is up to date, re-using {1}".format(
+                    self.name, memoized
+                )
+            )
+            self.result_image = memoized
+            memoized.add_tag("latest")
+            return memoized
+
+        def packages():
+            logging.info("Building service {0}…".format(self.name))
+            return self._system_packages_image(base_image, limits, refresh_cache)
+
+        def previous(dependencies_image):
+            if not incremental:
+                return None
+            return self._previous_build(dependencies_image)
+
+        def code(dependencies_image, previous_image, manifest, app_files):
+            if previous_image is not None or not self._share_code:
+                return None
+            return self._application._code_image(
+                dependencies_image, limits,
+                lambda session: self._unpack_service_tarball(
+                    lambda dest: self._stream_service_tarball(
+                        dest, app_files, service_files=False
+                    ),
+                    session, self._codec()
+                )
+            )
+
+        def build(dependencies_image, previous_image, code_image, manifest,
+                app_files):
+            start_image = previous_image or code_image or dependencies_image
+            return self._build(
+                app_files, start_image, code_image, previous_image, limits
+            )
+
+        def squash_result(result_image):
+            self._squash_result_image(base_image)
+            return self.result_image
+
+        def tag(result_image):
+            result_image.add_tag(self._memo_revspec(self._digest).tag)
+            result_image.add_tag("latest")
+            return result_image
+
+        add("memo", memo, ["scan", "builder-files"], after_memo=False)
+        add("packages", packages, required=True, after_memo=False)
+        add(
+            "dependencies",
+            lambda packages_image, app_files: self._dependencies_image(
+                app_files, packages_image, limits, refresh_cache
+            ),
+            ["packages", "builder-files"], required=True, after_memo=False
+        )
+        add("previous", previous, ["dependencies"])
+        add("code", code, ["dependencies", "previous", "scan", "builder-files"])
+        add(
+            "build", build,
+            ["dependencies", "previous", "code", "scan", "builder-files"],
+            required=True
+        )
+        if squash:
+            add("squash", squash_result, ["build"], required=True)
+        add("tag", tag, ["squash" if squash else "build"], required=True)
+
+    @_metrics_scope
     def run(self, stop_ev):
         try:
             image = Image(self._latest_result_revspec)
-            self._container = image.instantiate()
+            container = self._container = image.instantiate()
             ports = self.ports.values()
             ports.append(2222)
             if not "worker" in self.type:
@@ -433,12 +1522,13 @@ class Service(object):
                 self._extract_path, "supervisor.conf"
             ))
             logging.info("Starting Supervisor in {0}".format(image))
-            with self._container.run_stream_logs(
+            with container.run_stream_logs(
                 ["/bin/sh", "-lc", supervisor_cmd],
                 env={"HOME": "/home/dotcloud"},
                 as_user="dotcloud",
                 ports=ports
             ) as supervisor:
+                self._serving.set()
                 for port, mapped_port in supervisor.ports.iteritems():
                     if port == 2222:
                         logging.info(
@@ -452,21 +1542,200 @@ class Service(object):
                             "Port {0} on service {1} mapped to {2} on the "
                             "Docker host".format(port, self.name, mapped_port)
                         )
-            if self._container.exit_status != 0:
+            if container.exit_status != 0:
                 logging.warning(
                     "Service {0} didn't exit normally (returned "
-                    "{1})".format(self.name, self._container.exit_status)
+                    "{1})".format(self.name, container.exit_status)
                 )
             else:
                 logging.info("Service {0} exited".format(self.name))
-            exit_status = self._container.exit_status
-            self._container = None
-            return exit_status
+            return container.exit_status
         finally: # Avoid any stupid deadlock
+            self._container = None
+            self._serving.clear()
             stop_ev.set()
 
     def stop(self):
         """If the service is currently running or building, interrupt it."""
 
-        if self._container:
-            self._container.stop()
+        for container in (self._session, self._container):
+            if container:
+                container.stop()
+
+def _running_in_ci():
+    """Return True if the CI environment variable is set to a true value
+    (e.g: CI=true, but not CI=false or CI=0).
+    """
+
+    return os.environ.get("CI", "").strip().lower() in ("1", "true", "yes")
+
+def build_applications(applications, base_image=None, squash=False,
+        limits=None, refresh_cache=False, incremental=True, compression="auto",
+        workers=None, fail_fast=None, services=None):
+    """Build several applications at once.
+
+    The stages of all the services run in the same :class:`_StageScheduler`
+    (workers is the cap for all the applications), the builder is packaged
+    once for all of them and the host is split between all the services. The
+    cached layers (e.g: the system packages) and the list of the Docker images
+    are shared as well, since they are kept for the whole process.
+
+    The arguments are the ones of :meth:`Application.build` (services is
+    applied to each application).
+
+    :return: a :class:`collections.OrderedDict` with the applications in keys
+             and what :meth:`Application.build` returns for each of them in
+             values.
+    :raise ValueError: if two applications have the same name (their images
+                       would have the same names too).
+    """
+
+    names = collections.Counter(a.name for a in applications)
+    for name, count in names.iteritems():
+        if count > 1:
+            raise ValueError(
+                "{0} applications are named {1}".format(count, name)
+            )
+
+    results = collections.OrderedDict()
+    building = collections.OrderedDict()
+    for application in applications:
+        buildable = [
+            s for s in application._buildable_services
+            if services is None or s.name in services
+        ]
+        results[application] = {} if not buildable else None
+        if buildable:
+            building[application] = buildable
+    if not building:
+        return results
+
+    if not base_image:
+        # TODO: design something to automatically pick a base image.
+        logging.error(
+            "You need to specify the base image to use via the -i option "
+            "(you can pull and try lopter/sandbox-base)"
+        )
+        return results
+
+    all_buildable = list(itertools.chain.from_iterable(building.values()))
+    for application in building:
+        application._stage_prefix = (
+            application.name + "/" if len(building) > 1 else ""
+        )
+
+    # The output of all the services is streamed at the same time, prefix
+    # each line with the name of its service:
+    prefix_width = max(len(s._label) for s in all_buildable)
+    for service in all_buildable:
+        service.output_prefix = "{0:<{1}} |".format(
+            service._label, prefix_width
+        )
+
+    # Split the host between the services so a greedy build can't starve
+    # the others or push the host into swap:
+    default_limits = Limits.host_defaults(len(all_buildable))
+    if limits is not None:
+        default_limits = default_limits.merge(limits)
+    # Start the containers of the build sessions (if the warm pool is
+    # enabled) while the application tarball is generated:
+    sessions = collections.defaultdict(int)
+    for service in all_buildable:
+        sessions[service._session_limits(default_limits)] += 1
+    for service_limits, count in sessions.iteritems():
+        base_image.warm(service_limits, count)
+
+    for application, buildable in building.iteritems():
+        # Upload the code once for the services built on the same image:
+        upstreams = [(s, s._upstream_digest()) for s in buildable]
+        counts = collections.Counter(digest for s, digest in upstreams)
+        for service, digest in upstreams:
+            service._share_code = counts[digest] > 1
+        application.compression = compression
+        application._code_images = {}
+
+    with Application._build_dir() as build_dir, Application._reset_terminal():
+        def builder_files():
+            # The builder is the same for all the applications:
+            first = next(iter(building))
+            app_files = first._generate_builder_files(build_dir)
+            for application in building:
+                application.builder_digest = first.builder_digest
+            return app_files
+
+        # The stages of all the services run in the same scheduler, they
+        # start as soon as what they need is ready (e.g: the system
+        # packages are installed while the sources are scanned):
+        scheduler = _StageScheduler(workers)
+        scheduler.add("builder-files", builder_files, required=True)
+        for application, buildable in building.iteritems():
+            scheduler.add(
+                application._stage_prefix + "scan", application._scan,
+                required=True
+            )
+            for service in buildable:
+                service._add_build_stages(
+                    scheduler, base_image, squash, default_limits,
+                    refresh_cache, incremental
+                )
+        logging.debug("Starting parallel build for {0} services".format(
+            len(all_buildable)
+        ))
+        if fail_fast is None:
+            fail_fast = _running_in_ci()
+        scheduler.run(cancel_on=ContainerTimeoutError, fail_fast=fail_fast)
+        for application in building:
+            application._save_digests()
+        scheduler.log_critical_path()
+        Application._log_scheduler_stats()
+        Application._log_docker_metrics()
+
+        services_by_label = {s._label: s for s in all_buildable}
+        for stage in scheduler:
+            if stage.exc_info is None:
+                continue
+            what = "{0} (stage {1})".format(
+                ", ".join(a.name for a in building), stage.name
+            )
+            if stage.scope is not None:
+                service = services_by_label[stage.scope]
+                what = "service {0} ({1})".format(service._label, service.type)
+            if isinstance(stage.exc_info[1], ContainerTimeoutError):
+                logging.error("Couldn't build {0}: {1}".format(
+                    what, stage.exc_info[1]
+                ))
+            else:
+                logging.error(
+                    "Couldn't build {0}".format(what), exc_info=stage.exc_info
+                )
+
+        summary = []
+        for application, buildable in building.iteritems():
+            labels = [s._label for s in buildable]
+            stages = [
+                stage for stage in scheduler if stage.scope in labels or
+                stage.name in ("builder-files", application._stage_prefix + "scan")
+            ]
+            failed = any(stage.failed for stage in stages)
+            if not failed:
+                results[application] = {s.name: s.result_image for s in buildable}
+            started = [s.started_at for s in stages if s.started_at]
+            finished = [s.finished_at for s in stages if s.finished_at]
+            up_to_date = sum(
+                1 for label in labels
+                if scheduler["{0}:memo".format(label)].output is not None
+            )
+            summary.append(
+                "{0}: {1} ({2} services, {3} up to date, {4:.1f}s)".format(
+                    application.name, "failed" if failed else "built",
+                    len(buildable), up_to_date,
+                    max(finished) - min(started) if started else 0.
+                )
+            )
+        if len(building) > 1:
+            logging.info("Built {0} applications out of {1}:\n    {2}".format(
+                sum(1 for a in building if results[a] is not None),
+                len(building), "\n    ".join(summary)
+            ))
+
+    return results
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+"""
+sandbox.squash
+~~~~~~~~~~~~~~
+
+This module flattens layers of an image exported with ``docker save`` into a
+single layer, see :meth:`Image.squash
+<udotcloud.sandbox.containers.Image.squash>`.
+
+.. note::
+
+   Unlike :mod:`udotcloud.sandbox.tarfile`, the tarfile module from the
+   standard library is used here: the layers have to be merged member by
+   member without being extracted (extracting them would require root
+   privileges to keep the ownership of the files).
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+
+#: Prefix used by Docker to mark files deleted by a layer.
+WHITEOUT_PREFIX = ".wh."
+
+def _normpath(name):
+    path = os.path.normpath(name).lstrip("/")
+    return "" if path == "." else path
+
+def _is_removed(path, removed):
+    while path:
+        if path in removed:
+            return True
+        path = os.path.dirname(path)
+    return False
+
+def merge_layers(layers, dest):
+    """Merge several layers into a single one.
+
+    :param layers: list of file objects on the layer.tar of each layer,
+                   top-most layer first.
+    :param dest: file object where the merged layer is written.
+    :return: the number of members in the merged layer.
+    """
+
+    seen = set()
+    removed = set()
+    hardlinks = []
+    count = 0
+    merged = tarfile.open(fileobj=dest, mode="w", format=tarfile.GNU_FORMAT)
+    try:
+        for layer in layers:
+            # Files deleted by this layer are still visible in this layer
+            # (they could have been re-created), only hide them from the
+            # layers below:
+            removed_here = set()
+            source = tarfile.open(fileobj=layer, mode="r")
+            for member in source:
+                path = _normpath(member.name)
+                dirname, basename = os.path.split(path)
+                if basename.startswith(WHITEOUT_PREFIX):
+                    target = os.path.join(
+                        dirname, basename[len(WHITEOUT_PREFIX):]
+                    )
+                    removed_here.add(target)
+                    if target in seen:
+                        continue
+                if path in seen or _is_removed(path, removed):
+                    continue
+                seen.add(path)
+                count += 1
+                if member.islnk():
+                    # The target of the link can come from a layer below, it
+                    # has to be written before the link:
+                    hardlinks.append(member)
+                elif member.isfile():
+                    merged.addfile(member, source.extractfile(member))
+                else:
+                    merged.addfile(member)
+            source.close()
+            removed.update(removed_here)
+        for member in hardlinks:
+            merged.addfile(member)
+    finally:
+        merged.close()
+    return count
+
+def squash_saved_image(source, dest, top, base, fqrn, tag):
+    """Squash the layers of an image exported with ``docker save``.
+
+    :param source: file object on the tarball made by ``docker save``.
+    :param dest: file object where the tarball to give to ``docker load`` is
+                 written.
+    :param top: full id of the top-most layer of the image.
+    :param base: full id of the layer on top of which everything is squashed.
+    :param fqrn, tag: the repository and tag to load the new image as.
+    :return: the id of the new layer.
+    """
+
+    saved = tarfile.open(fileobj=source, mode="r")
+    workdir = tempfile.mkdtemp(prefix="sandbox-squash-")
+    try:
+        def layer_file(layer_id, name):
+            return saved.extractfile("{0}/{1}".format(layer_id, name))
+
+        # Walk down from the top until we reach the base:
+        config = json.load(layer_file(top, "json"))
+        layers = []
+        layer_id, parent = top, config.get("parent")
+        while layer_id != base:
+            if parent is None:
+                raise ValueError("{0} is not a parent of {1}".format(base, top))
+            layers.append(layer_file(layer_id, "layer.tar"))
+            layer_id = parent
+            parent = json.load(layer_file(layer_id, "json")).get("parent")
+
+        new_id = os.urandom(32).encode("hex")
+        new_dir = os.path.join(workdir, new_id)
+        os.mkdir(new_dir)
+        with open(os.path.join(new_dir, "layer.tar"), "w") as fp:
+            merge_layers(layers, fp)
+        config.update({"id": new_id, "parent": base})
+        config.pop("Size", None)
+        with open(os.path.join(new_dir, "json"), "w") as fp:
+            json.dump(config, fp)
+        with open(os.path.join(new_dir, "VERSION"), "w") as fp:
+            fp.write("1.0")
+        with open(os.path.join(workdir, "repositories"), "w") as fp:
+            json.dump({fqrn: {tag: new_id}}, fp)
+
+        loadable = tarfile.open(fileobj=dest, mode="w")
+        loadable.add(new_dir, new_id)
+        loadable.add(os.path.join(workdir, "repositories"), "repositories")
+        loadable.close()
+        return new_id
+    finally:
+        saved.close()
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import distutils.spawn
 import gevent
 import gevent.subprocess
+import os
+import time
 
 # Previous experience (in Python 2.6.x) has shown that the tarfile module is
 # utterly broken, this is why tar is directly used here.
@@ -13,34 +16,220 @@ class TarCreateError(TarError):
     def __init__(self, returncode, stderr):
         self.message = "tar returned {0}: {1}".format(returncode, stderr)
 
+#: The codecs that tarballs can be compressed with: name → compression
+#: commands by order of preference (the multi-threaded ones first). The name
+#: is also the command used to decompress (with -d) on the other end.
+CODECS = {
+    "gzip": [["pigz", "-c"], ["gzip", "-c"]],
+    "xz": [["pxz", "-c"], ["xz", "-T0", "-c"]],
+}
+
+#: Don't compress smaller tarballs, it's not worth it:
+COMPRESSION_MIN_SIZE = 4 * 1024 * 1024
+#: Use xz for bigger tarballs, when a multi-threaded xz is available:
+XZ_MIN_SIZE = 256 * 1024 * 1024
+
+def compression_command(codec):
+    """Return the command to compress with the given codec on this host.
+
+    :raise TarError: if no program implementing this codec is installed.
+    """
+
+    for cmd in CODECS[codec]:
+        if distutils.spawn.find_executable(cmd[0]):
+            return cmd
+    raise TarError("Can't compress with {0}: none of {1} is installed".format(
+        codec, ", ".join(cmd[0] for cmd in CODECS[codec])
+    ))
+
+def select_codec(size, codec="auto"):
+    """Pick the codec to compress a tarball of about size bytes.
+
+    :param codec: "auto", "none" or one of the :data:`CODECS`.
+    :return: the name of the codec or None to not compress at all.
+    """
+
+    if codec != "auto":
+        return None if codec == "none" else codec
+    if size < COMPRESSION_MIN_SIZE:
+        return None
+    if size >= XZ_MIN_SIZE and distutils.spawn.find_executable("pxz"):
+        return "xz"
+    return "gzip"
+
+class Compressor(object):
+    """File-like object that compresses what's written to it (with an
+    external program) and writes the result to dest.
+
+    .. attribute:: bytes_in
+
+       How many bytes were written to the compressor.
+
+    .. attribute:: bytes_out
+
+       How many bytes it wrote to dest.
+    """
+
+    def __init__(self, codec, dest):
+        self.codec = codec
+        self.bytes_in = self.bytes_out = 0
+        self._dest = dest
+        self._process = gevent.subprocess.Popen(
+            compression_command(codec), stdin=gevent.subprocess.PIPE,
+            stdout=gevent.subprocess.PIPE, stderr=gevent.subprocess.PIPE
+        )
+        self._stderr = gevent.spawn(self._process.stderr.read)
+        self._pump = gevent.spawn(self._copy)
+
+    def _copy(self):
+        buf = self._process.stdout.read(Tarball.BUFFER_SIZE)
+        while buf:
+            self._dest.write(buf)
+            self.bytes_out += len(buf)
+            buf = self._process.stdout.read(Tarball.BUFFER_SIZE)
+
+    def write(self, data):
+        self._process.stdin.write(data)
+        self.bytes_in += len(data)
+
+    def close(self):
+        """Flush the compressor (dest is left open).
+
+        :raise TarError: if the compressor didn't return 0.
+        """
+
+        self._process.stdin.close()
+        ret = self._process.wait()
+        self._pump.get()
+        stderr = self._stderr.get()
+        self._process.stdout.close()
+        self._process.stderr.close()
+        if ret != 0:
+            raise TarError("{0} returned {1}: {2}".format(
+                self.codec, ret, stderr
+            ))
+
 class Tarball(object):
-    """Utility class around :mod:`gevent.subprocess` and the tar command."""
+    """Utility class around :mod:`gevent.subprocess` and the tar command.
+
+    The destination of a tarball can be a path, a file or any object with a
+    write method (e.g: the stdin of a command running in a container), so
+    tarballs can be streamed without touching the disk.
+    """
+
+    BUFFER_SIZE = 64 * 1024
 
     def __init__(self, dest, tar_process=None):
         self.dest = dest
         self._tar_process = tar_process
         self._stderr = gevent.spawn(tar_process.stderr.read)
+        self._pump = None
+        if tar_process.stdout and not isinstance(dest, basestring):
+            self._pump = gevent.spawn(self._copy, tar_process.stdout, dest)
 
     @classmethod
-    def create_from_files(cls, files, dest, root_dir=None):
-        # The companion method would be extract_from_stream but we don't need
-        # it (we are going to use tar directly inside the container).
+    def _copy(cls, source, dest):
+        buf = source.read(cls.BUFFER_SIZE)
+        while buf:
+            dest.write(buf)
+            buf = source.read(cls.BUFFER_SIZE)
+
+    @classmethod
+    def _create(cls, options, dest, root_dir, prefix, stdin=None):
         cmd = ["tar", "-cf"]
         if isinstance(dest, basestring):
             cmd.append(dest)
             stdout = None
         else:
             cmd.append("-")
-            stdout = dest
+            # Pump the output ourselves if dest isn't backed by a file:
+            stdout = dest if hasattr(dest, "fileno") else gevent.subprocess.PIPE
         if root_dir:
             cmd.extend(["-C", root_dir])
-        cmd.extend(files if isinstance(files, list) else [files])
+        if prefix:
+            # (But leave the targets of the symbolic links alone)
+            cmd.append(r"--transform=s,^\(\./\)\?,{0}/,S".format(prefix))
+        cmd.extend(options)
 
         tar = gevent.subprocess.Popen(
-            cmd, stdout=stdout, stderr=gevent.subprocess.PIPE
+            cmd, stdin=stdin, stdout=stdout, stderr=gevent.subprocess.PIPE
         )
         return cls(dest, tar)
 
+    @classmethod
+    def create_from_files(cls, files, dest, root_dir=None, prefix=None):
+        """Archive the given files (recursively).
+
+        :param prefix: directory under which the files are put in the
+                       tarball.
+        """
+
+        # The companion method would be extract_from_stream but we don't need
+        # it (we are going to use tar directly inside the container).
+        return cls._create(
+            files if isinstance(files, list) else [files],
+            dest, root_dir, prefix
+        )
+
+    @classmethod
+    def create_from_list(cls, paths, dest, root_dir=None, prefix=None):
+        """Archive exactly the given paths (relative to root_dir), not what's
+        under them if they are directories.
+
+        The list is given to tar on its stdin, so it can be arbitrarily long.
+        """
+
+        tarball = cls._create(
+            ["--null", "--no-recursion", "-T", "-"], dest, root_dir, prefix,
+            stdin=gevent.subprocess.PIPE
+        )
+        for path in paths:
+            tarball._tar_process.stdin.write(path + "\0")
+        tarball._tar_process.stdin.close()
+        return tarball
+
+    @staticmethod
+    def _header(name, size, mtime):
+        # Minimal ustar header for a regular file:
+        fields = [
+            name.ljust(100, "\0"),
+            "0000644\0",
+            "{0:07o}\0".format(os.getuid()),
+            "{0:07o}\0".format(os.getgid()),
+            "{0:011o}\0".format(size),
+            "{0:011o}\0".format(int(mtime)),
+            " " * 8, # checksum, computed with this field set to spaces
+            "0",
+            "\0" * 100,
+            "ustar\x0000",
+        ]
+        header = "".join(fields).ljust(512, "\0")
+        checksum = "{0:06o}\0 ".format(sum(ord(c) for c in header))
+        return header[:148] + checksum + header[156:]
+
+    @classmethod
+    def write_files(cls, files, dest):
+        """Write a tarball containing the given files (generated in memory)
+        to dest.
+
+        Tarballs can't simply be concatenated, extract a stream made of
+        several tarballs with ``tar --ignore-zeros``.
+
+        :param files: dictionary with the file names (shorter than 100
+                      characters) in keys and their content in values.
+        :param dest: file-like object, not closed.
+        """
+
+        mtime = time.time()
+        for name, content in sorted(files.iteritems()):
+            if len(name) >= 100:
+                raise TarError("File name too long: {0}".format(name))
+            dest.write(cls._header(name, len(content), mtime))
+            dest.write(content)
+            if len(content) % 512:
+                dest.write("\0" * (512 - len(content) % 512))
+        dest.write("\0" * 1024)
+
     def poll(self):
         """Poll the status of the tarball creation.
 
@@ -62,6 +251,8 @@ class Tarball(object):
             ret = self._tar_process.poll()
             if ret is None:
                 return False
+        if self._pump:
+            self._pump.get()
         stderr = self._stderr.get()
         # as in communicate:
         self._tar_process.stderr.close()
@@ -25,6 +25,10 @@ class TestBuilderCase(unittest.TestCase):
         self.code_dir = os.path.join(self.installdir, "code")
         self.current_dir = os.path.join(self.installdir, "current")
         self.path = os.path.dirname(__file__)
+        # The sdist is generated by setup.py, its content doesn't matter here:
+        Application.SANDBOX_SDIST = os.path.join(self.builddir, "sdist.tar.gz")
+        with open(Application.SANDBOX_SDIST, "w") as fp:
+            fp.write("Dummy sdist\n")
         self.application = Application(
             os.path.join(self.path, self.sources_path), {}
         )
@@ -37,10 +41,14 @@ class TestBuilderCase(unittest.TestCase):
             self.fail("Service {0} isn't defined in {1}".format(
                 self.service_name, self.sources_path
             ))
-        app_files = self.application._generate_application_tarball(self.builddir)
-        svc_tarball = self.service._generate_service_tarball(self.builddir, app_files)
+        self.application._scan()
+        app_files = self.application._generate_builder_files(self.builddir)
+        svc_tarball = os.path.join(self.builddir, "service.tar")
+        with open(svc_tarball, "w") as fp:
+            self.service._stream_service_tarball(fp, app_files)
+        # The stream is made of several tarballs:
         gevent.subprocess.check_call([
-            "tar", "-xf", svc_tarball.dest, "-C", self.installdir
+            "tar", "--ignore-zeros", "-xf", svc_tarball, "-C", self.installdir
         ])
         self.builder = Builder(self.installdir)
 
@@ -118,6 +126,27 @@ stderr_logfile={install_dir}/supervisor/api_error.log
         self.assertRegexpMatches(python_version, "^Python 2.7")
         self.assertIn("gunicorn", installed_packages)
 
+    def test_builder_dependencies(self):
+        if not find_executable("virtualenv"):
+            self.skipTest(
+                "You need to install python-virtualenv "
+                "to run the Python services unit tests"
+            )
+
+        self.assertEqual(self.builder.build(dependencies_only=True), 0)
+
+        stamp = os.path.join(self.installdir, "env", ".dependencies-digest")
+        self.assertTrue(os.path.exists(stamp))
+        self.assertFalse(os.path.exists(os.path.join(self.installdir, "supervisor.conf")))
+
+        # The virtualenv isn't re-created when the dependencies didn't change:
+        service_builder = get_service(
+            self.installdir, self.current_dir, self.builder._svc_definition
+        )
+        os.utime(stamp, (0, 0))
+        service_builder._install_dependencies()
+        self.assertEqual(os.stat(stamp).st_mtime, 0)
+
 class TestBuilderCustom(TestBuilderCase):
 
     sources_path = "custom_app"
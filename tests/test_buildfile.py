@@ -346,3 +346,58 @@ www:sdf:
             except SchemaError as e:
                 self.assertEqual(str(e), 'Invalid service name (must be <= 16 characters) "123456789abceswseefsdfsdf" in "dotcloud.yml", line 3, column 5')
                 raise
+
+    def test_timeouts(self):
+        build_file = '''
+www:
+    type: python
+    timeouts:
+        build: 7200
+'''
+        desc = load_build_file(build_file)
+        self.assertDictEqual(desc['www']['timeouts'], {'build': 7200})
+
+        build_file = '''
+www:
+    type: python
+    timeouts:
+        build: forever
+'''
+        with self.assertRaises(SchemaError):
+            load_build_file(build_file)
+
+    def test_limits(self):
+        build_file = '''
+www:
+    type: python
+    limits:
+        cpu_shares: 512
+        cpuset: 0-3
+        memory: 2G
+'''
+        desc = load_build_file(build_file)
+        self.assertDictEqual(desc['www']['limits'], {
+            'cpu_shares': 512, 'cpuset': '0-3', 'memory': '2G'
+        })
+
+        # Numbers are valid too (e.g: a single CPU, or a size in bytes):
+        build_file = '''
+www:
+    type: python
+    limits:
+        cpuset: 0
+        memory: 536870912
+'''
+        desc = load_build_file(build_file)
+        self.assertDictEqual(desc['www']['limits'], {
+            'cpuset': '0', 'memory': '536870912'
+        })
+
+        build_file = '''
+www:
+    type: python
+    limits:
+        memory: lots
+'''
+        with self.assertRaises(SchemaError):
+            load_build_file(build_file)
@@ -1,12 +1,24 @@
 # -*- coding: utf-8 -*-
 
 import logging; logging.basicConfig(level="DEBUG")
+import gevent
+import gevent.queue
+import os
 import random
 import string
+import tempfile
 import unittest
 
-from udotcloud.sandbox.containers import ImageRevSpec, Image
-from udotcloud.sandbox.exceptions import UnkownImageError
+from udotcloud.sandbox.containers import ImageRevSpec, Image, LineBuffer, Limits
+from udotcloud.sandbox.containers import configure_warm_pool, drain_warm_pool
+from udotcloud.sandbox.containers import _CLIBackend, _CountingWriter, _Metrics
+from udotcloud.sandbox.containers import _ScheduledBackend
+from udotcloud.sandbox.containers import _EventsWatcher, _ImageCatalog
+from udotcloud.sandbox.containers import _InspectBatcher, _deadline
+from udotcloud.sandbox.containers import _OutputTail, _Scheduler, _WarmPool
+from udotcloud.sandbox.exceptions import ContainerTimeoutError
+from udotcloud.sandbox.exceptions import DockerCommandError, UnkownImageError
+from udotcloud.sandbox.tarfile import Tarball
 
 class ContainerTestCase(unittest.TestCase):
 
@@ -57,6 +69,33 @@ class TestContainers(ContainerTestCase):
             pass
         self.assertIn("TOTO=POUET", self.container.logs)
 
+    def test_container_run_output(self):
+        lines = []
+        output = LineBuffer(lines.append)
+        with self.container.run(["/bin/sh", "-c", "echo tick; echo tack"], output=output):
+            pass
+        output.flush()
+        self.assertListEqual(lines, ["tick", "tack"])
+
+    def test_container_run_stdin_output(self):
+        lines = []
+        output = LineBuffer(lines.append)
+        with self.container.run(["cat"], stdin=self.container.PIPE, output=output) as cat:
+            cat.stdin.write("TRAVERSABLE WORMHOLE!\n")
+            cat.stdin.close()
+        self.assertListEqual(lines, ["TRAVERSABLE WORMHOLE!"])
+
+    def test_container_run_stdout_stderr(self):
+        out, err = [], []
+        with self.container.run(
+            ["/bin/sh", "-c", "echo tick; echo tack >&2"],
+            stdout=LineBuffer(out.append), stderr=LineBuffer(err.append)
+        ):
+            pass
+        self.assertListEqual(out, ["tick"])
+        self.assertListEqual(err, ["tack"])
+        self.assertIn("tack\n", self.container.logs)
+
     def test_container_as_user_stdin(self):
         with self.container.run(["/bin/ls", "/root"], as_user="nobody", stdin=self.container.PIPE) as ls:
             ls.stdin.close()
@@ -86,6 +125,16 @@ class TestContainers(ContainerTestCase):
             output = container.communicate()[0]
             self.assertIn("tick\n", output)
 
+    def test_run_stream_logs_errors(self):
+        errors = []
+        with self.container.run_stream_logs(
+            ["/bin/sh", "-c", "sleep 1; echo tick; echo tack >&2"],
+            output=self.container.PIPE, errors=errors.append
+        ) as container:
+            output = container.communicate()[0]
+        self.assertEqual(output, "tick\n")
+        self.assertEqual("".join(errors), "tack\n")
+
     def test_run_stream_logs_ports(self):
         with self.container.run_stream_logs(
             ["/bin/sh", "-c", "sleep 1; echo tick"],
@@ -110,3 +159,477 @@ class TestContainers(ContainerTestCase):
     def test_run_stream_logs_stop(self):
         with self.container.run_stream_logs(["cat", "/dev/zero"]):
             self.container.stop(wait=1)
+
+class TestBuildSession(ContainerTestCase):
+
+    def test_session_run(self):
+        with self.image.session() as session:
+            with session.run(["/bin/sh", "-c", "echo tick > /tmp/tick"]):
+                pass
+            self.assertEqual(session.exit_status, 0)
+            with session.run(["cat", "/tmp/tick"]):
+                pass
+            self.assertEqual(session.logs, "tick\n")
+            with session.run(["/bin/ls", "/root"], as_user="nobody"):
+                pass
+            self.assertIn("Permission denied", session.logs)
+            self.assertEqual(session.exit_status, 2)
+
+    def test_session_stdin_env(self):
+        with self.image.session() as session:
+            with session.run(["cat"], stdin=session.PIPE) as cat:
+                cat.stdin.write("TRAVERSABLE WORMHOLE!\n")
+                cat.stdin.close()
+            self.assertEqual(session.logs, "TRAVERSABLE WORMHOLE!\n")
+            with session.run(["/usr/bin/env"], env={"TOTO": "POUET"}):
+                pass
+            self.assertIn("TOTO=POUET", session.logs)
+
+    def test_session_commit(self):
+        with self.image.session() as session:
+            with session.run(["/bin/sh", "-c", "echo tick > /tmp/tick"]):
+                pass
+            self.container.result = session.commit(self.result_revspec)
+        self.assertEqual(self.container.result.revspec, self.result_revspec)
+        container = self.container.result.instantiate()
+        with container.run(["cat", "/tmp/tick"]):
+            pass
+        self.assertEqual(container.logs, "tick\r\n")
+
+    def test_session_warm_pool(self):
+        configure_warm_pool(1)
+        try:
+            self.image.warm()
+            gevent.sleep(1)
+            with self.image.session() as session:
+                with session.run(["true"]):
+                    pass
+                self.assertEqual(session.exit_status, 0)
+        finally:
+            drain_warm_pool()
+
+class TestImageCatalog(unittest.TestCase):
+
+    base = ImageRevSpec("lopter", "sandbox-base", "33b6d177c4bd", "latest")
+    anonymous = ImageRevSpec(None, None, "71bed3ad1135", None)
+
+    def setUp(self):
+        self.loads = 0
+        self.docker_images = [self.base, self.anonymous]
+        self.catalog = _ImageCatalog(load=self.load)
+
+    def load(self):
+        self.loads += 1
+        return list(self.docker_images)
+
+    def test_lookup_tag(self):
+        revspec = self.catalog.lookup(ImageRevSpec.parse("lopter/sandbox-base"))
+        self.assertTupleEqual(revspec, self.base)
+        revspec = self.catalog.lookup(ImageRevSpec.parse("lopter/sandbox-base:latest"))
+        self.assertTupleEqual(revspec, self.base)
+        self.assertEqual(self.loads, 1)
+
+    def test_lookup_revision(self):
+        revspec = self.catalog.lookup(ImageRevSpec.parse("71bed3ad1135"))
+        self.assertTupleEqual(revspec, self.anonymous)
+        revspec = self.catalog.lookup(ImageRevSpec.parse(
+            "lopter/sandbox-base:33b6d177c4bd5f2f3ae2ceaae5a6f29a5e0d4d0a6d0d0aa7cf6af2e1a8d2b3c1"
+        ))
+        self.assertTupleEqual(revspec, self.base)
+        self.assertListEqual(self.catalog.resolve_prefix("33b6"), ["33b6d177c4bd"])
+        self.assertEqual(self.loads, 1)
+
+    def test_lookup_miss_reloads(self):
+        self.catalog.lookup(self.base)
+        self.assertIsNone(self.catalog.lookup(ImageRevSpec.parse("foo/bar")))
+        self.assertEqual(self.loads, 2)
+        pulled = ImageRevSpec("foo", "bar", "aaaaaaaaaaaa", "latest")
+        self.docker_images.append(pulled)
+        self.assertTupleEqual(self.catalog.lookup(ImageRevSpec.parse("foo/bar")), pulled)
+        self.assertEqual(self.loads, 3)
+
+    def test_lookup_miss_reload_interval(self):
+        self.catalog.reload_interval = 60
+        self.catalog.lookup(self.base)
+        self.assertIsNone(self.catalog.lookup(ImageRevSpec.parse("foo/bar")))
+        self.assertIsNone(self.catalog.lookup(ImageRevSpec.parse("foo/baz")))
+        self.assertEqual(self.loads, 1)
+        self.catalog.reload_interval = 0
+        self.assertIsNone(self.catalog.lookup(ImageRevSpec.parse("foo/bar")))
+        self.assertEqual(self.loads, 2)
+
+    def test_add_tag(self):
+        self.catalog.lookup(self.base)
+        commited = ImageRevSpec(None, "app-www", "bbbbbbbbbbbb", "ts-42")
+        self.catalog.add(commited)
+        self.catalog.add(ImageRevSpec(*(commited[:-1] + ("latest",))))
+        revspec = self.catalog.lookup(ImageRevSpec.parse("app-www:ts-42"))
+        self.assertTupleEqual(revspec, commited)
+        revspec = self.catalog.lookup(ImageRevSpec.parse("app-www:latest"))
+        self.assertEqual(revspec.revision, "bbbbbbbbbbbb")
+        # Move latest to a new build:
+        self.catalog.add(ImageRevSpec(None, "app-www", "cccccccccccc", "latest"))
+        revspec = self.catalog.lookup(ImageRevSpec.parse("app-www:latest"))
+        self.assertEqual(revspec.revision, "cccccccccccc")
+        self.assertEqual(self.loads, 1)
+
+    def test_remove(self):
+        self.catalog.lookup(self.base)
+        self.catalog.remove(self.anonymous.revision)
+        self.docker_images.remove(self.anonymous)
+        self.assertIsNone(self.catalog.lookup(self.anonymous))
+        self.assertListEqual(self.catalog.resolve_prefix("71"), [])
+
+class TestOutput(unittest.TestCase):
+
+    def test_line_buffer(self):
+        lines = []
+        output = LineBuffer(lines.append, max_length=8)
+        output("tick\r\nta")
+        self.assertListEqual(lines, ["tick"])
+        output("ck\n")
+        self.assertListEqual(lines, ["tick", "tack"])
+        output("0123456789")
+        self.assertListEqual(lines, ["tick", "tack", "01234567"])
+        output.flush()
+        self.assertListEqual(lines, ["tick", "tack", "01234567", "89"])
+
+    def test_output_tail(self):
+        tail = _OutputTail(10)
+        for i in xrange(100):
+            tail.write("{0:02}\n".format(i))
+        self.assertEqual(tail.getvalue(), "\n97\n98\n99\n")
+        self.assertEqual(tail.total, 300)
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = _Scheduler(jobs=1)
+        self.order = []
+
+    def operation(self, name, duration=0.01):
+        with self.scheduler.slot(name):
+            self.order.append(name)
+            gevent.sleep(duration)
+
+    def test_limits(self):
+        running = []
+        def commit():
+            with self.scheduler.slot("commit"):
+                running.append(1)
+                self.assertEqual(len(running), 1)
+                gevent.sleep(0.01)
+                running.pop()
+        gevent.joinall(
+            [gevent.spawn(commit) for i in xrange(5)], raise_error=True
+        )
+        stats = self.scheduler.stats()["commit"]
+        self.assertEqual(stats["calls"], 5)
+        self.assertEqual(stats["queued"], 4)
+        self.assertGreater(stats["max_wait"], 0)
+
+    def test_cheap_operations(self):
+        # The limit for heavy operations doesn't apply to inspect:
+        greenlets = [gevent.spawn(self.operation, "commit", 0.05)]
+        greenlets.extend(gevent.spawn(self.operation, "inspect") for i in xrange(3))
+        gevent.joinall(greenlets, raise_error=True)
+        self.assertEqual(self.scheduler.stats()["inspect"]["queued"], 0)
+
+    def test_priorities(self):
+        self.scheduler.configure(jobs=1, limits={"stop": 1})
+        self.scheduler._total_limit = 1
+        greenlets = [gevent.spawn(self.operation, "run")]
+        greenlets.append(gevent.spawn(self.operation, "commit"))
+        greenlets.append(gevent.spawn(self.operation, "stop"))
+        gevent.joinall(greenlets, raise_error=True)
+        self.assertListEqual(self.order, ["run", "stop", "commit"])
+
+class TestEventsWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.events = gevent.queue.Queue()
+        self.subscriptions = []
+        self.watcher = _EventsWatcher(self.subscribe)
+
+    def tearDown(self):
+        self.watcher.close()
+
+    def subscribe(self, since):
+        self.subscriptions.append(since)
+        return self.events
+
+    def test_exited(self):
+        exited = self.watcher.exited("c0ffee" * 10)
+        self.events.put(("start", "c0ffee" * 10, None))
+        gevent.sleep(0)
+        self.assertFalse(exited.ready())
+        # The docker command only outputs the short ids:
+        self.events.put(("die", "c0ffeec0ffee", None))
+        exited.get(timeout=1)
+        self.assertEqual(len(self.subscriptions), 1)
+
+    def test_exited_before_wait(self):
+        self.watcher.exited("deadbeef" * 8)
+        self.events.put(("die", "c0ffee" * 10, None))
+        gevent.sleep(0)
+        self.assertTrue(self.watcher.exited("c0ffee" * 10).ready())
+        self.assertTrue(self.watcher.exited("c0ffee" * 10).ready())
+
+    def test_reconnect(self):
+        streams = [
+            iter([("start", "c0ffee" * 10, 1400000000)]),
+            DockerCommandError("Connection reset by peer"),
+            iter([("die", "c0ffee" * 10, 1400000042)])
+        ]
+        subscriptions = []
+        def subscribe(since):
+            subscriptions.append(since)
+            stream = streams.pop(0)
+            if isinstance(stream, Exception):
+                raise stream
+            return stream
+        watcher = _EventsWatcher(subscribe)
+        watcher.RETRY_DELAY = 0.001
+        exited = watcher.exited("c0ffee" * 10)
+        exited.get(timeout=1)
+        # Followed again from the time of the last event:
+        self.assertEqual(subscriptions[1:], [1399999999, 1399999999])
+        watcher.close()
+
+    def test_error(self):
+        subscriptions = []
+        def subscribe(since):
+            subscriptions.append(since)
+            raise DockerCommandError("Docker is down")
+        watcher = _EventsWatcher(subscribe)
+        watcher.RETRY_DELAY = 0.001
+        exited = watcher.exited("c0ffee" * 10)
+        with self.assertRaises(DockerCommandError):
+            exited.get(timeout=1)
+        self.assertEqual(len(subscriptions), watcher.MAX_FAILURES)
+        watcher.close()
+
+class TestCLIBackend(unittest.TestCase):
+
+    def test_parse_event(self):
+        container_id = "4386fb97867d" + "0" * 52
+        self.assertEqual(_CLIBackend._parse_event(
+            '{"status":"die","id":"%s","from":"ubuntu","Type":"container",'
+            '"Action":"die","Actor":{"ID":"%s"},"time":1400000000}' % (
+                container_id, container_id
+            )
+        ), ("die", container_id, 1400000000))
+        self.assertIsNone(_CLIBackend._parse_event(
+            '{"Type":"network","Action":"connect","Actor":{"ID":"abcd"}}'
+        ))
+        # Docker < 1.10:
+        self.assertEqual(_CLIBackend._parse_event(
+            "[2014-05-13 15:04:05 +0200 CEST] 4386fb97867d: (from ubuntu:14.04) die"
+        ), ("die", "4386fb97867d", None))
+        # Docker >= 1.10, without --format:
+        self.assertEqual(_CLIBackend._parse_event(
+            "2016-03-01T12:00:00.000000000+01:00 container die %s "
+            "(exitCode=0, image=ubuntu, name=jolly_bell)" % container_id
+        ), ("die", container_id, None))
+        self.assertIsNone(_CLIBackend._parse_event("garbage"))
+
+class TestInspectBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.batcher = _InspectBatcher(self.inspect_many, self.inspect)
+
+    def inspect(self, container_id):
+        if container_id == "missing":
+            raise DockerCommandError("No such container: missing")
+        return {"Id": container_id}
+
+    def inspect_many(self, container_ids):
+        self.batches.append(container_ids)
+        return [self.inspect(container_id) for container_id in container_ids]
+
+    def test_batch(self):
+        results = [self.batcher.inspect(c) for c in ["a", "b", "a", "c"]]
+        self.assertListEqual(
+            [result.get(timeout=1)["Id"] for result in results],
+            ["a", "b", "a", "c"]
+        )
+        self.assertListEqual(self.batches, [["a", "b", "c"]])
+        self.batcher.inspect("d").get(timeout=1)
+        self.assertEqual(len(self.batches), 2)
+
+    def test_error(self):
+        found = self.batcher.inspect("a")
+        missing = self.batcher.inspect("missing")
+        self.assertEqual(found.get(timeout=1), {"Id": "a"})
+        with self.assertRaises(DockerCommandError):
+            missing.get(timeout=1)
+
+class TestDeadline(unittest.TestCase):
+
+    def test_expired(self):
+        expired = []
+        with self.assertRaises(ContainerTimeoutError):
+            with _deadline(0.01, ["sleep", "1"], lambda: expired.append(1)):
+                gevent.sleep(1)
+        self.assertListEqual(expired, [1])
+
+    def test_in_time(self):
+        with _deadline(1, ["true"], self.fail):
+            gevent.sleep(0)
+        with _deadline(None, ["true"], self.fail):
+            gevent.sleep(0.01)
+        gevent.sleep(0.01)
+
+class TestLimits(unittest.TestCase):
+
+    def test_merge(self):
+        limits = Limits(cpu_shares=1024, memory=1024 ** 3)
+        merged = limits.merge(Limits(cpuset="0-3", memory=512 * 1024 ** 2))
+        self.assertEqual(merged, Limits(1024, "0-3", 512 * 1024 ** 2))
+        self.assertEqual(limits.merge(Limits()), limits)
+
+    def test_host_defaults(self):
+        limits = Limits.host_defaults(1)
+        self.assertIsNone(limits.cpu_shares)
+        self.assertGreaterEqual(limits.memory, Limits.MIN_MEMORY)
+        self.assertEqual(Limits.host_defaults(10 ** 6).memory, Limits.MIN_MEMORY)
+
+    def test_host_defaults_cpuset(self):
+        class HostLimits(Limits):
+            cpus = 8
+            @classmethod
+            def _host_cpus(cls):
+                return cls.cpus
+        docker_host = os.environ.pop("DOCKER_HOST", None)
+        try:
+            self.assertEqual(HostLimits.host_defaults(4).cpuset, "1-7")
+            HostLimits.cpus = 2
+            self.assertIsNone(HostLimits.host_defaults(4).cpuset)
+            HostLimits.cpus = None
+            self.assertIsNone(HostLimits.host_defaults(4).cpuset)
+            # The CPUs of a remote daemon are unknown:
+            HostLimits.cpus = 8
+            os.environ["DOCKER_HOST"] = "tcp://10.0.0.1:4243"
+            self.assertIsNone(HostLimits.host_defaults(4).cpuset)
+        finally:
+            os.environ.pop("DOCKER_HOST", None)
+            if docker_host is not None:
+                os.environ["DOCKER_HOST"] = docker_host
+
+    def test_cli_options(self):
+        self.assertListEqual(_CLIBackend._generate_limits_option_list(None), [])
+        self.assertListEqual(
+            _CLIBackend._generate_limits_option_list(Limits(512, "0,2", 1024)),
+            ["-c", "512", "--cpuset=0,2", "-m", "1024"]
+        )
+
+class TestWarmPool(unittest.TestCase):
+
+    def setUp(self):
+        self.started = []
+        self.destroyed = []
+        def start(revision, limits):
+            gevent.sleep(0)
+            self.started.append((revision, limits))
+            return "{0}-{1}".format(revision, len(self.started))
+        self.pool = _WarmPool(start, self.destroyed.append, size=2)
+
+    def test_disabled(self):
+        self.pool.size = 0
+        self.pool.fill("abc")
+        self.assertIsNone(self.pool.acquire("abc"))
+        gevent.sleep(0.01)
+        self.assertListEqual(self.started, [])
+
+    def test_acquire_refills(self):
+        self.assertIsNone(self.pool.acquire("abc"))
+        gevent.sleep(0.01)
+        self.assertEqual(len(self.started), 2)
+        self.assertEqual(self.pool.acquire("abc"), "abc-1")
+        gevent.sleep(0.01)
+        self.assertEqual(len(self.started), 3)
+        # The limits are part of the key:
+        self.assertIsNone(self.pool.acquire("abc", Limits(memory=1024)))
+
+    def test_fill_count(self):
+        self.pool.fill("abc", count=3)
+        self.pool.fill("abc", count=3)
+        gevent.sleep(0.01)
+        self.assertEqual(len(self.started), 3)
+
+    def test_drain(self):
+        self.pool.fill("abc")
+        self.pool.drain()
+        self.assertEqual(self.pool.size, 0)
+        self.assertListEqual(sorted(self.destroyed), ["abc-1", "abc-2"])
+        self.assertIsNone(self.pool.acquire("abc"))
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = _Metrics()
+
+    def test_histogram(self):
+        commit = self.metrics.operation("commit")
+        for duration in [0.001, 0.2, 0.3, 2, 1000]:
+            commit.record(duration)
+        commit.record(0.4, error=True)
+        self.assertEqual(commit.calls, 6)
+        self.assertEqual(commit.errors, 1)
+        self.assertEqual(commit.max_duration, 1000)
+        self.assertEqual(commit.percentile(50), 0.5)
+        self.assertEqual(commit.percentile(100), float("inf"))
+        histogram = commit.as_dict()["histogram"]
+        self.assertEqual(histogram[0], {"le": 0.01, "count": 1})
+        self.assertEqual(histogram[-1], {"le": "+Inf", "count": 1})
+
+    def test_counting_writer(self):
+        transfer = self.metrics.operation("run")
+        with tempfile.TemporaryFile() as fp:
+            dest = _CountingWriter(fp, transfer)
+            # Tarball gives the fd to tar when dest has one:
+            self.assertFalse(hasattr(dest, "fileno"))
+            tarball = Tarball.create_from_files(
+                "__init__.py", dest, os.path.dirname(__file__)
+            )
+            tarball.wait()
+            dest.flush()
+            self.assertEqual(transfer.bytes, os.fstat(fp.fileno()).st_size)
+        self.assertGreater(transfer.bytes, 0)
+
+    def test_scopes(self):
+        with self.metrics.scope("www"):
+            self.metrics.operation("run").record(1)
+            self.metrics.operation("run").add_bytes(42)
+            self.metrics.operation("command").add_exit_status(1)
+        self.metrics.operation("run").record(2)
+        greenlet = gevent.spawn(self.metrics.operation("inspect").record, 1)
+        with self.metrics.scope("api"):
+            greenlet.join() # not accounted to api
+        operations = self.metrics.operations()
+        self.assertEqual(operations["run"].calls, 2)
+        self.assertEqual(operations["run"].bytes, 42)
+        scopes = self.metrics.scopes()
+        self.assertEqual(scopes["www"]["run"].calls, 1)
+        self.assertEqual(scopes["www"]["command"].exit_statuses, {1: 1})
+        self.assertEqual(scopes[None]["run"].calls, 1)
+        self.assertIn("inspect", scopes[None])
+        self.assertNotIn("api", scopes)
+
+    def test_scheduled_backend(self):
+        class Backend(object):
+            name = "fake"
+            def commit(self):
+                return "abc"
+            def kill(self):
+                raise DockerCommandError("no such container")
+        backend = _ScheduledBackend(Backend(), _Scheduler(1), self.metrics)
+        self.assertEqual(backend.name, "fake")
+        self.assertEqual(backend.commit(), "abc")
+        with self.assertRaises(DockerCommandError):
+            backend.kill()
+        operations = self.metrics.operations()
+        self.assertEqual(operations["commit"].calls, 1)
+        self.assertEqual(operations["commit"].errors, 0)
+        self.assertEqual(operations["kill"].errors, 1)
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+import logging; logging.basicConfig(level="DEBUG")
+import errno
+import gevent
+import gevent.server
+import gevent.socket
+import httplib
+import json
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import unittest
+
+from udotcloud.sandbox import dockerapi
+from udotcloud.sandbox.exceptions import DockerCommandError, DockerNotFoundError
+
+class FakeDocker(object):
+    """Answer HTTP/1.1 requests on a unix socket with canned responses."""
+
+    def __init__(self, path, routes):
+        self.routes = routes
+        #: Close the connections after each response (without telling).
+        self.drop_idle = False
+        self.connections = 0
+        self.requests = []
+        listener = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(16)
+        self.server = gevent.server.StreamServer(listener, self._handle)
+        self.server.start()
+
+    def _handle(self, sock, address):
+        self.connections += 1
+        fp = sock.makefile()
+        while True:
+            request_line = fp.readline()
+            if not request_line:
+                break
+            headers = {}
+            line = fp.readline()
+            while line not in ("\r\n", ""):
+                key, value = line.split(":", 1)
+                headers[key.lower()] = value.strip()
+                line = fp.readline()
+            body = fp.read(int(headers.get("content-length", 0)))
+            method, path = request_line.split()[:2]
+            self.requests.append((method, path, body))
+            status, data = self.routes.get(
+                (method, path.split("?")[0]), (404, "no such route")
+            )
+            if status == 101:
+                sock.sendall("HTTP/1.1 101 UPGRADED\r\n\r\n" + data)
+                break
+            if isinstance(data, list): # chunked
+                sock.sendall(
+                    "HTTP/1.1 {0} Whatever\r\n"
+                    "Transfer-Encoding: chunked\r\n\r\n".format(status)
+                )
+                for chunk in data:
+                    sock.sendall("{0:x}\r\n{1}\r\n".format(len(chunk), chunk))
+                sock.sendall("0\r\n\r\n")
+                continue
+            sock.sendall(
+                "HTTP/1.1 {0} Whatever\r\nContent-Length: {1}\r\n\r\n"
+                "{2}".format(status, len(data), data)
+            )
+            if self.drop_idle:
+                break
+        fp.close()
+        sock.close()
+
+    def stop(self):
+        self.server.stop()
+
+class TestDockerAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="udotcloud", suffix="tests")
+        self.path = os.path.join(self.tmpdir, "docker.sock")
+        self.docker = FakeDocker(self.path, {
+            ("GET", "/images/json"): (200, json.dumps([
+                {"Id": "33b6d177c4bd", "RepoTags": ["lopter/sandbox-base:latest"]}
+            ])),
+            ("POST", "/containers/create"): (201, json.dumps({"Id": "c0ffee"})),
+            ("POST", "/containers/c0ffee/wait"): (200, json.dumps({"StatusCode": 42})),
+            ("DELETE", "/containers/c0ffee"): (204, ""),
+            ("POST", "/containers/c0ffee/attach"): (101, "".join([
+                struct.pack(">BxxxL", dockerapi.STDOUT, 5), "hello",
+                struct.pack(">BxxxL", dockerapi.STDERR, 6), " world"
+            ])),
+            ("POST", "/containers/c0ffee/exec"): (201, json.dumps({"Id": "e1"})),
+            ("POST", "/exec/e1/start"): (101, struct.pack(
+                ">BxxxL", dockerapi.STDOUT, 5
+            ) + "tick\n"),
+            ("GET", "/exec/e1/json"): (200, json.dumps({
+                "Running": False, "ExitCode": 0
+            })),
+            ("GET", "/events"): (200, [
+                json.dumps({"status": "start", "id": "c0ffee"}),
+                json.dumps({"status": "die", "id": "c0ffee"})[:10],
+                json.dumps({"status": "die", "id": "c0ffee"})[10:]
+            ])
+        })
+        self.pool = dockerapi.ConnectionPool(self.path, size=2)
+        self.client = dockerapi.Client(self.pool)
+
+    def tearDown(self):
+        self.pool.close()
+        self.docker.stop()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_images(self):
+        images = self.client.images()
+        self.assertEqual(images[0]['RepoTags'], ["lopter/sandbox-base:latest"])
+
+    def test_keep_alive(self):
+        self.client.images()
+        self.assertEqual(self.client.create_container({})['Id'], "c0ffee")
+        self.assertEqual(self.client.wait("c0ffee"), 42)
+        self.client.remove_container("c0ffee")
+        self.assertEqual(len(self.docker.requests), 4)
+        self.assertEqual(self.docker.connections, 1)
+
+    def test_pool_size(self):
+        gevent.joinall([
+            gevent.spawn(self.client.images) for i in xrange(10)
+        ], raise_error=True)
+        self.assertEqual(len(self.docker.requests), 10)
+        self.assertLessEqual(self.docker.connections, 2)
+
+    def test_idle_connection_closed(self):
+        self.docker.drop_idle = True
+        self.client.images()
+        gevent.sleep(0.01)
+        self.assertEqual(self.client.create_container({})['Id'], "c0ffee")
+        gevent.sleep(0.01)
+        self.client.images()
+        self.assertEqual(len(self.docker.requests), 3)
+        self.assertEqual(self.docker.connections, 3)
+
+    def test_can_retry(self):
+        reset = socket.error(errno.ECONNRESET, "Connection reset by peer")
+        can_retry = dockerapi.Client._can_retry
+        self.assertTrue(can_retry("POST", None, False, reset))
+        self.assertTrue(can_retry("GET", None, True, reset))
+        self.assertFalse(can_retry("POST", "{}", True, reset))
+        self.assertTrue(can_retry("POST", "{}", True, httplib.BadStatusLine("")))
+        with tempfile.TemporaryFile() as fp:
+            self.assertTrue(can_retry("POST", fp, False, reset))
+
+        class Stream(object):
+            def read(self, size=-1):
+                return ""
+
+        self.assertFalse(can_retry("POST", Stream(), False, reset))
+
+    def test_error(self):
+        with self.assertRaises(DockerCommandError):
+            self.client.inspect_container("deadbeef")
+        # The connection can still be used after an error:
+        self.client.images()
+        self.assertEqual(self.docker.connections, 1)
+
+    def test_create_body(self):
+        self.client.create_container({"Image": "33b6d177c4bd", "Cmd": ["pwd"]})
+        method, path, body = self.docker.requests[0]
+        self.assertEqual(json.loads(body)['Cmd'], ["pwd"])
+
+    def test_attach(self):
+        stream = self.client.attach("c0ffee")
+        self.assertListEqual(list(stream.frames()), [
+            (dockerapi.STDOUT, "hello"), (dockerapi.STDERR, " world")
+        ])
+        stream.close()
+
+    def test_exec(self):
+        exec_id = self.client.exec_create("c0ffee", {"Cmd": ["echo", "tick"]})
+        stream = self.client.exec_start(exec_id)
+        self.assertEqual(stream.read(), "tick\n")
+        stream.close()
+        self.assertEqual(self.client.exec_inspect(exec_id)['ExitCode'], 0)
+        method, path, body = self.docker.requests[-2]
+        self.assertEqual(json.loads(body), {"Detach": False, "Tty": False})
+
+    def test_events(self):
+        stream = self.client.events(since=1234)
+        self.assertListEqual(list(stream), [
+            {"status": "start", "id": "c0ffee"},
+            {"status": "die", "id": "c0ffee"}
+        ])
+        stream.close()
+        method, path, body = self.docker.requests[-1]
+        self.assertEqual(path, "/events?since=1234")
+
+    def test_demultiplex(self):
+        data = struct.pack(">BxxxL", dockerapi.STDERR, 3) + "abc"
+        self.assertListEqual(
+            list(dockerapi.demultiplex(data)), [(dockerapi.STDERR, "abc")]
+        )
+
+    def test_docker_not_found(self):
+        client = dockerapi.Client(dockerapi.ConnectionPool(
+            os.path.join(self.tmpdir, "nothing-here.sock")
+        ))
+        with self.assertRaises(DockerNotFoundError):
+            client.images()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from udotcloud.sandbox.ignore import IgnoreRules
+
+class TestIgnoreRules(unittest.TestCase):
+
+    def test_no_rules(self):
+        rules = IgnoreRules()
+        self.assertEqual(len(rules), 0)
+        self.assertFalse(rules.match("wsgi.py"))
+
+    def test_comments(self):
+        rules = IgnoreRules(["# comment\n", "\n", "\\#notes\n"])
+        self.assertEqual(len(rules), 1)
+        self.assertTrue(rules.match("#notes"))
+
+    def test_basename(self):
+        rules = IgnoreRules(["*.pyc", "node_modules/"])
+        self.assertTrue(rules.match("wsgi.pyc"))
+        self.assertTrue(rules.match("lib/utils.pyc"))
+        self.assertFalse(rules.match("wsgi.py"))
+        self.assertTrue(rules.match("node_modules", is_dir=True))
+        self.assertTrue(rules.match("static/node_modules", is_dir=True))
+        self.assertFalse(rules.match("node_modules"))
+
+    def test_anchored(self):
+        rules = IgnoreRules(["/data", "doc/build"])
+        self.assertTrue(rules.match("data", is_dir=True))
+        self.assertFalse(rules.match("lib/data", is_dir=True))
+        self.assertTrue(rules.match("doc/build", is_dir=True))
+        self.assertFalse(rules.match("lib/doc/build", is_dir=True))
+
+    def test_wildcards(self):
+        rules = IgnoreRules(["**/cache", "logs/**", "a/**/b", "*.sw[op]", "?.tmp"])
+        self.assertTrue(rules.match("cache"))
+        self.assertTrue(rules.match("x/y/cache"))
+        self.assertTrue(rules.match("logs/2013/01.log"))
+        self.assertFalse(rules.match("logs", is_dir=True))
+        self.assertTrue(rules.match("a/b"))
+        self.assertTrue(rules.match("a/x/y/b"))
+        self.assertTrue(rules.match(".wsgi.py.swp"))
+        self.assertFalse(rules.match(".wsgi.py.swx"))
+        self.assertTrue(rules.match("1.tmp"))
+        self.assertFalse(rules.match("12.tmp"))
+        self.assertFalse(rules.match("lib/x/1.tmpl"))
+
+    def test_negation(self):
+        rules = IgnoreRules(["*.log", "!important.log"])
+        self.assertTrue(rules.match("debug.log"))
+        self.assertFalse(rules.match("important.log"))
+        rules = IgnoreRules(["!important.log", "*.log"])
+        self.assertTrue(rules.match("important.log"))
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import gevent
+import os
+import shutil
+import tempfile
+import unittest
+
+from udotcloud.sandbox.ignore import IgnoreRules
+from udotcloud.sandbox.inotify import Inotify
+
+class TestInotify(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="sandbox-test-inotify-")
+        os.mkdir(os.path.join(self.root, "lib"))
+        os.mkdir(os.path.join(self.root, "node_modules"))
+        self.inotify = Inotify(self.root, IgnoreRules(["*.pyc", "node_modules/"]))
+
+    def tearDown(self):
+        self.inotify.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write(self, path):
+        with open(os.path.join(self.root, path), "w") as fp:
+            fp.write(path)
+
+    def changes(self, debounce=0.1):
+        with gevent.Timeout(5):
+            return next(self.inotify.changes(debounce))[0]
+
+    def test_changes(self):
+        self.write("wsgi.py")
+        self.write("lib/utils.py")
+        self.assertEqual(self.changes(), {"wsgi.py", "lib/utils.py"})
+        os.unlink(os.path.join(self.root, "wsgi.py"))
+        self.assertEqual(self.changes(), {"wsgi.py"})
+
+    def test_ignored(self):
+        self.write("lib/utils.pyc")
+        self.write("node_modules/index.js")
+        self.write("lib/utils.py")
+        self.assertEqual(self.changes(), {"lib/utils.py"})
+
+    def test_new_directory(self):
+        os.makedirs(os.path.join(self.root, "static/css"))
+        self.assertEqual(self.changes(), {"static", "static/css"})
+        self.write("static/css/style.css")
+        self.assertEqual(self.changes(), {"static/css/style.css"})
+
+    def test_debounce(self):
+        def write_later():
+            for i in range(3):
+                gevent.sleep(0.05)
+                self.write("{0}.py".format(i))
+        writer = gevent.spawn(write_later)
+        self.assertEqual(self.changes(0.2), {"0.py", "1.py", "2.py"})
+        writer.join()
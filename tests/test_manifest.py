@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from udotcloud.sandbox.ignore import IgnoreRules
+from udotcloud.sandbox.manifest import Manifest
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="udotcloud", suffix="tests")
+        os.mkdir(os.path.join(self.root, "lib"))
+        self._write("wsgi.py", "application = None\n")
+        self._write("lib/utils.py", "pass\n")
+        os.symlink("wsgi.py", os.path.join(self.root, "app.py"))
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _write(self, path, content, mtime=None):
+        path = os.path.join(self.root, path)
+        with open(path, "w") as fp:
+            fp.write(content)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def test_scan(self):
+        manifest = Manifest.scan(self.root)
+        self.assertEqual(len(manifest), 3)
+        self.assertItemsEqual(
+            manifest.entries.keys(), ["wsgi.py", "lib/utils.py", "app.py"]
+        )
+        self.assertNotEqual(manifest.digest("app.py"), manifest.digest("wsgi.py"))
+
+    def test_scan_ignore(self):
+        os.mkdir(os.path.join(self.root, "data"))
+        self._write("data/dump.sql", "x" * 4096)
+        self._write("lib/utils.pyc", "\0" * 10)
+        ignore = IgnoreRules(["/data", "*.pyc"])
+        manifest = Manifest.scan(self.root, ignore)
+        self.assertItemsEqual(
+            manifest.entries.keys(), ["wsgi.py", "lib/utils.py", "app.py"]
+        )
+        self.assertEqual(manifest.directories, ["lib"])
+        self.assertDictEqual(manifest.ignored, {
+            "data": None, "lib/utils.pyc": 10
+        })
+        manifest = Manifest.scan(self.root, ignore, measure_ignored=True)
+        self.assertDictEqual(manifest.ignored, {
+            "data": 4096, "lib/utils.pyc": 10
+        })
+        self.assertEqual(
+            manifest.paths(), ["app.py", "lib", "lib/utils.py", "wsgi.py"]
+        )
+
+    def test_diff(self):
+        previous = Manifest.loads(Manifest.scan(self.root).dumps())
+        self._write("wsgi.py", "application = True\n")
+        self._write("README", "Hello\n")
+        os.unlink(os.path.join(self.root, "lib/utils.py"))
+        changed, deleted = Manifest.scan(self.root).diff(previous)
+        self.assertEqual(changed, ["README", "wsgi.py"])
+        self.assertEqual(deleted, ["lib/utils.py"])
+
+    def test_diff_same_content(self):
+        previous = Manifest.scan(self.root)
+        previous.dumps()
+        # Touched but not modified:
+        self._write("lib/utils.py", "pass\n", time.time() + 60)
+        changed, deleted = Manifest.scan(self.root).diff(previous)
+        self.assertEqual(changed, [])
+        self.assertEqual(deleted, [])
+
+    def test_diff_reuses_digests(self):
+        previous = Manifest.scan(self.root)
+        previous.entries["wsgi.py"][2] = "0" * 40
+        # Same size and mtime: wsgi.py isn't read, and the (wrong) digest of the
+        # previous manifest is adopted.
+        manifest = Manifest.scan(self.root)
+        self.assertEqual(manifest.diff(previous), ([], []))
+        self.assertEqual(manifest.digest("wsgi.py"), "0" * 40)
+
+    def test_reuse_digests(self):
+        previous = Manifest.scan(self.root)
+        previous.entries["wsgi.py"][2] = "0" * 40
+        previous.entries["app.py"][2] = "1" * 40
+        previous = Manifest.loads(previous.dumps(computed_only=True))
+        self.assertItemsEqual(previous.entries.keys(), ["wsgi.py", "app.py"])
+        self._write("wsgi.py", "application = True\n", time.time() + 60)
+        manifest = Manifest.scan(self.root)
+        manifest.reuse_digests(previous)
+        self.assertEqual(manifest.entries["app.py"][2], "1" * 40)
+        self.assertIsNone(manifest.entries["wsgi.py"][2])
+        self.assertIsNone(manifest.entries["lib/utils.py"][2])
@@ -1,15 +1,22 @@
 # -*- coding: utf-8 -*-
 
+import collections
 import contextlib
+import gevent
 import logging; logging.basicConfig(level="DEBUG")
 import json
 import os
 import shutil
+import tarfile
 import tempfile
 import unittest
 import yaml
 
-from udotcloud.sandbox import Application
+from udotcloud.sandbox import Application, sources
+from udotcloud.sandbox.exceptions import ContainerTimeoutError
+from udotcloud.sandbox.exceptions import UnkownImageError
+from udotcloud.sandbox.sources import _LayerCache, _StageScheduler
+from udotcloud.sandbox.sources import _running_in_ci, build_applications
 from udotcloud.sandbox.containers import ImageRevSpec, Image
 
 from test_containers import ContainerTestCase
@@ -20,10 +27,30 @@ def _destroy_result(container):
     if container.result:
         container.result.destroy()
 
+class _FakeContainer(object):
+
+    def __init__(self):
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+class _FakeImage(object):
+
+    def __init__(self, session):
+        self._session = session
+
+    @contextlib.contextmanager
+    def session(self, limits=None):
+        yield self._session
+
 class TestApplication(unittest.TestCase):
 
     def setUp(self):
         self.path = os.path.dirname(__file__)
+        self.manifests_dir = tempfile.mkdtemp(prefix="udotcloud", suffix="tests")
+        self.addCleanup(shutil.rmtree, self.manifests_dir, ignore_errors=True)
+        Application.MANIFESTS_DIR = self.manifests_dir
 
     def test_load_simple_application(self):
         application = Application(os.path.join(self.path, "simple_python_app"), {})
@@ -43,6 +70,129 @@ class TestApplication(unittest.TestCase):
         application = Application(os.path.join(self.path, "custom_app"), {})
         self.assertListEqual(application.services[0].systempackages, ["cmake"])
 
+    def test_local_requirements(self):
+        application = Application(os.path.join(self.path, "simple_gunicorn_gevent_app"), {})
+        service = application.services[0]
+        self.assertIn("gunicorn", service._read_requirements())
+        for line in ["-e .", "-r base.txt", "./libs/foo", "file:///tmp/foo"]:
+            self.assertTrue(service._LOCAL_REQUIREMENT_RE.match(line))
+        for line in ["gevent==1.0", "# -e ."]:
+            self.assertFalse(service._LOCAL_REQUIREMENT_RE.match(line))
+
+    def test_upstream_digest(self):
+        application = Application(os.path.join(self.path, "double_gunicorn"), {})
+        api, www = application.services
+        self.assertEqual(api._upstream_digest(), www._upstream_digest())
+        www.systempackages = ["cmake"]
+        self.assertNotEqual(api._upstream_digest(), www._upstream_digest())
+
+    def test_inputs_digest(self):
+        application = Application(os.path.join(self.path, "simple_gunicorn_gevent_app"), {})
+        application.builder_digest = "42"
+        service = application.services[0]
+        base_image = collections.namedtuple("Image", ["revision"])("abcd")
+        manifest = application._scan()
+        digest = service._inputs_digest(base_image, manifest, False)
+        self.assertEqual(digest, service._inputs_digest(base_image, manifest, False))
+        self.assertNotEqual(digest, service._inputs_digest(base_image, manifest, True))
+        # e.g: a fresh checkout, only the content of the files matters:
+        manifest.entries["requirements.txt"][1] += 1
+        self.assertEqual(digest, service._inputs_digest(base_image, manifest, False))
+        manifest.entries["requirements.txt"][2] = "0" * 40
+        self.assertNotEqual(digest, service._inputs_digest(base_image, manifest, False))
+        service.approot = "api"
+        self.assertNotEqual(digest, service._inputs_digest(base_image, manifest, False))
+
+    def test_build_stages(self):
+        application = Application(os.path.join(self.path, "simple_python_app"), {})
+        scheduler = _StageScheduler(workers=2)
+        scheduler.add("builder-files", lambda: [])
+        scheduler.add("scan", application._scan)
+        application.services[0]._add_build_stages(scheduler, None)
+        # The system packages are installed while the sources are scanned:
+        self.assertEqual(scheduler["www:packages"].inputs, [])
+        self.assertEqual(
+            scheduler["www:dependencies"].inputs, ["www:packages", "builder-files"]
+        )
+        self.assertEqual(
+            scheduler["www:memo"].inputs, ["scan", "builder-files"]
+        )
+        self.assertIn("www:memo", scheduler["www:build"].inputs)
+
+    def test_save_digests(self):
+        application = Application(os.path.join(self.path, "simple_gunicorn_gevent_app"), {})
+        manifest = application._scan()
+        manifest.entries["requirements.txt"][2] = "0" * 40
+        application._save_digests()
+        # The digests of the files that didn't change are re-used:
+        manifest = application._scan()
+        self.assertEqual(manifest.entries["requirements.txt"][2], "0" * 40)
+        self.assertTrue(all(
+            entry[2] is None for path, entry in manifest.entries.iteritems()
+            if path != "requirements.txt"
+        ))
+
+    def test_affected_services(self):
+        application = Application(os.path.join(self.path, "double_gunicorn"), {})
+        api, www = application.services
+        api.approot = "api"
+        self.assertEqual(application._affected_services({"api/wsgi.py"}), [api, www])
+        self.assertEqual(application._affected_services({"apidoc/index.rst"}), [www])
+        www.approot = "www/"
+        self.assertEqual(application._affected_services({"api"}), [api])
+        self.assertEqual(application._affected_services({"README"}), [])
+        self.assertEqual(application._affected_services({"dotcloud.yml"}), [api, www])
+        self.assertEqual(application._affected_services({""}), [api, www])
+
+    def test_rebuild_running_service(self):
+        application = Application(os.path.join(self.path, "simple_python_app"), {})
+        service = application.services[0]
+        running, session = _FakeContainer(), _FakeContainer()
+        service._container = running
+        def run_builder(session, *args):
+            # ^C while the build runs:
+            service.stop()
+            return False
+        service._upload_code = lambda *args: None
+        service._install_builder = lambda session: None
+        service._run_builder = run_builder
+        self.assertIsNone(service._build([], _FakeImage(session), None, None, None))
+        self.assertTrue(session.stopped)
+        self.assertTrue(running.stopped)
+        self.assertIs(service._container, running)
+        self.assertIsNone(service._session)
+
+    def test_restart_not_running(self):
+        application = Application(os.path.join(self.path, "simple_python_app"), {})
+        self.assertFalse(application.restart(application.services))
+        self.assertEqual(application._runners, {})
+
+    def test_build_applications_stages(self):
+        application = Application(os.path.join(self.path, "double_gunicorn"), {})
+        application._stage_prefix = "double_gunicorn/"
+        service = application.services[0]
+        scheduler = _StageScheduler()
+        scheduler.add("builder-files", lambda: [])
+        scheduler.add("double_gunicorn/scan", lambda: None)
+        service._add_build_stages(scheduler, None)
+        label = "double_gunicorn/{0}".format(service.name)
+        self.assertEqual(service._label, label)
+        self.assertEqual(
+            scheduler[label + ":build"].inputs[-2:],
+            ["double_gunicorn/scan", "builder-files"]
+        )
+        self.assertEqual(scheduler[label + ":tag"].scope, label)
+
+    def test_build_applications_errors(self):
+        simple = Application(os.path.join(self.path, "simple_python_app"), {})
+        mysql = Application(os.path.join(self.path, "mysql_app"), {})
+        results = build_applications([simple, mysql])
+        self.assertEqual(results.keys(), [simple, mysql])
+        self.assertIsNone(results[simple])
+        self.assertEqual(results[mysql], {})
+        with self.assertRaises(ValueError):
+            build_applications([simple, Application(simple._root, {})])
+
     def test_simple_application_build(self):
         application = Application(os.path.join(self.path, "simple_gunicorn_gevent_app"), {})
         images = application.build(base_image=Image(ImageRevSpec.parse("lopter/sandbox-base:latest")))
@@ -104,6 +254,163 @@ class TestApplication(unittest.TestCase):
         result = images.get("www")
         self.assertIsNotNone(result)
 
+class TestRunningInCI(unittest.TestCase):
+
+    def setUp(self):
+        ci = os.environ.pop("CI", None)
+        if ci is not None:
+            self.addCleanup(os.environ.__setitem__, "CI", ci)
+        self.addCleanup(os.environ.pop, "CI", None)
+
+    def test_running_in_ci(self):
+        self.assertFalse(_running_in_ci())
+        for value in ["true", "True", "1", "yes"]:
+            os.environ["CI"] = value
+            self.assertTrue(_running_in_ci(), value)
+        for value in ["", "false", "0", "no"]:
+            os.environ["CI"] = value
+            self.assertFalse(_running_in_ci(), value)
+
+class TestLayerCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = _LayerCache()
+
+    def test_digest(self):
+        self.assertEqual(
+            self.cache.digest("abc", ["cmake", "git"]),
+            self.cache.digest("abc", ["cmake", "git"])
+        )
+        self.assertNotEqual(
+            self.cache.digest("abc", ["cmake", "git"]),
+            self.cache.digest("def", ["cmake", "git"])
+        )
+
+    def test_build_once(self):
+        built = []
+        def build(revspec):
+            gevent.sleep(0.01)
+            built.append(revspec)
+            return "image"
+        greenlets = [
+            gevent.spawn(self.cache.get, "pkgs", "1234", build, refresh=True)
+            for i in xrange(3)
+        ]
+        gevent.joinall(greenlets)
+        self.assertEqual([g.value for g in greenlets], ["image"] * 3)
+        self.assertEqual(len(built), 1)
+        self.assertEqual(str(built[0]), "sandbox-cache:pkgs-1234")
+
+    def test_build_once_cold(self):
+        # The lookup in the cache yields (it asks the Docker daemon):
+        def lookup(revspec):
+            gevent.sleep(0.01)
+            raise UnkownImageError(str(revspec))
+        built = []
+        def build(revspec):
+            gevent.sleep(0.01)
+            built.append(revspec)
+            return "image"
+        image_class, sources.Image = sources.Image, lookup
+        try:
+            greenlets = [
+                gevent.spawn(self.cache.get, "pkgs", "1234", build)
+                for i in xrange(3)
+            ]
+            gevent.joinall(greenlets)
+        finally:
+            sources.Image = image_class
+        self.assertEqual([g.exception for g in greenlets], [None] * 3)
+        self.assertEqual([g.value for g in greenlets], ["image"] * 3)
+        self.assertEqual(len(built), 1)
+
+    def test_build_error(self):
+        def build(revspec):
+            gevent.sleep(0.01)
+            raise ValueError("apt is broken")
+        greenlets = [
+            gevent.spawn(self.cache.get, "pkgs", "1234", build, refresh=True)
+            for i in xrange(2)
+        ]
+        gevent.joinall(greenlets)
+        for greenlet in greenlets:
+            self.assertIsInstance(greenlet.exception, ValueError)
+
+class TestStageScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = _StageScheduler(workers=2)
+        self.running = 0
+        self.max_running = 0
+
+    def _sleep(self, duration, output):
+        def stage(*inputs):
+            self.running += 1
+            self.max_running = max(self.running, self.max_running)
+            gevent.sleep(duration)
+            self.running -= 1
+            return output
+        return stage
+
+    def test_run(self):
+        self.scheduler.add("scan", self._sleep(0.01, "manifest"))
+        self.scheduler.add("packages", self._sleep(0.05, "image"))
+        self.scheduler.add(
+            "build", lambda image, manifest: (image, manifest),
+            ["packages", "scan"]
+        )
+        self.scheduler.run()
+        self.assertEqual(self.scheduler["build"].output, ("image", "manifest"))
+        self.assertFalse(any(stage.failed for stage in self.scheduler))
+        self.assertEqual(self.max_running, 2)
+        self.assertEqual(
+            [stage.name for stage in self.scheduler.critical_path()],
+            ["packages", "build"]
+        )
+
+    def test_unknown_input(self):
+        with self.assertRaises(ValueError):
+            self.scheduler.add("build", lambda image: image, ["packages"])
+
+    def test_workers(self):
+        for i in xrange(5):
+            self.scheduler.add("stage{0}".format(i), self._sleep(0.01, i))
+        self.scheduler.run()
+        self.assertEqual(self.max_running, 2)
+
+    def test_required(self):
+        self.scheduler.add("packages", lambda: None, required=True)
+        self.scheduler.add("optional", lambda: None)
+        self.scheduler.add("build", lambda image: image, ["packages"])
+        self.scheduler.run()
+        self.assertTrue(self.scheduler["packages"].failed)
+        self.assertFalse(self.scheduler["optional"].failed)
+        self.assertTrue(self.scheduler["build"].skipped)
+
+    def test_cancel(self):
+        def timeout():
+            raise ContainerTimeoutError(["apt-get"], 1)
+        self.scheduler.add("packages", timeout)
+        self.scheduler.add("build", self._sleep(10, "image"))
+        with gevent.Timeout(2):
+            self.scheduler.run(cancel_on=ContainerTimeoutError)
+        self.assertIsInstance(
+            self.scheduler["packages"].exc_info[1], ContainerTimeoutError
+        )
+        self.assertTrue(self.scheduler["build"].failed)
+
+    def test_fail_fast(self):
+        failures = []
+        self.scheduler.add("packages", lambda: None, required=True,
+            on_failure=failures.append
+        )
+        self.scheduler.add("build", self._sleep(10, "image"))
+        with gevent.Timeout(2):
+            self.scheduler.run(fail_fast=True)
+        self.assertEqual(failures, [self.scheduler["packages"]])
+        self.assertTrue(self.scheduler["build"].failed)
+        self.assertIsNotNone(self.scheduler["build"].finished_at)
+
 class TestService(ContainerTestCase):
 
     def setUp(self):
@@ -124,15 +431,25 @@ class TestService(ContainerTestCase):
         self.service = self.application.services[0]
         self.assertDictEqual(self.service.ports, {})
 
-    def test_generate_environment_files(self):
-        self.application = Application(os.path.join(self.path, "simple_gunicorn_gevent_app"), {"API_KEY": "42"})
+    def _stream_service_tarball(self, env={}):
+        self.application = Application(os.path.join(self.path, "simple_gunicorn_gevent_app"), env)
         self.service = self.application.services[0]
-        env_json, env_yml, env_profile = self.service._generate_environment_files(self.tmpdir)
-        with open(env_json) as fp_json, open(env_yml) as fp_yml, open(env_profile) as fp_profile:
-            env_json = json.load(fp_json)
-            env_yml = yaml.safe_load(fp_yml)
+        self.application._scan()
+        builder_file = os.path.join(self.tmpdir, "bootstrap.sh")
+        with open(builder_file, "w") as fp:
+            fp.write("Test Content 42\n")
+        service_tarball = os.path.join(self.tmpdir, "service.tar")
+        with open(service_tarball, "w") as fp:
+            self.service._stream_service_tarball(fp, [builder_file])
+        # The stream is made of several tarballs:
+        return tarfile.open(service_tarball, ignore_zeros=True)
+
+    def test_environment_files(self):
+        with contextlib.closing(self._stream_service_tarball({"API_KEY": "42"})) as tarball:
+            env_json = json.load(tarball.extractfile("environment.json"))
+            env_yml = yaml.safe_load(tarball.extractfile("environment.yml"))
             env_profile = {}
-            for line in fp_profile:
+            for line in tarball.extractfile("dotcloud_profile"):
                 self.assertTrue(line.startswith("export "))
                 key, value = line[len("export "):-1].split("=") # strip export and \n
                 env_profile[key] = value
@@ -143,31 +460,27 @@ class TestService(ContainerTestCase):
             self.assertEqual(env.get("DOTCLOUD_SERVICE_NAME"), self.service.name)
             self.assertEqual(env.get("PORT_WWW"), str(self.service.CUSTOM_PORTS_RANGE_START))
 
-    def test_generate_service_tarball(self):
-        self.application = Application(os.path.join(self.path, "simple_gunicorn_gevent_app"), {})
-        self.service = self.application.services[0]
-        application_tarball = os.path.join(self.tmpdir, "application.tar")
-        with open(application_tarball, "w") as fp:
-            fp.write("Test Content 42\n")
-        service_tarball = self.service._generate_service_tarball(self.tmpdir, [application_tarball])
-        self.assertTrue(os.path.exists(service_tarball.dest))
-        with open(service_tarball.dest, "r") as fp:
-            service_tarball = fp.read()
-        self.assertIn("Test Content 42\n", service_tarball)
-        self.assertIn("DOTCLOUD_SERVICE_NAME", service_tarball)
+    def test_stream_service_tarball(self):
+        with contextlib.closing(self._stream_service_tarball()) as tarball:
+            names = tarball.getnames()
+            self.assertEqual(tarball.extractfile("bootstrap.sh").read(), "Test Content 42\n")
+            definition = json.load(tarball.extractfile("definition.json"))
+        self.assertIn("code/dotcloud.yml", names)
+        self.assertIn("code/requirements.txt", names)
+        self.assertEqual(definition["name"], self.service.name)
 
     def test_unpack_tarball(self):
         self.application = Application(os.path.join(self.path, "simple_gunicorn_gevent_app"), {})
         self.service = self.application.services[0]
-        application_tarball = os.path.join(self.tmpdir, "application.tar")
-        with open(application_tarball, "w") as fp:
-            fp.write("Test Content 42\n")
-        service_tarball = self.service._generate_service_tarball(self.tmpdir, [application_tarball])
-        self.service._unpack_service_tarball(service_tarball.dest, self.container)
+        self.application._scan()
+        self.service._unpack_service_tarball(
+            lambda dest: self.service._stream_service_tarball(dest, []),
+            self.container
+        )
         self.assertIsNotNone(self.container.result)
         result = self.container.result.instantiate()
         with _destroy_result(result):
             with result.run(["ls", "-lFh", self.service._extract_path]):
                 pass
-            self.assertIn("application.tar", result.logs)
-            self.assertIn("service.tar", result.logs)
+            self.assertIn("code/", result.logs)
+            self.assertIn("definition.json", result.logs)
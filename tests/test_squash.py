@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import logging; logging.basicConfig(level="DEBUG")
+import json
+import StringIO
+import tarfile
+import unittest
+
+from udotcloud.sandbox import squash
+
+def make_tar(members):
+    """Make a tarball in memory from a list of (name, content) tuples.
+
+    If content is None, the member is a directory, if it starts with "->" the
+    member is a hard link.
+    """
+
+    fp = StringIO.StringIO()
+    tar = tarfile.open(fileobj=fp, mode="w")
+    for name, content in members:
+        info = tarfile.TarInfo(name)
+        if content is None:
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+        elif content.startswith("->"):
+            info.type = tarfile.LNKTYPE
+            info.linkname = content[2:]
+            tar.addfile(info)
+        else:
+            info.size = len(content)
+            tar.addfile(info, StringIO.StringIO(content))
+    tar.close()
+    fp.seek(0)
+    return fp
+
+def read_tar(fp):
+    fp.seek(0)
+    tar = tarfile.open(fileobj=fp, mode="r")
+    members = {}
+    for member in tar:
+        content = None
+        if member.isfile():
+            content = tar.extractfile(member).read()
+        elif member.islnk():
+            content = "->" + member.linkname
+        members[member.name] = content
+    return members
+
+class TestSquash(unittest.TestCase):
+
+    def test_merge_layers(self):
+        top = make_tar([
+            ("./etc", None),
+            ("./etc/motd", "hello"),
+            ("./etc/.wh.hosts", ""),
+            ("./var/.wh.cache", ""),
+            ("./etc/issue", "->etc/issue.net")
+        ])
+        bottom = make_tar([
+            ("./etc", None),
+            ("./etc/motd", "bye"),
+            ("./etc/hosts", "localhost"),
+            ("./etc/issue.net", "Ubuntu"),
+            ("./var", None),
+            ("./var/cache", None),
+            ("./var/cache/apt", "debs")
+        ])
+        merged = StringIO.StringIO()
+        squash.merge_layers([top, bottom], merged)
+        members = read_tar(merged)
+        self.assertEqual(members["./etc/motd"], "hello")
+        self.assertEqual(members["./etc/issue.net"], "Ubuntu")
+        self.assertEqual(members["./etc/issue"], "->etc/issue.net")
+        # The whiteouts are kept since they can hide files from the base:
+        self.assertIn("./etc/.wh.hosts", members)
+        self.assertNotIn("./etc/hosts", members)
+        self.assertNotIn("./var/cache", members)
+        self.assertNotIn("./var/cache/apt", members)
+        self.assertIn("./var", members)
+
+    def test_merge_layers_recreated(self):
+        top = make_tar([("./tmp/lock", "1")])
+        bottom = make_tar([("./tmp/.wh.lock", "")])
+        merged = StringIO.StringIO()
+        self.assertEqual(squash.merge_layers([top, bottom], merged), 1)
+        self.assertEqual(read_tar(merged), {"./tmp/lock": "1"})
+
+    def test_squash_saved_image(self):
+        layers = [
+            ("c" * 64, "b" * 64, [("./app", "v2")]),
+            ("b" * 64, "a" * 64, [("./app", "v1"), ("./lib", "so")]),
+            ("a" * 64, None, [("./bin", "sh")])
+        ]
+        saved = StringIO.StringIO()
+        tar = tarfile.open(fileobj=saved, mode="w")
+        for layer_id, parent, members in layers:
+            config = json.dumps({"id": layer_id, "parent": parent, "Size": 2})
+            info = tarfile.TarInfo("{0}/json".format(layer_id))
+            info.size = len(config)
+            tar.addfile(info, StringIO.StringIO(config))
+            layer = make_tar(members).getvalue()
+            info = tarfile.TarInfo("{0}/layer.tar".format(layer_id))
+            info.size = len(layer)
+            tar.addfile(info, StringIO.StringIO(layer))
+        tar.close()
+        saved.seek(0)
+
+        loadable = StringIO.StringIO()
+        new_id = squash.squash_saved_image(
+            saved, loadable, "c" * 64, "a" * 64, "lopter/app", "ts-42"
+        )
+        loadable.seek(0)
+        tar = tarfile.open(fileobj=loadable, mode="r")
+        repositories = json.load(tar.extractfile("repositories"))
+        self.assertEqual(repositories, {"lopter/app": {"ts-42": new_id}})
+        config = json.load(tar.extractfile("{0}/json".format(new_id)))
+        self.assertEqual(config["parent"], "a" * 64)
+        self.assertNotIn("Size", config)
+        layer = tar.extractfile("{0}/layer.tar".format(new_id))
+        self.assertEqual(
+            read_tar(StringIO.StringIO(layer.read())),
+            {"./app": "v2", "./lib": "so"}
+        )
+
+    def test_squash_wrong_base(self):
+        saved = StringIO.StringIO()
+        tar = tarfile.open(fileobj=saved, mode="w")
+        config = json.dumps({"id": "c" * 64})
+        info = tarfile.TarInfo("{0}/json".format("c" * 64))
+        info.size = len(config)
+        tar.addfile(info, StringIO.StringIO(config))
+        tar.close()
+        saved.seek(0)
+        with self.assertRaises(ValueError):
+            squash.squash_saved_image(
+                saved, StringIO.StringIO(), "c" * 64, "a" * 64, "app", "latest"
+            )
@@ -74,3 +74,71 @@ class TestTarballfile(unittest.TestCase):
         self.assertTrue(os.path.exists(os.path.join(
             self.tmpdir, "custom_app", "dotcloud.yml"
         )))
+
+    def test_tar_from_list(self):
+        extract = gevent.subprocess.Popen(
+            ["tar", "-xf", "-", "-C", self.tmpdir], stdin=subprocess.PIPE
+        )
+        tarball = tarfile.Tarball.create_from_list(
+            ["simple_python_app/wsgi.py"], dest=extract.stdin, root_dir=self.path
+        )
+        tarball.wait()
+        self.assertEqual(extract.wait(), 0)
+
+        self.assertTrue(os.path.exists(os.path.join(
+            self.tmpdir, "simple_python_app", "wsgi.py"
+        )))
+        self.assertFalse(os.path.exists(os.path.join(
+            self.tmpdir, "simple_python_app", "dotcloud.yml"
+        )))
+
+    def test_stream_files(self):
+        extract = gevent.subprocess.Popen(
+            ["tar", "--ignore-zeros", "-xf", "-", "-C", self.tmpdir],
+            stdin=subprocess.PIPE
+        )
+        tarball = tarfile.Tarball.create_from_files(
+            ".", dest=extract.stdin,
+            root_dir=os.path.join(self.path, "simple_python_app"),
+            prefix="code"
+        )
+        tarball.wait()
+        tarfile.Tarball.write_files(
+            {"environment.json": "{}\n", "definition.json": "42" * 512},
+            extract.stdin
+        )
+        extract.stdin.close()
+        self.assertEqual(extract.wait(), 0)
+
+        self.assertTrue(os.path.exists(os.path.join(
+            self.tmpdir, "code", "dotcloud.yml"
+        )))
+        with open(os.path.join(self.tmpdir, "definition.json")) as fp:
+            self.assertEqual(fp.read(), "42" * 512)
+        with open(os.path.join(self.tmpdir, "environment.json")) as fp:
+            self.assertEqual(fp.read(), "{}\n")
+
+    def test_select_codec(self):
+        self.assertIsNone(tarfile.select_codec(1024))
+        self.assertEqual(tarfile.select_codec(64 * 1024 * 1024), "gzip")
+        self.assertIsNone(tarfile.select_codec(64 * 1024 * 1024, "none"))
+        self.assertEqual(tarfile.select_codec(1024, "xz"), "xz")
+
+    def test_compressor(self):
+        extract = gevent.subprocess.Popen(
+            ["tar", "--use-compress-program=gzip", "-xf", "-", "-C", self.tmpdir],
+            stdin=subprocess.PIPE
+        )
+        compressor = tarfile.Compressor("gzip", extract.stdin)
+        tarball = tarfile.Tarball.create_from_files(
+            "simple_python_app", dest=compressor, root_dir=self.path
+        )
+        tarball.wait()
+        compressor.close()
+        extract.stdin.close()
+        self.assertEqual(extract.wait(), 0)
+
+        self.assertGreater(compressor.bytes_in, compressor.bytes_out)
+        self.assertTrue(os.path.exists(os.path.join(
+            self.tmpdir, "simple_python_app", "dotcloud.yml"
+        )))
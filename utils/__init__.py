@@ -18,6 +18,21 @@ def bytes_to_human(value):
             break
     return str(int(value)) + suffix
 
+def human_to_bytes(value):
+    """Counterpart of bytes_to_human: human_to_bytes("512M") → 536870912.
+
+    The suffix is case insensitive and optional (bytes).
+
+    :raises: ValueError if value can't be parsed.
+    """
+
+    factors = {"t": 1024**4, "g": 1024**3, "m": 1024**2, "k": 1024, "b": 1}
+    value = str(value).strip().lower()
+    factor = factors.get(value[-1:])
+    if factor is not None:
+        value = value[:-1]
+    return int(float(value) * (factor or 1))
+
 @contextlib.contextmanager
 def ignore_eexist():
     try: